@@ -0,0 +1,219 @@
+"""
+bench_yards.py measures the throughput of the generation pipeline.
+
+Every case runs yards.loop() in a fresh process on the example data, or on a synthetic library scaled up
+from it, and reports images/sec, peak RSS and the time spent in each stage of the pipeline. The results are
+written as JSON so that runs on two commits can be compared with --compare.
+
+    python benchmarks/bench_yards.py --output results.json
+    python benchmarks/bench_yards.py --output new.json --compare results.json
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import argparse
+import copy
+import json
+import multiprocessing as mp
+import os
+import platform
+import queue as queue_module
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_DIR = os.path.join(ROOT_DIR, 'example') + '/'
+sys.path.insert(0, ROOT_DIR)
+
+STAGES = ['plan', 'background', 'sprite_load', 'transform', 'edge_handler', 'composite', 'encode', 'annotation']
+
+# (name, parameter overrides, library) - the library is 'example' or the scale of the synthetic library
+CASES = [
+    ('baseline', {}, 'example'),
+    ('scheme-distribution', {'classification_scheme': 'distribution'}, 'example'),
+    ('scheme-discrete', {'classification_scheme': 'discrete'}, 'example'),
+    ('scheme-mimic-real', {'classification_scheme': 'mimic-real'}, 'example'),
+    ('placement-learned', {'classification_scheme': 'mimic-real', 'placement_scheme': 'learned', 'transform_sprites': True}, 'example'),
+    ('transform', {'transform_sprites': True}, 'example'),
+    ('transform-precomputed', {'transform_sprites': True, 'precompute_transforms': True}, 'example'),
+    ('clip', {'clip_sprites': True}, 'example'),
+    ('transform-clip', {'transform_sprites': True, 'clip_sprites': True}, 'example'),
+    ('renderer-numpy', {'renderer': 'numpy'}, 'example'),
+    ('renderer-numpy-transform-clip', {'renderer': 'numpy', 'transform_sprites': True, 'clip_sprites': True}, 'example'),
+    ('sprites-x4', {'sprites_per_class': 8}, 'example'),
+    ('sprites-x16-renderer-numpy', {'sprites_per_class': 32, 'renderer': 'numpy'}, 'example'),
+    ('sprites-x16', {'sprites_per_class': 32}, 'example'),
+    ('maps-x2', {}, 2),
+    ('maps-x4', {}, 4),
+    ('maps-x4-transform-clip', {'transform_sprites': True, 'clip_sprites': True}, 4),
+    ('maps-x4-viewport', {'viewport': [256, 192]}, 4),
+    ('maps-x4-small-cache', {'cache_size_mb': 8}, 4),
+    ('maps-x4-small-cache-grouped', {'cache_size_mb': 8, 'group_by_background': True}, 4),
+]
+
+
+def _build_library(directory, scale):
+    """Writes a copy of the example maps and sprites with every map tiled scale x scale times."""
+    os.makedirs(directory + 'maps/')
+    for name in sorted(os.listdir(EXAMPLE_DIR + 'maps/')):
+        if not name.endswith('.png'):
+            continue
+        image = Image.open(EXAMPLE_DIR + 'maps/' + name).convert('RGBA')
+        width, height = image.size
+        scaled = Image.new('RGBA', (width * scale, height * scale))
+        for i in range(scale):
+            for j in range(scale):
+                scaled.paste(image, (i * width, j * height))
+        scaled.save(directory + 'maps/' + name)
+    # the sprites are kept as is, so that only the map size changes
+    return directory + 'maps/', EXAMPLE_DIR + 'sprites/'
+
+
+def _make_config(work_dir, parameters, library, num_images, seed):
+    """Returns the config of a case."""
+    with open(EXAMPLE_DIR + 'config.yaml') as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+    parameters = dict(parameters)
+
+    if library == 'example':
+        maps_dir, sprites_dir = EXAMPLE_DIR + 'maps/', EXAMPLE_DIR + 'sprites/'
+    else:
+        maps_dir, sprites_dir = _build_library(work_dir + 'library/', library)
+    # the real data is copied, since learning from it caches its stats in its directory
+    shutil.copytree(EXAMPLE_DIR + 'smb_handlabeled', work_dir + 'real')
+    config['directories'] = {'maps': maps_dir, 'sprites': sprites_dir, 'output': work_dir + 'output/', 'real': work_dir + 'real/'}
+
+    # sprites_per_class is a benchmark knob rather than a config parameter
+    sprites_per_class = parameters.pop('sprites_per_class', None)
+    if sprites_per_class is not None:
+        config['classes'] = {c: sprites_per_class for c in config['classes']}
+    if parameters.get('classification_scheme') == 'distribution':
+        config['classes'] = {c: [0.25, 0.25, 0.25, 0.25] for c in config['classes']}
+    elif parameters.get('classification_scheme') == 'mimic-real':
+        config['classes'] = {c: i for i, c in enumerate(config['classes'])}
+
+    config['parameters'].update(parameters)
+    config['parameters']['num_images'] = num_images
+    config['parameters']['seed'] = seed
+    return config
+
+
+def _run_case(work_dir, parameters, library, num_images, seed, queue):
+    """Runs one case in a fresh process and puts its result on the queue."""
+    import contextlib
+    from yards.yards import yards
+    from yards.tools import _profiler
+
+    config = _make_config(work_dir, parameters, library, num_images, seed)
+    config_path = work_dir + 'config.yaml'
+    with open(config_path, 'w') as file:
+        yaml.dump(config, file)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        yd = yards(config_path)
+        setup = time.perf_counter() - start
+
+        _profiler.reset()
+        _profiler.enable()
+        start = time.perf_counter()
+        yd.loop()
+        elapsed = time.perf_counter() - start
+        _profiler.disable()
+
+    stats = _profiler.get_stats()['stages']
+    queue.put({
+        'num_images': num_images,
+        'setup_seconds': setup,
+        'loop_seconds': elapsed,
+        'images_per_sec': num_images / elapsed if elapsed > 0 else 0.0,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10),
+        'stages': {name: {'seconds': stats[name]['total'], 'calls': stats[name]['calls'], 'share': stats[name]['total'] / elapsed if elapsed > 0 else 0.0}
+                   for name in STAGES if name in stats}
+    })
+
+
+def run_case(name, parameters, library, num_images, seed):
+    """Runs a case in a spawned process, so that its peak RSS isn't shared with other cases."""
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    with tempfile.TemporaryDirectory() as work_dir:
+        process = ctx.Process(target=_run_case, args=(work_dir + '/', parameters, library, num_images, seed, queue))
+        process.start()
+        result = None
+        # poll the queue, so that a case that crashes doesn't hang the benchmark
+        while result is None and (process.is_alive() or not queue.empty()):
+            try:
+                result = queue.get(timeout=1)
+            except queue_module.Empty:
+                pass
+        process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError('Benchmark case {} failed with exit code {}.'.format(name, process.exitcode))
+    result.update({'parameters': parameters, 'library': library})
+    return result
+
+
+def _git_commit():
+    """Returns the commit the benchmark ran on, or None outside a git checkout."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Prints the change in images/sec of every case against a baseline run."""
+    print('{:<32}{:>12}{:>12}{:>10}'.format('case', 'baseline', 'current', 'change'))
+    for name, result in results['cases'].items():
+        if name not in baseline['cases']:
+            continue
+        old, new = baseline['cases'][name]['images_per_sec'], result['images_per_sec']
+        print('{:<32}{:>12.1f}{:>12.1f}{:>+9.1f}%'.format(name, old, new, 100 * (new - old) / old if old > 0 else 0.0))
+
+
+def _get_args():
+    """Parses and returns command-line arguments."""
+    parser = argparse.ArgumentParser(description='Measures the throughput of yards.loop().')
+    parser.add_argument('--num-images', '-n', type=int, default=200, help='The number of images each case generates.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed every case generates with.')
+    parser.add_argument('--cases', nargs='*', default=None, help='The names of the cases to run. Runs every case if not given.')
+    parser.add_argument('--output', '-o', type=str, default=None, help='The path to write the JSON results to.')
+    parser.add_argument('--compare', type=str, default=None, help='The path to the JSON results of a baseline run to compare against.')
+    return parser.parse_args()
+
+
+def main():
+    '''Runs the benchmark cases'''
+    args = _get_args()
+    cases = [case for case in CASES if args.cases is None or case[0] in args.cases]
+
+    results = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cases': {}
+    }
+    for name, parameters, library in cases:
+        result = run_case(name, copy.deepcopy(parameters), library, args.num_images, args.seed)
+        results['cases'][name] = result
+        breakdown = ', '.join('{} {:.0f}%'.format(stage, 100 * timing['share']) for stage, timing in result['stages'].items())
+        print('{:<32}{:>8.1f} images/sec {:>8.1f} MB  ({})'.format(name, result['images_per_sec'], result['peak_rss_mb'], breakdown))
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
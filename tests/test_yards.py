@@ -1,5 +1,678 @@
+import os
+import json
+import yaml
+import numpy as np
 from yards import __version__
+from yards.yards import yards
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example') + '/'
+
+
+def _write_config(tmp_path, output_format=None, **parameters):
+    """Writes a config for the example data into tmp_path and returns its path."""
+    with open(EXAMPLE_DIR + 'config.yaml') as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+    config['directories'] = {
+        'maps': EXAMPLE_DIR + 'maps/',
+        'sprites': EXAMPLE_DIR + 'sprites/',
+        'output': str(tmp_path) + '/output/',
+        'real': EXAMPLE_DIR + 'smb_handlabeled/'
+    }
+    config['parameters']['num_images'] = 20
+    config['parameters'].update(parameters)
+    if output_format is not None:
+        config['output_format'] = output_format
+    os.makedirs(str(tmp_path), exist_ok=True)
+    config_path = str(tmp_path) + '/config.yaml'
+    with open(config_path, 'w') as file:
+        yaml.dump(config, file)
+    return config_path
+
+
+def _output_files(yd):
+    """Returns the sorted names of every image and label in the output directories."""
+    return {key: sorted(os.listdir(path)) for key, path in yd._output_dirs.items()}
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_parallel_loop_matches_loop_split(tmp_path):
+    yd = yards(_write_config(tmp_path / 'serial'))
+    yd.loop()
+    pyd = yards(_write_config(tmp_path / 'parallel'))
+    pyd.parallel_loop(num_cpus=2)
+    assert _output_files(pyd) == _output_files(yd)
+    assert len(_output_files(pyd)['images_train']) == 16
+
+
+def test_parallel_loop_mixes_real_images(tmp_path):
+    yd = yards(_write_config(tmp_path, mix_size=0.5))
+    yd.parallel_loop(num_cpus=2)
+    files = _output_files(yd)
+    assert len(files['images_train']) + len(files['images_val']) == 20
+    assert files['labels_train'] == [os.path.splitext(f)[0] + '.txt' for f in files['images_train']]
+
+
+def _read_outputs(yd):
+    """Returns the bytes of every image and label in the output directories."""
+    outputs = {}
+    for path in yd._output_dirs.values():
+        for name in os.listdir(path):
+            with open(path + name, 'rb') as file:
+                outputs[name] = file.read()
+    return outputs
+
+
+def test_seeded_runs_are_reproducible(tmp_path):
+    yd = yards(_write_config(tmp_path / 'serial', seed=7, mix_size=0.5, transform_sprites=True, clip_sprites=True))
+    yd.loop()
+    pyd = yards(_write_config(tmp_path / 'parallel', seed=7, mix_size=0.5, transform_sprites=True, clip_sprites=True))
+    pyd.parallel_loop(num_cpus=2)
+    assert _read_outputs(pyd) == _read_outputs(yd)
+
+
+def test_single_image_can_be_regenerated(tmp_path):
+    yd = yards(_write_config(tmp_path, seed=7))
+    yd.loop()
+    outputs = _read_outputs(yd)
+    os.remove(yd._output_dirs['images_train'] + 'super_mario_bros-3.png')
+    yd._create_images([(3, True)])
+    assert _read_outputs(yd) == outputs
+
+
+def test_image_cache_evicts_least_recently_used():
+    from yards.tools._cache import ImageCache
+    paths = [EXAMPLE_DIR + 'maps/{}.png'.format(i) for i in range(1, 4)]
+    cache = ImageCache(max_bytes=2 * 256 * 192 * 4)
+    cache.preload(paths)
+    assert len(cache) == 2 and paths[2] not in cache
+    cache.get(paths[0])
+    cache.get(paths[2])
+    assert paths[1] not in cache and paths[0] in cache
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1 and cache.stats()['evictions'] == 1
+    # sizes are read without decoding into the cache
+    assert cache.get_size(paths[1]) == (256, 192) and paths[1] not in cache and cache.stats()['misses'] == 1
+    # the numpy renderer's arrays count against the same budget
+    from yards.tools._compositor import Compositor
+    compositor = Compositor(cache)
+    compositor.add_background(paths[2], cache.get(paths[2]))
+    assert compositor.get_background(paths[2]) is not None and paths[0] not in cache and cache.stats()['evictions'] == 2
+
+
+def test_transform_atlas_matches_transform_per_map_size():
+    from yards.tools import _helper
+    from yards.tools._atlas import TransformAtlas
+    from yards.tools._cache import ImageCache
+    path = EXAMPLE_DIR + 'sprites/player/0.png'
+    cache = ImageCache()
+    sprite = cache.get(path)
+    small_map = (sprite.size[0] * 3, sprite.size[1] * 3)
+    tiny_map = (sprite.size[0] + 1, sprite.size[1] + 1)
+    atlas = TransformAtlas()
+    atlas.build(cache, [path], [(256, 192), small_map])
+    for map_dim in [(256, 192), small_map, tiny_map]:
+        for mirror in (False, True):
+            for rotate in range(4):
+                for resize in (False, True):
+                    operations = (mirror, rotate, resize)
+                    expected = _helper.apply_transform(sprite, operations, map_dim)
+                    variant = atlas.get(path, _helper.get_transform_index(operations), map_dim)
+                    assert variant.size == expected.size and variant.tobytes() == expected.tobytes()
+
+
+def test_sprite_metadata_persists_transparencies(tmp_path):
+    import shutil
+    from yards.tools import _helper
+    from yards.tools._cache import ImageCache
+    from yards.tools._metadata import SpriteMetadata
+    sprites_dir = str(tmp_path) + '/sprites/'
+    shutil.copytree(EXAMPLE_DIR + 'sprites/', sprites_dir)
+    paths = [sprites_dir + 'player/0.png', sprites_dir + 'enemy/1.png']
+    cache = ImageCache()
+    metadata = SpriteMetadata()
+    metadata.build(cache, paths, [(256, 192)], True)
+    metadata.save(sprites_dir)
+
+    loaded = SpriteMetadata()
+    loaded.load(sprites_dir)
+    loaded.build(cache, paths, [(256, 192)], True)
+    assert not loaded._is_modified
+    for path in paths:
+        sprite = _helper.apply_transform(cache.get(path), (True, 1, False), (256, 192))
+        expected = [{key: int(value) for key, value in quadrant.items()} for quadrant in _helper._get_transparencies(sprite)]
+        assert loaded.get_transparencies(path, _helper.get_transform_index((True, 1, False))) == expected
+
+
+def test_packed_libraries_match_image_files(tmp_path, monkeypatch):
+    import shutil
+    from PIL import Image
+    from yards.tools import _cache, _pack
+    for library in ('maps', 'sprites'):
+        shutil.copytree(EXAMPLE_DIR + library, str(tmp_path) + '/' + library)
+        pack, num_decoded = _pack.build_pack(str(tmp_path) + '/' + library + '/')
+        assert num_decoded == len(pack) > 0
+
+    yd = yards(_write_config(tmp_path / 'files', seed=3, clip_sprites=True, transform_sprites=True))
+    yd.loop()
+    config_path = _write_config(tmp_path / 'packed', seed=3, clip_sprites=True, transform_sprites=True, use_packs=True)
+    with open(config_path) as file:
+        config = yaml.safe_load(file)
+    config['directories'].update(maps=str(tmp_path) + '/maps/', sprites=str(tmp_path) + '/sprites/')
+    # packed images are never decoded
+    monkeypatch.setattr(_cache.Image, 'open', None)
+    packed = yards()
+    packed.set_config(config)
+    packed.parallel_loop(num_cpus=2)
+    assert _read_outputs(packed) == _read_outputs(yd)
+    monkeypatch.undo()
+
+    # packing again only decodes the changed sprite
+    path = str(tmp_path) + '/sprites/player/0.png'
+    Image.open(path).transpose(Image.FLIP_LEFT_RIGHT).save(path)
+    assert _pack.SpritePack.open(str(tmp_path) + '/sprites/').get_stale_paths() == ['player/0.png']
+    pack, num_decoded = _pack.build_pack(str(tmp_path) + '/sprites/')
+    assert num_decoded == 1 and pack.get_stale_paths() == []
+    with Image.open(path) as image:
+        assert np.array_equal(np.asarray(pack.get_image(path)), np.asarray(image.convert('RGBA')))
+
+    # a run packs a changed sprite again instead of serving its old pixels
+    Image.open(path).transpose(Image.FLIP_TOP_BOTTOM).save(path)
+    repacked = yards()
+    repacked.set_config(config)
+    with Image.open(path) as image:
+        assert np.array_equal(np.asarray(repacked._image_cache.get(path)), np.asarray(image.convert('RGBA')))
+
+
+def test_plan_does_not_depend_on_chunking(tmp_path):
+    from yards.tools._planner import PlacementPlan
+    yd = yards(_write_config(tmp_path, seed=11, transform_sprites=True, clip_sprites=True))
+    plan = yd.plan(range(1, 21))
+    single = [yd.plan([count]).placements for count in range(1, 21)]
+    assert (plan.placements == np.concatenate(single)).all()
+    plan.save(str(tmp_path) + '/plan.npz')
+    loaded = PlacementPlan.load(str(tmp_path) + '/plan.npz')
+    assert (loaded.images == plan.images).all() and (loaded.placements == plan.placements).all()
+    assert loaded.sprite_paths == plan.sprite_paths
+
+
+def test_planner_rejects_classes_it_cannot_draw():
+    import pytest
+    from yards.tools import _validator
+    from yards.tools._planner import Planner
+    assert _validator.validate_classes({'player': [0.5, 0.5]}, 'distribution')
+    assert not _validator.validate_classes({'player': [0.5, 0.4]}, 'distribution')
+    path = EXAMPLE_DIR + 'sprites/player/0.png'
+    with pytest.raises(ValueError, match='enemy'):
+        Planner({'enemy': 1, 'player': 1}, {'enemy': 0, 'player': 1}, 'random', -1, ['map.png'], [(256, 192)],
+                {'enemy': [], 'player': [path]}, {path: (16, 16)}, False, False)
+
+
+def test_output_formats_round_trip(tmp_path):
+    import threading
+    from PIL import Image
+    for image_format in ['png', 'bmp', 'ppm', 'tga', 'webp']:
+        yd = yards(_write_config(tmp_path / image_format, seed=5, mix_size=0.5))
+        yd.set_output_format({'format': image_format, 'compress_level': 1, 'encoder_threads': 2} if image_format == 'png' else {'format': image_format, 'encoder_threads': 2})
+        yd.loop()
+        # the encoder's threads are shut down once the loop is done
+        assert not any(thread.name.startswith('ThreadPoolExecutor') for thread in threading.enumerate())
+        synthetic = [name for name in os.listdir(yd._output_dirs['images_train']) if name.endswith('.' + image_format)]
+        assert len(synthetic) > 0
+        with Image.open(yd._output_dirs['images_train'] + synthetic[0]) as image:
+            assert image.size == (256, 192)
+        yd.visualize(num_visualize=3)
+        assert len(os.listdir(yd._dirs['output'] + 'examples/')) == 3
+
+
+def test_shards_pack_every_sample(tmp_path):
+    from yards.tools import _shards
+    output_format = {'mode': 'shards', 'shard_size': 4}
+    yd = yards(_write_config(tmp_path / 'serial', output_format, seed=5, mix_size=0.5))
+    yd.loop()
+    pyd = yards(_write_config(tmp_path / 'parallel', output_format, seed=5, mix_size=0.5))
+    pyd.parallel_loop(num_cpus=2)
+    shards_dir = yd._output_dirs['shards']
+    assert sorted(os.listdir(shards_dir)) == sorted(os.listdir(pyd._output_dirs['shards']))
+    for name in os.listdir(shards_dir):
+        with open(shards_dir + name, 'rb') as file, open(pyd._output_dirs['shards'] + name, 'rb') as parallel_file:
+            assert file.read() == parallel_file.read()
+
+    index = {**_shards.read_index(shards_dir, 'train'), **_shards.read_index(shards_dir, 'val')}
+    assert len(index) == 20 and all(set(members) == {'.png', '.txt'} for members in index.values())
+    with open(EXAMPLE_DIR + 'smb_handlabeled/labels/n-im_00001.txt', 'rb') as file:
+        real_label = file.read()
+    assert any(_shards.read_member(shards_dir, members['.txt']) == real_label for members in index.values())
+
+
+def test_stream_yields_the_images_loop_writes(tmp_path):
+    from PIL import Image
+    yd = yards(_write_config(tmp_path, seed=9, clip_sprites=True))
+    yd.loop()
+    serial = list(yd.stream(n=5, start=2))
+    background = list(yd.stream(n=5, start=2, num_workers=2, chunk_size=2, prefetch=1))
+    for count, (image, boxes, class_ids), (parallel_image, _, _) in zip(range(2, 7), serial, background):
+        with Image.open(yd._output_dirs['images_train'] + 'super_mario_bros-{}.png'.format(count)) as written:
+            assert (np.asarray(written.convert('RGB')) == image).all()
+        assert (parallel_image == image).all()
+        with open(yd._output_dirs['labels_train'] + 'super_mario_bros-{}.txt'.format(count)) as file:
+            labels = np.array([[float(i) for i in line.split()] for line in file]).reshape(-1, 5)
+        assert (labels[:, 0] == class_ids).all() and np.allclose(labels[:, 1:], boxes)
+
+    infinite = yd.stream()
+    assert [next(infinite)[0].shape for _ in range(3)] == [(192, 256, 3)] * 3
+
+
+def test_resume_and_append(tmp_path):
+    from yards.tools import _manifest
+    config_path = _write_config(tmp_path, mix_size=0.5)
+    yd = yards(config_path)
+    yd.loop()
+    outputs = _read_outputs(yd)
+    # the checksums hashed before writing are those of the written files
+    for count, (is_train, size, checksum) in yd._manifest.completed.items():
+        assert _manifest.checksum_files(yd._get_sample_paths(count, is_train, '.png')) == (size, checksum)
+
+    # simulate an interrupted run: lose some files and the end of the log
+    removed = sorted(os.listdir(yd._output_dirs['images_train']))[0]
+    os.remove(yd._output_dirs['images_train'] + removed)
+    with open(yd._dirs['output'] + 'manifest.log') as file:
+        lines = file.readlines()
+    with open(yd._dirs['output'] + 'manifest.log', 'w') as file:
+        file.writelines(lines[:-5] + [lines[-5][:10]])
+
+    # parameters that don't change the images may differ in the resumed run
+    config_path = _write_config(tmp_path, mix_size=0.5, cache_size_mb=1, precompute_transforms=True)
+    resumed = yards()
+    resumed.load_config_from_file(config_path, resume=True)
+    real_tasks, synt_tasks = resumed._get_pending_tasks()
+    lost = {int(line.split()[0]) for line in lines[-5:]} | {int(os.path.splitext(removed)[0].split('-')[-1])}
+    assert {task[1] for task in real_tasks} | {task[0] for task in synt_tasks} == lost
+    resumed.loop()
+    assert _read_outputs(resumed) == outputs
+
+    appended = yards()
+    appended.load_config_from_file(config_path, resume=True)
+    appended.append(10)
+    appended.loop()
+    files = _output_files(appended)
+    assert len(files['images_train']) + len(files['images_val']) == 30
+    assert 'super_mario_bros-28.png' in files['images_train'] and 'super_mario_bros-30.png' in files['images_val']
+    assert {name: data for name, data in _read_outputs(appended).items() if name in outputs} == outputs
+
+    # the dataset index covers the images of every run
+    for split in ('train', 'val'):
+        with open(appended._dirs['output'] + split + '.txt') as file:
+            listed = [line.strip() for line in file]
+        assert sorted(os.path.split(path)[1] for path in listed) == files['images_' + split]
+        assert all(os.path.isfile(appended._dirs['output'] + path) for path in listed)
+
+
+def test_resume_keeps_outputs_it_cannot_resume(tmp_path):
+    import pytest
+    yd = yards(_write_config(tmp_path / 'shards', output_format={'mode': 'shards', 'shard_size': 4}))
+    yd.loop()
+    shards = sorted(os.listdir(yd._output_dirs['shards']))
+    resumed = yards()
+    with pytest.raises(ValueError):
+        resumed.load_config_from_file(yd._config_path, resume=True)
+    assert sorted(os.listdir(yd._output_dirs['shards'])) == shards
+    with pytest.raises(ValueError):
+        yd.append(10)
+
+    # an output written before manifests existed has nothing to resume, so it's kept
+    yd = yards(_write_config(tmp_path / 'files'))
+    yd.loop()
+    outputs = _read_outputs(yd)
+    os.remove(yd._dirs['output'] + 'manifest.json')
+    with pytest.raises(ValueError):
+        yards().load_config_from_file(yd._config_path, resume=True)
+    assert _read_outputs(yd) == outputs
+
+
+def test_dataset_index_matches_labels(tmp_path):
+    yd = yards(_write_config(tmp_path, seed=5, mix_size=0.5))
+    yd.parallel_loop(num_cpus=2)
+    with open(yd._dirs['output'] + 'dataset_stats.json') as file:
+        stats = json.load(file)
+    with open(yd._dirs['output'] + 'data.yaml') as file:
+        data = yaml.safe_load(file)
+    assert data['names'] == {n: c for c, n in yd._class_numbers.items()} and data['train'] == 'train.txt'
+
+    for split in ('train', 'val'):
+        classes, boxes_per_image = {}, {}
+        for name in os.listdir(yd._output_dirs['labels_' + split]):
+            with open(yd._output_dirs['labels_' + split] + name) as file:
+                class_ids = [line.split()[0] for line in file if line.strip()]
+            boxes_per_image[str(len(class_ids))] = boxes_per_image.get(str(len(class_ids)), 0) + 1
+            for class_id in class_ids:
+                classes[class_id] = classes.get(class_id, 0) + 1
+        assert stats[split]['classes'] == classes and stats[split]['boxes_per_image'] == boxes_per_image
+        assert stats[split]['images'] == len(os.listdir(yd._output_dirs['images_' + split]))
+
+
+def test_profile_counts_serial_and_parallel_runs(tmp_path):
+    from yards.tools import _profiler
+    reports = []
+    yd = yards(_write_config(tmp_path / 'serial', seed=7, clip_sprites=True))
+    _profiler.reset()
+    yd.enable_profiling(reports.append)
+    try:
+        yd.loop()
+        serial = yd.get_profile()
+        _profiler.reset()
+        pyd = yards(_write_config(tmp_path / 'parallel', seed=7, clip_sprites=True))
+        pyd.parallel_loop(num_cpus=2)
+        parallel = pyd.get_profile()
+    finally:
+        yd.disable_profiling()
+        _profiler.remove_exporter(reports.append)
+        _profiler.reset()
+
+    assert len(reports) == 2
+    assert serial['counters']['images'] == 20 and serial['stages']['composite']['calls'] == serial['counters']['sprites_placed']
+    # the workers' stats are merged into the main process
+    for key in ('images', 'sprites_placed', 'edge_handler_calls', 'bytes_written'):
+        assert parallel['counters'][key] == serial['counters'][key]
+
+
+def test_numpy_renderer_matches_pil_renderer(tmp_path):
+    pil = yards(_write_config(tmp_path / 'pil', seed=7, transform_sprites=True, clip_sprites=True))
+    fast = yards(_write_config(tmp_path / 'numpy', seed=7, transform_sprites=True, clip_sprites=True, renderer='numpy'))
+    for (image, boxes, class_ids), (fast_image, fast_boxes, fast_class_ids) in zip(pil.stream(20), fast.stream(20)):
+        assert (fast_image == image).all()
+        assert np.array_equal(fast_boxes, boxes) and np.array_equal(fast_class_ids, class_ids)
+
+    # sprites with partial alpha are blended like alpha_composite, up to rounding
+    from PIL import Image
+    from yards.tools import _compositor
+    rng = np.random.default_rng(0)
+    background = Image.fromarray(rng.integers(0, 256, (8, 8, 4), dtype=np.uint8)).convert('RGB').convert('RGBA')
+    sprite = Image.fromarray(rng.integers(0, 256, (4, 4, 4), dtype=np.uint8))
+    expected = background.copy()
+    expected.alpha_composite(sprite, dest=(2, 3))
+    array = np.array(background.convert('RGB'))
+    _compositor.composite(array, _compositor.SpriteArrays(sprite), (0, 0, 4, 4), (2, 3))
+    assert np.abs(array.astype(int) - np.asarray(expected.convert('RGB'))).max() <= 1
+
+
+def test_grouping_by_background_keeps_outputs(tmp_path):
+    yd = yards(_write_config(tmp_path / 'serial', seed=7, mix_size=0.5))
+    yd.loop()
+    grouped = yards(_write_config(tmp_path / 'grouped', seed=7, mix_size=0.5, group_by_background=True))
+    grouped.parallel_loop(num_cpus=2)
+    assert _read_outputs(grouped) == _read_outputs(yd)
+
+    shards = yards(_write_config(tmp_path / 'shards', seed=7, group_by_background=True))
+    shards.set_output_format({'mode': 'shards', 'shard_size': 8})
+    assert [task[0] for task in shards._get_scheduled_tasks()[1]] == list(range(1, 21))
+
+
+def test_real_copy_modes_keep_outputs(tmp_path):
+    yd = yards(_write_config(tmp_path / 'copy', seed=7, mix_size=0.5))
+    yd.loop()
+    for mode in ('hardlink', 'symlink', 'reflink'):
+        linked = yards(_write_config(tmp_path / mode, seed=7, mix_size=0.5, real_copy_mode=mode, real_copy_threads=3))
+        linked.loop()
+        assert _read_outputs(linked) == _read_outputs(yd)
+        # running again over the links replaces them rather than writing through them
+        linked._manifest.completed.clear()
+        linked._copy_real_samples(linked._get_scheduled_tasks()[0])
+        assert _read_outputs(linked) == _read_outputs(yd)
+
+    # every real image and label is a link to the real file, and every synthetic one is a file
+    targets = [os.readlink(path.replace('/copy/', '/symlink/') + name) for path in yd._output_dirs.values()
+               for name in os.listdir(path) if os.path.islink(path.replace('/copy/', '/symlink/') + name)]
+    assert len(targets) == 20
+    assert all(target.startswith(EXAMPLE_DIR + 'smb_handlabeled/') for target in targets)
+
+
+def test_background_weights(tmp_path):
+    yd = yards(_write_config(tmp_path, seed=7, background_weights={'1.png': 0, '2.png': 3.0}))
+    counts = list(range(1, 201))
+    backgrounds = yd.plan(counts).images['background']
+    assert (yd._planner.backgrounds(7, counts) == backgrounds).all()
+    names = [os.path.split(yd._map_path_cache[i])[1] for i in backgrounds]
+    assert '1.png' not in names and names.count('2.png') > names.count('3.png')
+
+
+def test_viewport_crops_maps(tmp_path):
+    yd = yards(_write_config(tmp_path / 'crop', seed=7, transform_sprites=True, viewport=[128, 96]))
+    plan = yd.plan(range(1, 21))
+    assert (plan.images['width'] == 128).all() and (plan.images['height'] == 96).all()
+    assert len(set(zip(plan.images['left'], plan.images['top']))) > 1
+    assert ((plan.images['left'] <= 256 - 128) & (plan.images['top'] <= 192 - 96)).all()
+    for (image, placements), (array, boxes, _) in zip(plan, yd.stream(20)):
+        assert array.shape == (96, 128, 3)
+        assert ((boxes[:, :2] - boxes[:, 2:] / 2 >= -1e-6) & (boxes[:, :2] + boxes[:, 2:] / 2 <= 1 + 1e-6)).all()
+        # pixels that no sprite covers show the map's window
+        window = np.asarray(yd._image_cache.get(yd._map_path_cache[image['background']]).convert('RGB'))[image['top']:image['top']+96, image['left']:image['left']+128]
+        uncovered = np.ones((96, 128), dtype=bool)
+        for placement in placements:
+            uncovered[placement['y']:placement['y']+placement['height'], placement['x']:placement['x']+placement['width']] = False
+        assert (array[uncovered] == window[uncovered]).all()
+
+    # clipping happens at the edges of the viewport
+    pil = yards(_write_config(tmp_path / 'pil', seed=7, clip_sprites=True, transform_sprites=True, viewport=[128, 96]))
+    fast = yards(_write_config(tmp_path / 'numpy', seed=7, clip_sprites=True, transform_sprites=True, viewport=[128, 96], renderer='numpy'))
+    for (array, boxes, _), (fast_array, _, _) in zip(pil.stream(20), fast.stream(20)):
+        assert array.shape == (96, 128, 3) and (fast_array == array).all()
+        assert ((boxes[:, :2] - boxes[:, 2:] / 2 >= -1e-6) & (boxes[:, :2] + boxes[:, 2:] / 2 <= 1 + 1e-6)).all()
+
+
+def test_max_overlap_bounds_label_iou(tmp_path):
+    for clip_sprites in (False, True):
+        yd = yards(_write_config(tmp_path / str(clip_sprites), seed=3, num_images=40, transform_sprites=True, clip_sprites=clip_sprites, max_overlap=0.25))
+        yd.loop()
+        for split in ('train', 'val'):
+            for name in os.listdir(yd._output_dirs['labels_' + split]):
+                with open(yd._output_dirs['labels_' + split] + name) as file:
+                    boxes = np.array([line.split()[1:] for line in file if line.strip()], dtype=np.float64).reshape(-1, 4)
+                low, high = boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2
+                sides = np.clip(np.minimum(high[:, None], high[None]) - np.maximum(low[:, None], low[None]), 0, None)
+                intersections = sides[..., 0] * sides[..., 1]
+                areas = boxes[:, 2] * boxes[:, 3]
+                ious = intersections / (areas[:, None] + areas[None] - intersections)
+                np.fill_diagonal(ious, 0)
+                assert ious.max(initial=0) <= 0.25 + 1e-9
+
+
+def test_instance_buffer_measures_visible_boxes(tmp_path):
+    from yards.tools import _compositor
+    instances = np.zeros((10, 12), dtype=np.int32)
+    mask = np.ones((4, 4), dtype=bool)
+    assert _compositor.draw_instance(instances, mask, (0, 0, 4, 4), (2, 3), 1) == 16
+    assert _compositor.draw_instance(instances, mask, (0, 0, 4, 4), (4, 4), 2) == 16
+    boxes, visible = _compositor.get_instance_boxes(instances, 2)
+    assert boxes.tolist() == [[2, 3, 6, 7], [4, 4, 8, 8]] and visible.tolist() == [10, 16]
+
+    # both renderers measure the same boxes, and flagged boxes are the ones dropped otherwise
+    labels = {}
+    for renderer, occluded_boxes in (('pil', 'flag'), ('numpy', 'flag'), ('numpy', 'drop')):
+        yd = yards(_write_config(tmp_path / (renderer + occluded_boxes), seed=3, num_images=30, transform_sprites=True, clip_sprites=True,
+                                 renderer=renderer, min_visibility=0.5, occluded_boxes=occluded_boxes))
+        yd.loop()
+        labels[renderer, occluded_boxes] = {}
+        for split in ('train', 'val'):
+            for name in os.listdir(yd._output_dirs['labels_' + split]):
+                with open(yd._output_dirs['labels_' + split] + name) as file:
+                    labels[renderer, occluded_boxes][split, name] = file.read().splitlines()
+        if occluded_boxes == 'flag':
+            with open(yd._dirs['output'] + 'occluded.txt') as file:
+                flagged = [line.split() for line in file]
+    assert labels['pil', 'flag'] == labels['numpy', 'flag']
+    assert flagged and all(float(visibility) < 0.5 for _, _, visibility in flagged)
+    for key, lines in labels['numpy', 'flag'].items():
+        rows = {int(row) for label, row, _ in flagged if label == './labels/{}/{}'.format(*key)}
+        assert [line for row, line in enumerate(lines) if row not in rows] == labels['numpy', 'drop'][key]
+
+
+def test_filters_change_pixels_but_not_labels(tmp_path):
+    from yards.tools import _filters
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (13, 17, 3), dtype=np.uint8)
+    padded = np.pad(pixels.astype(np.int64), ((1, 1), (1, 1), (0, 0)), mode='edge')
+    assert np.array_equal(_filters.blur(pixels, 1), (sum(padded[i:i+13, j:j+17] for i in range(3) for j in range(3)) + 4) // 9)
+    assert np.array_equal(_filters.pixelate(pixels, 4)[:4, :4], np.broadcast_to(np.rint(pixels[:4, :4].mean(axis=(0, 1))), (4, 4, 3)))
+    assert np.array_equal(_filters.color_shift(pixels, hue=360), pixels)
+    assert not _filters.is_valid([{'type': 'blur', 'radius': 0}]) and not _filters.is_valid([{'type': 'sharpen'}])
+
+    filters = [{'type': 'color_shift', 'hue': [-30, 30]}, {'type': 'blur', 'radius': [1, 2], 'probability': 0.5},
+               {'type': 'noise', 'sigma': 4}, {'type': 'scanlines'}]
+    plain = yards(_write_config(tmp_path / 'plain', seed=7, transform_sprites=True, clip_sprites=True))
+    pil = yards(_write_config(tmp_path / 'pil', seed=7, transform_sprites=True, clip_sprites=True, filters=filters))
+    fast = yards(_write_config(tmp_path / 'numpy', seed=7, transform_sprites=True, clip_sprites=True, filters=filters, renderer='numpy'))
+    for (image, boxes, _), (filtered, filtered_boxes, _), (fast_filtered, _, _) in zip(plain.stream(10), pil.stream(10), fast.stream(10)):
+        assert not np.array_equal(filtered, image) and np.array_equal(filtered_boxes, boxes)
+        assert np.array_equal(fast_filtered, filtered)
+
+
+def test_work_queue_only_completes_held_leases(tmp_path):
+    import time
+    from yards.tools._coordinator import WorkQueue
+    queue = WorkQueue(str(tmp_path) + '/', lease_seconds=0.05)
+    queue.create([], [(1, True), (2, True)], chunk_size=2)
+    chunk_id, _, tasks = queue.acquire('slow')
+    time.sleep(0.1)
+    # the chunk of a worker whose lease expired is leased by another, and only that worker completes it
+    assert queue.acquire('fast')[0] == chunk_id
+    assert not queue.complete(chunk_id, 'slow')
+    assert queue.complete(chunk_id, 'fast') and queue.is_finished()
+    assert not queue.complete(chunk_id, 'fast')
+    queue.close()
+
+
+def _run_worker(config_path, name, crash=False):
+    """Joins the run of a config as a worker, which exits without giving up its lease on its first synthetic chunk if it crashes."""
+    yd = yards()
+    yd.load_config_from_file(config_path, join=True)
+    if crash:
+        yd._create_images = lambda tasks: os._exit(1)
+    yd.work(worker=name, lease_seconds=1.0, poll_seconds=0.1, chunk_size=4)
+
+
+def test_workers_match_single_node_run(tmp_path):
+    import multiprocessing
+    yd = yards(_write_config(tmp_path / 'single', seed=7, mix_size=0.5, transform_sprites=True, clip_sprites=True))
+    yd.loop()
+
+    # a worker crashes with a chunk leased, and two workers sharing the output directory take it over once its lease expires
+    config_path = _write_config(tmp_path / 'workers', seed=7, mix_size=0.5, transform_sprites=True, clip_sprites=True)
+    ctx = multiprocessing.get_context('fork')
+    crashed = ctx.Process(target=_run_worker, args=(config_path, 'crashed', True))
+    crashed.start()
+    crashed.join(60)
+    workers = [ctx.Process(target=_run_worker, args=(config_path, 'worker-{}'.format(i))) for i in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    assert [worker.exitcode for worker in [crashed] + workers] == [1, 0, 0]
+
+    # a worker joining the finished run stops at once and closes its connection to the queue
+    import pytest
+    import sqlite3
+    late = yards()
+    late.load_config_from_file(config_path, join=True)
+    queue = late._work_queue
+    late.work(worker='late')
+    assert late._work_queue is None
+    with pytest.raises(sqlite3.ProgrammingError):
+        queue.progress()
+
+    wyd = yards()
+    wyd.load_config_from_file(config_path, resume=True)
+    assert _read_outputs(wyd) == _read_outputs(yd)
+    for filename in ('train.txt', 'val.txt', 'dataset_stats.json'):
+        with open(yd._dirs['output'] + filename) as file, open(wyd._dirs['output'] + filename) as worker_file:
+            assert worker_file.read() == file.read()
+
+
+def test_real_stats_are_cached_and_match_labels(tmp_path, monkeypatch):
+    import shutil
+    from yards.tools import _real_stats
+    real_dir = str(tmp_path) + '/real/'
+    shutil.copytree(EXAMPLE_DIR + 'smb_handlabeled/labels', real_dir + 'labels')
+    stats = _real_stats.get_real_stats(real_dir)
+    label_paths = sorted(name for name in os.listdir(real_dir + 'labels') if name.endswith('.txt'))
+    counts = []
+    for name in label_paths:
+        with open(real_dir + 'labels/' + name) as file:
+            counts.append([int(float(line.split()[0])) for line in file])
+    values, frequencies = np.unique([c.count(3) for c in counts], return_counts=True)
+    assert stats.get_frequency_space(3) == [list(values), list(frequencies / len(counts))]
+    assert stats.classes[3]['positions'].sum() == sum(c.count(3) for c in counts)
+
+    # a second run loads the saved stats, and changing a label file invalidates them
+    monkeypatch.setattr(_real_stats.RealStats, 'scan', None)
+    assert _real_stats.get_real_stats(real_dir).get_frequency_space(3) == stats.get_frequency_space(3)
+    monkeypatch.undo()
+    with open(real_dir + 'labels/' + label_paths[0], 'a') as file:
+        file.write('3 0.5 0.5 0.1 0.1\n')
+    monkeypatch.setattr(_real_stats, '_MIN_PARALLEL_FILES', 0)
+    monkeypatch.setattr(_real_stats, 'CHUNK_SIZE', 3)
+    changed = _real_stats.get_real_stats(real_dir, num_processes=2)
+    assert changed.classes[3]['positions'].sum() == stats.classes[3]['positions'].sum() + 1
+
+
+def test_learned_placement_follows_real_labels(tmp_path):
+    from yards.tools import _priors
+    weights = np.array([0.0, 1.0, 3.0, 0.0, 4.0])
+    prob, alias = _priors.build_alias_table(weights)
+    draws = _priors.sample_alias(prob[None, :], alias[None, :], np.zeros(100000, dtype=np.int64), np.random.default_rng(0).random(100000))
+    assert np.allclose(np.bincount(draws, minlength=5) / 100000, weights / weights.sum(), atol=0.01)
+
+    classes = {'player': 0, 'enemy': 1, 'item': 2, 'helpful': 3, 'warp': 4}
+    config_path = _write_config(tmp_path, seed=7, classification_scheme='mimic-real', placement_scheme='learned')
+    with open(config_path) as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+    config['classes'] = classes
+    # the real stats are cached in the real directory, so it's copied to keep the example tree clean
+    import shutil
+    config['directories']['real'] = str(tmp_path) + '/real/'
+    shutil.copytree(EXAMPLE_DIR + 'smb_handlabeled', config['directories']['real'])
+    yd = yards()
+    yd.set_config(config)
+    plan = yd.plan(range(1, 201))
+    bins = yd._planner._priors.bins
+    for class_number, stats in yd._real_stats.classes.items():
+        if class_number not in classes.values() or stats['positions'].sum() == 0:
+            continue
+        placements = plan.placements[plan.placements['class_number'] == class_number]
+        centers = np.stack([(placements['x'] + placements['width'] / 2) / 256, (placements['y'] + placements['height'] / 2) / 192], axis=1)
+        cells = np.minimum((centers * bins).astype(int), bins - 1)
+        # sprites are only moved off the cells of real labels when they would leave the map
+        assert (stats['positions'][cells[:, 0], cells[:, 1]] > 0).mean() > 0.8
+    # without clipping, sprites moved onto the map stay clear of the edge handler
+    assert not yd._config['parameters']['clip_sprites'] and not plan.placements['clipped'].any()
+    assert (plan.placements['x'] + plan.placements['width'] < 256).all() and (plan.placements['y'] + plan.placements['height'] < 192).all()
+
+
+def test_visualize_draws_like_pil_and_tiles_sheets(tmp_path):
+    from PIL import Image, ImageDraw
+    from yards.tools import _visualizer
+    boxes = np.array([[0.25, 0.25, 0.3, 0.2], [0.7, 0.6, 0.4, 0.5], [0.05, 0.95, 0.3, 0.3]])
+    class_ids = np.array([0, 3, 1])
+    array = _visualizer.draw_boxes(np.zeros((48, 64, 3), dtype=np.uint8), boxes, class_ids)
+    expected = Image.new('RGB', (64, 48))
+    draw = ImageDraw.Draw(expected)
+    for (x, y, w, h), c in zip(boxes, class_ids):
+        draw.rectangle([int(64*x - 64*w/2), int(48*y - 48*h/2), int(64*x + 64*w/2), int(48*y + 48*h/2)], outline=_visualizer.get_class_color(c))
+    assert (array == np.asarray(expected)).all()
+
+    yd = yards(_write_config(tmp_path, seed=7))
+    yd.loop()
+    yd.visualize(num_visualize=10, num_processes=2)
+    examples_dir = yd._dirs['output'] + 'examples/'
+    assert len(os.listdir(examples_dir)) == 10
+    yd.visualize(num_visualize=10, sheet=(2, 2))
+    assert sorted(os.listdir(examples_dir)) == ['contact-sheet-000{}.png'.format(i) for i in range(3)]
+    with Image.open(examples_dir + 'contact-sheet-0000.png') as sheet:
+        assert sheet.size == (512, 384)
+
+    # in-memory samples are annotated like the files
+    annotated = yd.visualize_samples(yd.stream(4), num_visualize=4)
+    with Image.open(yd._output_dirs['images_train'] + 'super_mario_bros-1.png') as image, open(yd._output_dirs['labels_train'] + 'super_mario_bros-1.txt', 'rb') as file:
+        expected = _visualizer.draw_boxes(np.array(image.convert('RGB')), *_visualizer.parse_label(file.read()))
+    assert len(annotated) == 4 and (annotated[0] == expected).all()
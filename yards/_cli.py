@@ -5,9 +5,13 @@ _cli.py is the command-line program for that the user can use to generate pseudo
 """
 
 import argparse
+import importlib
+import json
 import os
-# from multiprocessing import cpu_count
+from multiprocessing import cpu_count
 from .yards import yards
+from .tools import _profiler
+from .tools import _pack
 
 # get arguments
 def _get_args():
@@ -23,10 +27,60 @@ def _get_args():
         default=None,
         help='Whether or not to visualize the output.'
     )
-    # parser.add_argument('--parallel', '-p',
-    #     action='store_true',
-    #     help='Whether or not to parallelize the processes.'
-    # )
+    parser.add_argument('--sheet', '-s',
+        nargs=2,
+        type=int,
+        default=None,
+        metavar=('COLUMNS', 'ROWS'),
+        help='Tiles the visualized images into contact sheets of COLUMNS x ROWS images.'
+    )
+    parser.add_argument('--parallel', '-p',
+        nargs='?',
+        type=int,
+        const=cpu_count(),
+        default=None,
+        help='The number of processes to generate images with. Uses every CPU if no number is given.'
+    )
+    parser.add_argument('--resume', '-r',
+        action='store_true',
+        help='Whether or not to resume the run in the output directory, skipping the images it already completed.'
+    )
+    parser.add_argument('--append', '-a',
+        type=int,
+        default=None,
+        help='The number of new images to add to the dataset in the output directory.'
+    )
+    parser.add_argument('--worker', '-w',
+        nargs='?',
+        const='',
+        default=None,
+        metavar='NAME',
+        help='Joins the run in the output directory as one of several workers, which may run on other machines that share the directory. Names the worker after its host and process if no name is given.'
+    )
+    parser.add_argument('--lease',
+        type=float,
+        default=60.0,
+        metavar='SECONDS',
+        help='How long the chunks of a worker that stopped heartbeating stay leased before other workers take them over.'
+    )
+    parser.add_argument('--pack',
+        nargs='+',
+        default=None,
+        metavar='DIRECTORY',
+        help='Packs the maps or sprites in each directory into a memory-mapped pack file, which runs with use_packs read instead of the images.'
+    )
+    parser.add_argument('--profile',
+        nargs='?',
+        type=str,
+        const='profile.json',
+        default=None,
+        help='The path to write a JSON report of the time spent in each stage and the run counters to. Writes profile.json if no path is given.'
+    )
+    parser.add_argument('--profile-exporter',
+        type=str,
+        default=None,
+        help='A module:function that is called with the profile report at the end of the run, e.g. to send it to a monitoring system.'
+    )
     
     return parser.parse_args()
 
@@ -46,26 +100,52 @@ def _valid_visualize(arguments):
         valid = False
     return not_none and valid
 
+def _load_exporter(name):
+    '''Returns the function named by a module:function string'''
+    module_name, _, function_name = name.partition(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
 def main():
     '''Entry point for cli interface'''
     args = _get_args()
     yd = yards()
+    if args.profile is not None or args.profile_exporter is not None:
+        yd.enable_profiling()
+
+    if args.pack is not None:
+        for directory in args.pack:
+            directory = os.path.join(directory, '')
+            pack, num_decoded = _pack.build_pack(directory)
+            print('Packed {} images in {} ({} new or changed).'.format(len(pack), directory, num_decoded))
 
-    if _valid_config(args.config):
-        yd.load_config_from_file(args.config)
-        yd.loop()
-        
-        # if args.parallel:
-        #     num_cpus = cpu_count()
-        #     yd.parallel_loop(num_cpus=num_cpus)
-        # else:
-        #     yd.loop()
+    if _valid_config(args.config) and args.worker is not None:
+        yd.load_config_from_file(args.config, join=True)
+        yd.work(worker=args.worker or None, lease_seconds=args.lease)
+    elif _valid_config(args.config):
+        yd.load_config_from_file(args.config, resume=args.resume or args.append is not None)
+        if args.append is not None:
+            yd.append(args.append)
+
+        if args.parallel:
+            yd.parallel_loop(num_cpus=args.parallel)
+        else:
+            yd.loop()
 
     if _valid_visualize(args.visualize):
         if len(args.visualize) == 1:
-            yd.visualize(num_visualize=int(args.visualize[0]))
+            yd.visualize(num_visualize=int(args.visualize[0]), num_processes=args.parallel, sheet=args.sheet)
         elif len(args.visualize) == 2:
-            yd.visualize(directory=args.visualize[0], num_visualize=int(args.visualize[1]))
+            yd.visualize(directory=args.visualize[0], num_visualize=int(args.visualize[1]), num_processes=args.parallel, sheet=args.sheet)
+
+    if args.profile is not None or args.profile_exporter is not None:
+        report = yd.get_profile()
+        print(_profiler.format_report(report))
+        if args.profile is not None:
+            with open(args.profile, 'w') as file:
+                json.dump(report, file, indent=4)
+            print('Wrote the profile to {}.'.format(args.profile))
+        if args.profile_exporter is not None:
+            _load_exporter(args.profile_exporter)(report)
 
 
 
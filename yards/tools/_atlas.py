@@ -0,0 +1,82 @@
+"""
+Precomputed transform variants of the sprites.
+
+Each sprite has at most 16 transform variants (mirror x 4 rotations x 2x scale). The atlas builds
+them once so that placing a transformed sprite is a lookup instead of a pixel transform.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+from PIL import Image
+from . import _helper
+
+NUM_VARIANTS = 16
+
+
+class TransformAtlas():
+    """Every legal transform variant of every sprite.
+
+    Variants are stored once per distinct image, so symmetric sprites share their pixels. Whether a
+    variant may be doubled in size depends on the map, so each map size gets its own table mapping the
+    16 drawn variant indices to the stored variants.
+    """
+
+    def __init__(self):
+        '''Initializing an empty atlas'''
+        self._variants = {}     # path -> list of NUM_VARIANTS images (None for scaled variants that are never legal)
+        self._tables = {}       # map_dim -> {path: tuple mapping variant index -> stored variant index}
+
+    def __len__(self):
+        return len(self._variants)
+
+    def _build_sprite(self, path, sprite, map_dims):
+        '''Builds the variants of a single sprite that are legal on at least one of the map sizes'''
+        variants = [None] * NUM_VARIANTS
+        unique_variants = {}
+        for mirror in (False, True):
+            for rotate in range(4):
+                unscaled = _helper.apply_transform(sprite, (mirror, rotate, False), None)
+                candidates = [(False, unscaled)]
+                if any(_helper.can_upscale(unscaled.size, map_dim) for map_dim in map_dims):
+                    candidates.append((True, unscaled.resize((unscaled.size[0]*2, unscaled.size[1]*2), Image.NEAREST)))
+                for resize, variant in candidates:
+                    # share pixels between identical variants of symmetric sprites
+                    key = (variant.size, variant.tobytes())
+                    if key not in unique_variants:
+                        unique_variants[key] = variant
+                    index = _helper.get_transform_index((mirror, rotate, resize))
+                    variants[index] = unique_variants[key]
+        self._variants[path] = variants
+
+    def build(self, image_cache, sprite_paths, map_dims):
+        '''Builds the variants for every sprite and a variant table for every map size'''
+        for path in sprite_paths:
+            self._build_sprite(path, image_cache.get(path), map_dims)
+        for map_dim in map_dims:
+            self._get_table(map_dim)
+
+    def _get_table(self, map_dim):
+        '''Returns the variant table for a map size, building it the first time the size is seen'''
+        table = self._tables.get(map_dim)
+        if table is None:
+            table = {}
+            for path, variants in self._variants.items():
+                slots = []
+                for index in range(NUM_VARIANTS):
+                    # a scaled variant falls back to its unscaled variant when the sprite is too big for the map
+                    if index % 2 == 1 and not _helper.can_upscale(variants[index-1].size, map_dim):
+                        index -= 1
+                    elif variants[index] is None:
+                        self._build_sprite(path, variants[0], list(self._tables) + [map_dim])
+                        variants = self._variants[path]
+                    slots.append(index)
+                table[path] = tuple(slots)
+            self._tables[map_dim] = table
+        return table
+
+    def resolve(self, path, index, map_dim):
+        '''Returns the stored variant index for a drawn variant index on a map size'''
+        return self._get_table(tuple(map_dim))[path][index]
+
+    def get(self, path, index, map_dim):
+        '''Returns the variant of a sprite for a drawn variant index on a map size. The image is shared, so it must not be modified.'''
+        return self._variants[path][self.resolve(path, index, map_dim)]
@@ -0,0 +1,115 @@
+"""
+In-memory cache of decoded sprite and background images.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+from collections import OrderedDict
+from PIL import Image
+
+
+class ImageCache():
+    """LRU cache of RGBA images keyed by path, capped at max_bytes of pixel data (-1 for no cap).
+
+    The cache is filled in the parent process before a pool is forked, so worker processes
+    share the decoded pixels copy-on-write instead of each decoding their own copy. Other
+    arrays derived from the images, such as the numpy renderer's, can be kept under their own
+    keys within the same budget.
+    """
+
+    def __init__(self, max_bytes=-1, packs=()):
+        '''Initializing an empty cache. Images in one of the packs are read from it instead of decoded.'''
+        self._images = OrderedDict()
+        self._sizes = {}    # key -> bytes
+        self._packs = [pack for pack in packs if pack is not None]
+        self._max_bytes = max_bytes
+        self._num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, path):
+        return path in self._images
+
+    def _load(self, path):
+        '''Decodes the image at path into RGBA'''
+        for pack in self._packs:
+            if path in pack:
+                return pack.get_image(path)
+        with Image.open(path) as image:
+            return image.convert('RGBA')
+
+    def _insert(self, key, value, size):
+        '''Adds an entry of size bytes to the cache, evicting the least recently used entries when over budget'''
+        if self._max_bytes != -1 and size > self._max_bytes:
+            return
+        if key in self._images:
+            self._num_bytes -= self._sizes[key]
+        self._images[key] = value
+        self._sizes[key] = size
+        self._num_bytes += size
+        while self._max_bytes != -1 and self._num_bytes > self._max_bytes:
+            evicted, _ = self._images.popitem(last=False)
+            self._num_bytes -= self._sizes.pop(evicted)
+            self.evictions += 1
+
+    def get(self, path):
+        '''Returns the RGBA image at path. The returned image is shared, so it must not be modified.'''
+        image = self._images.get(path)
+        if image is not None:
+            self._images.move_to_end(path)
+            self.hits += 1
+            return image
+        self.misses += 1
+        image = self._load(path)
+        self._insert(path, image, image.size[0] * image.size[1] * 4)
+        return image
+
+    def get_entry(self, key):
+        '''Returns the entry added under key, or None if it wasn't added or was evicted'''
+        value = self._images.get(key)
+        if value is not None:
+            self._images.move_to_end(key)
+        return value
+
+    def add_entry(self, key, value, size):
+        '''Adds an entry of size bytes under key, which counts against the same budget as the images, and returns it'''
+        self._insert(key, value, size)
+        return value
+
+    def get_size(self, path):
+        '''Returns the (width, height) of the image at path, read from the cache, a pack index or the file's header without decoding it'''
+        image = self._images.get(path)
+        if image is not None:
+            return image.size
+        for pack in self._packs:
+            entry = pack.get_entry(path)
+            if entry is not None:
+                return entry['width'], entry['height']
+        with Image.open(path) as image:
+            return image.size
+
+    def preload(self, paths):
+        '''Decodes images up front until the cache is full'''
+        for path in paths:
+            if path in self._images:
+                continue
+            image = self._load(path)
+            size = image.size[0] * image.size[1] * 4
+            if self._max_bytes != -1 and self._num_bytes + size > self._max_bytes:
+                break
+            self._insert(path, image, size)
+
+    def stats(self):
+        '''Returns the cache counters'''
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'images': len(self._images), 'bytes': self._num_bytes}
+
+
+def format_stats(stats):
+    """Returns a one-line summary of cache counters."""
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = 100.0 * stats['hits'] / lookups if lookups > 0 else 0.0
+    return 'Image cache: {} hits, {} misses ({:.1f}% hit rate), {} evictions.'.format(stats['hits'], stats['misses'], hit_rate, stats['evictions'])
@@ -0,0 +1,159 @@
+"""
+Work queue that lets several worker processes, on one or more machines, generate one run together.
+
+The queue is a SQLite database in the output directory, so workers only need a shared filesystem with
+working file locks. The first worker to join a run splits its pending images into chunks in the queue,
+and every worker then leases one chunk at a time, generates it, and marks it done along with its manifest
+and dataset index entries in the same transaction, which also keeps the workers' log appends apart.
+Workers heartbeat on a thread to renew their leases. A worker that stops gives up its leases, and the chunks
+of a worker that crashed are leased by another once its leases expire. Since every image is drawn from its
+own random stream, a chunk is the same whichever worker generates it, so the output is identical to a run
+on a single machine.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+QUEUE_FILENAME = 'work_queue.db'
+# the database and the journal SQLite keeps next to it during a transaction
+QUEUE_FILENAMES = (QUEUE_FILENAME, QUEUE_FILENAME + '-journal')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, tasks TEXT NOT NULL,
+                                   worker TEXT, lease_expiry REAL, done INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS workers (name TEXT PRIMARY KEY, heartbeat REAL NOT NULL, num_chunks INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+
+def _connect(path, timeout):
+    """Returns a connection to the queue database that runs statements outside of transactions unless one is begun."""
+    connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+class WorkQueue():
+    """Chunks of (src_image_path, count, is_train) real and (count, is_train) synthetic tasks leased to workers."""
+
+    def __init__(self, output_dir, lease_seconds=60.0, timeout=600.0):
+        '''Opening the queue of an output directory. A worker's leases expire lease_seconds after its last heartbeat,
+            and waiting for another worker's transaction gives up after timeout seconds.'''
+        self._output_dir = output_dir
+        self.lease_seconds = lease_seconds
+        self._timeout = timeout
+        self._connection = _connect(output_dir + QUEUE_FILENAME, timeout)
+
+    def close(self):
+        self._connection.close()
+
+    @contextmanager
+    def transaction(self):
+        '''Runs the block with the queue locked against every other worker, and commits it unless the block raises'''
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        self._connection.execute('COMMIT')
+
+    def _get_state(self, key):
+        row = self._connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_state(self, key, value):
+        self._connection.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    def reset(self):
+        '''Empties the queue, e.g. when the run it belonged to was cleared'''
+        self._connection.execute('DELETE FROM chunks')
+        self._connection.execute('DELETE FROM workers')
+        self._connection.execute('DELETE FROM state')
+
+    def is_created(self):
+        return self._get_state('created') is not None
+
+    def create(self, real_tasks, synt_tasks, chunk_size=64):
+        '''Splits the real and synthetic tasks into chunks of chunk_size tasks, which are leased in that order'''
+        chunks = [('real', real_tasks[i:i+chunk_size]) for i in range(0, len(real_tasks), chunk_size)]
+        chunks += [('synt', synt_tasks[i:i+chunk_size]) for i in range(0, len(synt_tasks), chunk_size)]
+        self._connection.executemany('INSERT INTO chunks (kind, tasks) VALUES (?, ?)', ((kind, json.dumps(tasks)) for kind, tasks in chunks))
+        self._set_state('created', str(time.time()))
+
+    def acquire(self, worker):
+        '''Leases the first chunk that isn't done and isn't leased, or whose lease expired.
+            Returns its (id, kind, tasks), or None if there is none.'''
+        now = time.time()
+        row = self._connection.execute('SELECT id, kind, tasks FROM chunks WHERE done = 0 AND (worker IS NULL OR lease_expiry < ?) ORDER BY id LIMIT 1', (now,)).fetchone()
+        if row is None:
+            return None
+        self._connection.execute('UPDATE chunks SET worker = ?, lease_expiry = ? WHERE id = ?', (worker, now + self.lease_seconds, row[0]))
+        return row[0], row[1], [tuple(task) for task in json.loads(row[2])]
+
+    def complete(self, chunk_id, worker):
+        '''Marks a chunk as done if the worker still holds its lease. Returns false if the lease expired, in which case the chunk
+            is left to the worker that leases it next, and the worker that lost it should drop its results.'''
+        now = time.time()
+        cursor = self._connection.execute('UPDATE chunks SET done = 1, lease_expiry = NULL WHERE id = ? AND done = 0 AND worker = ? AND lease_expiry > ?',
+                                          (chunk_id, worker, now))
+        if cursor.rowcount == 0:
+            return False
+        self._connection.execute('INSERT INTO workers (name, heartbeat, num_chunks) VALUES (?, ?, 1) '
+                                 'ON CONFLICT (name) DO UPDATE SET heartbeat = excluded.heartbeat, num_chunks = num_chunks + 1', (worker, now))
+        return True
+
+    def release(self, worker):
+        '''Gives up the leases of a worker on the chunks it didn't finish, so other workers can take them at once'''
+        self._connection.execute('UPDATE chunks SET worker = NULL, lease_expiry = NULL WHERE worker = ? AND done = 0', (worker,))
+
+    def heartbeat(self, worker):
+        '''Renews the leases of a worker'''
+        now = time.time()
+        self._connection.execute('UPDATE chunks SET lease_expiry = ? WHERE worker = ? AND done = 0', (now + self.lease_seconds, worker))
+        self._connection.execute('INSERT INTO workers (name, heartbeat) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET heartbeat = excluded.heartbeat', (worker, now))
+
+    def progress(self):
+        '''Returns the number of chunks that are done and the number of chunks'''
+        return self._connection.execute('SELECT COALESCE(SUM(done), 0), COUNT(*) FROM chunks').fetchone()
+
+    def is_finished(self):
+        '''Returns true if every chunk is done'''
+        done, total = self.progress()
+        return self.is_created() and done == total
+
+    def is_finalized(self):
+        return self._get_state('finalized') is not None
+
+    def set_finalized(self):
+        '''Records that the run's dataset index was written after its last chunk'''
+        self._set_state('finalized', str(time.time()))
+
+    @contextmanager
+    def heartbeats(self, worker):
+        '''Renews the leases of a worker every quarter of the lease while the block runs, on a thread with its own connection'''
+        stop = threading.Event()
+
+        def beat():
+            queue = WorkQueue(self._output_dir, self.lease_seconds, self._timeout)
+            try:
+                while not stop.wait(self.lease_seconds / 4):
+                    try:
+                        queue.heartbeat(worker)
+                    except sqlite3.OperationalError:
+                        # the database was locked for longer than the timeout, so the next beat tries again
+                        pass
+            finally:
+                queue.close()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
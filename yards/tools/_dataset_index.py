@@ -0,0 +1,116 @@
+"""
+Dataset-level index of a generated dataset.
+
+As samples are written, the class numbers of their boxes are gathered from the in-memory labels and
+appended to index.log, so that a resumed run keeps the samples of the runs before it. At the end of a run,
+the index is written out as YOLO-style train.txt and val.txt image lists, a data.yaml with the class names,
+and dataset_stats.json with the number of boxes of each class and of images with each number of boxes per
+split. Training pipelines can then use the dataset without scanning the output directory. Boxes that are
+flagged as occluded are listed in occluded.txt with their label rows and visible fractions.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import os
+import json
+import yaml
+
+LOG_FILENAME = 'index.log'
+STATS_FILENAME = 'dataset_stats.json'
+DATA_FILENAME = 'data.yaml'
+OCCLUDED_FILENAME = 'occluded.txt'
+
+
+class DatasetIndex():
+    """Image names and box classes of every sample in an output directory."""
+
+    def __init__(self, output_dir, persist=True):
+        '''Initializing the index of an output directory. Without persist, the index is only kept in memory.'''
+        self._output_dir = output_dir
+        self._log_path = output_dir + LOG_FILENAME if persist else None
+        self.entries = {}   # count -> (is_train, image name, class numbers, [(row, visible fraction) of occluded boxes])
+
+    def create(self):
+        '''Starts an empty index'''
+        self.entries = {}
+        if self._log_path is not None:
+            open(self._log_path, 'w').close()
+
+    def load(self):
+        '''Reads the index log of an earlier run'''
+        self.entries = {}
+        if self._log_path is None or not os.path.isfile(self._log_path):
+            return
+        with open(self._log_path) as file:
+            for line in file:
+                fields = line.split()
+                # a line cut off by an interrupted run is ignored
+                if not line.endswith('\n') or len(fields) != 5:
+                    continue
+                occluded = [(int(row), float(visibility)) for row, visibility in (box.split(':') for box in fields[4].split(',') if box != '-')]
+                self.entries[int(fields[0])] = (fields[1] == 'train', fields[2], [int(c) for c in fields[3].split(',') if c != '-'], occluded)
+
+    def record(self, entries):
+        '''Adds (count, is_train, image name, class numbers[, occluded boxes]) entries of written samples, where the occluded boxes are
+            (row, visible fraction) pairs. A count that is written again replaces its entry.'''
+        if not entries:
+            return
+        entries = [(count, is_train, name, list(class_ids), list(occluded[0]) if occluded else []) for count, is_train, name, class_ids, *occluded in entries]
+        if self._log_path is not None:
+            with open(self._log_path, 'a') as file:
+                for count, is_train, name, class_ids, occluded in entries:
+                    file.write('{} {} {} {} {}\n'.format(count, 'train' if is_train else 'val', name, ','.join(str(c) for c in class_ids) or '-',
+                                                        ','.join('{}:{:.4f}'.format(row, visibility) for row, visibility in occluded) or '-'))
+        for count, *entry in entries:
+            self.entries[count] = tuple(entry)
+
+    def get_stats(self):
+        '''Returns the number of images and boxes, boxes of each class, and images with each number of boxes of each split'''
+        stats = {split: {'images': 0, 'boxes': 0, 'occluded_boxes': 0, 'classes': {}, 'boxes_per_image': {}} for split in ('train', 'val')}
+        for is_train, _, class_ids, occluded in self.entries.values():
+            split = stats['train' if is_train else 'val']
+            split['images'] += 1
+            split['boxes'] += len(class_ids)
+            split['occluded_boxes'] += len(occluded)
+            split['boxes_per_image'][len(class_ids)] = split['boxes_per_image'].get(len(class_ids), 0) + 1
+            for class_id in class_ids:
+                split['classes'][class_id] = split['classes'].get(class_id, 0) + 1
+        for split in stats.values():
+            split['classes'] = dict(sorted(split['classes'].items()))
+            split['boxes_per_image'] = dict(sorted(split['boxes_per_image'].items()))
+        return stats
+
+    def _get_relative_dir(self, directory):
+        '''Returns the path of a directory relative to the output directory, as ./dir/'''
+        return './' + os.path.relpath(directory, self._output_dir).replace(os.sep, '/') + '/'
+
+    def write(self, class_names, image_dirs=None, label_dirs=None):
+        '''Writes the dataset stats and data.yaml with the {number: name} classes, and the image lists and occluded boxes of the
+            {split: image dir} and {split: label dir} dirs if given'''
+        stats = self.get_stats()
+        with open(self._output_dir + STATS_FILENAME, 'w') as file:
+            json.dump(stats, file, indent=4)
+        if image_dirs is None:
+            return
+
+        # the label and row of each flagged box, relative to the output directory like the image lists
+        lines = []
+        for count in sorted(self.entries):
+            is_train, name, _, occluded = self.entries[count]
+            label = self._get_relative_dir(label_dirs['train' if is_train else 'val']) + os.path.splitext(name)[0] + '.txt'
+            lines.extend('{} {} {:.4f}\n'.format(label, row, visibility) for row, visibility in occluded)
+        if lines or os.path.isfile(self._output_dir + OCCLUDED_FILENAME):
+            with open(self._output_dir + OCCLUDED_FILENAME, 'w') as file:
+                file.writelines(lines)
+
+        data = {'path': os.path.abspath(self._output_dir)}
+        for split in ('train', 'val'):
+            # image paths relative to the output directory, in index order
+            prefix = self._get_relative_dir(image_dirs[split])
+            lines = [prefix + self.entries[count][1] + '\n' for count in sorted(self.entries) if self.entries[count][0] == (split == 'train')]
+            with open(self._output_dir + split + '.txt', 'w') as file:
+                file.writelines(lines)
+            data[split] = split + '.txt'
+        data['nc'] = max(class_names, default=-1) + 1
+        data['names'] = dict(sorted(class_names.items()))
+        with open(self._output_dir + DATA_FILENAME, 'w') as file:
+            yaml.dump(data, file, sort_keys=False)
@@ -0,0 +1,101 @@
+"""
+Image encoders for the generated images.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import io
+import os
+import hashlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from . import _profiler
+
+# format name -> (PIL format, file extension)
+FORMATS = {
+    'png': ('PNG', '.png'),
+    'bmp': ('BMP', '.bmp'),
+    'ppm': ('PPM', '.ppm'),
+    'tga': ('TGA', '.tga'),
+    'webp': ('WEBP', '.webp')
+}
+
+# extensions of every image the package reads or writes
+IMAGE_EXTENSIONS = [extension for _, extension in FORMATS.values()]
+
+
+class Encoder():
+    """Saves images in the configured format, optionally on a pool of threads.
+
+    PIL releases the GIL while compressing, so encoding on threads overlaps with compositing the next image.
+    """
+
+    def __init__(self, output_format=None):
+        '''Initializing an encoder from the output_format section of a config'''
+        output_format = output_format if output_format is not None else {}
+        self.format = output_format.get('format', 'png')
+        self._pil_format, self.extension = FORMATS[self.format]
+        self._save_params = {}
+        if self.format == 'png':
+            if output_format.get('compress_level') is not None:
+                self._save_params['compress_level'] = output_format['compress_level']
+            self._save_params['optimize'] = output_format.get('optimize', False)
+        elif self.format == 'webp':
+            self._save_params['lossless'] = True
+        self._num_threads = output_format.get('encoder_threads', 0)
+        self._executor = None
+        self._executor_pid = None
+        self._pending = deque()
+
+    def __getstate__(self):
+        '''Drops the thread pool when pickled for a worker process'''
+        state = self.__dict__.copy()
+        state['_executor'], state['_executor_pid'], state['_pending'] = None, None, deque()
+        return state
+
+    def encode(self, image, path):
+        '''Saves an image to path, which should end with the encoder's extension.
+            Returns the size and the sha1 hash of the saved bytes, which are hashed before they're written rather than read back.'''
+        data = self.encode_bytes(image)
+        with open(path, 'wb') as file:
+            file.write(data)
+        _profiler.count('bytes_written', len(data))
+        return len(data), hashlib.sha1(data)
+
+    def encode_bytes(self, image):
+        '''Returns the encoded bytes of an image'''
+        if self.format == 'ppm' and image.mode == 'RGBA':
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, self._pil_format, **self._save_params)
+        return buffer.getvalue()
+
+    def submit(self, image, path):
+        '''Saves an image on the thread pool, or right away if the encoder has no threads. Returns a future of what encode returns.'''
+        if self._num_threads <= 0:
+            future = Future()
+            future.set_result(self.encode(image, path))
+            return future
+        # a forked worker inherits the parent's pool without its threads, so it starts its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self._num_threads)
+            self._executor_pid = os.getpid()
+            self._pending = deque()
+        future = self._executor.submit(self.encode, image, path)
+        self._pending.append(future)
+        # bound the number of images held in memory while waiting to be encoded
+        while len(self._pending) > 2 * self._num_threads:
+            self._pending.popleft().result()
+        return future
+
+    def flush(self):
+        '''Waits for every submitted image to be saved, raising any error from the threads'''
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self):
+        '''Waits for the submitted images and shuts down the thread pool, which the next submit starts again.
+            Call flush first to raise any error from the threads.'''
+        # a forked worker's inherited pool has no threads in the worker, so only the process that started it shuts it down
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=True)
+        self._executor, self._executor_pid, self._pending = None, None, deque()
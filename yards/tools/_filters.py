@@ -0,0 +1,165 @@
+"""
+Post-processing filters applied to rendered images before they are encoded.
+
+A filter chain is a list of filters from the filters parameter, each applied with a probability and with
+parameters that are either fixed or drawn from a [low, high] range for every image. The draws come from a
+stream of the image's index that is separate from its placements, so adding filters doesn't move sprites and
+a seeded run filters every image the same way on any process. Every filter is a few whole-array NumPy
+operations on the (height, width, channels) pixels of an image, which are filtered in memory instead of in a
+second pass that decodes and re-encodes the saved files. Only the RGB channels are filtered.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import numpy as np
+
+# the parameters of each filter with their defaults, in the order they are drawn
+FILTER_PARAMETERS = {
+    'blur': {'radius': 1},
+    'pixelate': {'size': 2},
+    'palette': {'levels': 4},
+    'color_shift': {'brightness': 0.0, 'contrast': 1.0, 'saturation': 1.0, 'hue': 0.0},
+    'noise': {'sigma': 8.0},
+    'scanlines': {'intensity': 0.3, 'period': 2},
+}
+_INTEGER_PARAMETERS = {'radius', 'size', 'levels', 'period'}
+_MIN_VALUES = {'radius': 1, 'size': 1, 'levels': 2, 'period': 2}
+
+
+def blur(pixels, radius):
+    """Returns the pixels blurred with a box filter of the given radius, as a running sum along each axis."""
+    size = 2*radius + 1
+    # a leading zero row and column, and the edge pixels repeated, so every window is a difference of two sums
+    sums = np.zeros((pixels.shape[0] + 2*radius + 1, pixels.shape[1] + 2*radius + 1, pixels.shape[2]), dtype=np.int32)
+    sums[1:, 1:] = np.pad(pixels, ((radius, radius), (radius, radius), (0, 0)), mode='edge')
+    sums = sums.cumsum(axis=0, out=sums).cumsum(axis=1, out=sums)
+    window = sums[size:, size:] - sums[:-size, size:] - sums[size:, :-size] + sums[:-size, :-size]
+    return ((window + size*size // 2) // (size*size)).astype(np.uint8)
+
+
+def pixelate(pixels, size):
+    """Returns the pixels with every size x size block set to its mean color."""
+    height, width = pixels.shape[:2]
+    rows, columns = -(-height // size), -(-width // size)
+    padded = np.pad(pixels, ((0, rows*size - height), (0, columns*size - width), (0, 0)), mode='edge')
+    # one strided slice per offset in the block, which is faster than reducing over a reshaped array
+    sums = sum(padded[i::size, j::size].astype(np.int32) for i in range(size) for j in range(size))
+    blocks = ((sums + size*size // 2) // (size*size)).astype(np.uint8)
+    return np.repeat(np.repeat(blocks, size, axis=0), size, axis=1)[:height, :width]
+
+
+def palette(pixels, levels=4, colors=None):
+    """Returns the pixels reduced to the given levels of each channel, or to the nearest of a list of RGB colors."""
+    if colors is None:
+        step = 255 / (levels - 1)
+        return (np.rint(np.rint(pixels / step) * step)).astype(np.uint8)
+    colors = np.asarray(colors, dtype=np.int32)
+    flat = pixels.reshape(-1, 3).astype(np.int32)
+    # squared distances to every color, expanded so that no (pixels, colors, 3) array is built
+    distances = (colors*colors).sum(axis=1)[None] - 2 * flat @ colors.T
+    return colors[distances.argmin(axis=1)].astype(np.uint8).reshape(pixels.shape)
+
+
+def color_shift(pixels, brightness=0.0, contrast=1.0, saturation=1.0, hue=0.0):
+    """Returns the pixels with the hue rotated by the given degrees, the saturation and contrast scaled, and brightness * 255 added."""
+    angle = np.radians(hue)
+    # a rotation about the gray axis followed by a scaling away from it, as one matrix
+    gray = np.full((3, 3), 1/3)
+    cross = np.array([[0, -1, 1], [1, 0, -1], [-1, 1, 0]]) / np.sqrt(3)
+    rotation = np.cos(angle) * np.eye(3) + (1 - np.cos(angle)) * gray + np.sin(angle) * cross
+    matrix = saturation * rotation + (1 - saturation) * gray
+    shifted = pixels.astype(np.float32) @ matrix.T.astype(np.float32)
+    shifted = (shifted - 127.5) * contrast + 127.5 + brightness * 255
+    return np.clip(np.rint(shifted), 0, 255).astype(np.uint8)
+
+
+def noise(pixels, sigma, rng):
+    """Returns the pixels with Gaussian noise of standard deviation sigma added, drawn from rng."""
+    noisy = pixels + sigma * rng.standard_normal(pixels.shape, dtype=np.float32)
+    return np.clip(np.rint(noisy), 0, 255).astype(np.uint8)
+
+
+def scanlines(pixels, intensity, period=2):
+    """Returns the pixels with the last row of every period rows darkened by intensity, like the scanlines of a CRT."""
+    darkened = pixels.copy()
+    darkened[period-1::period] = np.rint(darkened[period-1::period] * (1 - intensity)).astype(np.uint8)
+    return darkened
+
+
+def is_valid(specs):
+    """Returns true if specs is a list of filters, each a dict with a known type, known parameters and a probability in [0, 1]."""
+    if not isinstance(specs, list):
+        return False
+    for spec in specs:
+        if not isinstance(spec, dict) or spec.get('type') not in FILTER_PARAMETERS:
+            return False
+        for key, value in spec.items():
+            if key == 'type':
+                continue
+            if key == 'probability':
+                if not isinstance(value, (int, float)) or not 0 <= value <= 1:
+                    return False
+            elif key == 'colors' and spec['type'] == 'palette':
+                if not isinstance(value, list) or not value or not all(isinstance(color, list) and len(color) == 3 for color in value):
+                    return False
+            elif key not in FILTER_PARAMETERS[spec['type']]:
+                return False
+            else:
+                values = value if isinstance(value, list) else [value]
+                if len(values) not in (1, 2) or not all(isinstance(v, (int, float)) for v in values) or values[0] > values[-1]:
+                    return False
+                if key in _MIN_VALUES and values[0] < _MIN_VALUES[key]:
+                    return False
+    return True
+
+
+class FilterChain():
+    """The filters of the filters parameter, applied in order."""
+
+    def __init__(self, specs):
+        '''Initializing a chain from a list of filter dicts'''
+        self._specs = [dict(spec) for spec in specs]
+
+    def __len__(self):
+        return len(self._specs)
+
+    def draw(self, rng):
+        '''Returns the (type, parameters) of the filters drawn for an image, which are applied in order'''
+        filters = []
+        for spec in self._specs:
+            # every filter draws the same numbers whether or not it's applied, so the filters after it keep their draws
+            applied = rng.random() < spec.get('probability', 1.0)
+            parameters = {}
+            for key, default in FILTER_PARAMETERS[spec['type']].items():
+                value = spec.get(key, default)
+                if isinstance(value, list):
+                    low, high = value[0], value[-1]
+                    value = int(rng.integers(low, high + 1)) if key in _INTEGER_PARAMETERS else float(rng.uniform(low, high))
+                parameters[key] = int(value) if key in _INTEGER_PARAMETERS else value
+            if 'colors' in spec:
+                parameters['colors'] = spec['colors']
+            if applied:
+                filters.append((spec['type'], parameters))
+        return filters
+
+    def apply(self, pixels, rng):
+        '''Returns the (height, width, channels) uint8 pixels of an image with the filters drawn from rng applied'''
+        filters = self.draw(rng)
+        if not filters:
+            return pixels
+        rgb = np.ascontiguousarray(pixels[..., :3])
+        for filter_type, parameters in filters:
+            if filter_type == 'blur':
+                rgb = blur(rgb, parameters['radius'])
+            elif filter_type == 'pixelate':
+                rgb = pixelate(rgb, parameters['size'])
+            elif filter_type == 'palette':
+                rgb = palette(rgb, parameters['levels'], parameters.get('colors'))
+            elif filter_type == 'color_shift':
+                rgb = color_shift(rgb, parameters['brightness'], parameters['contrast'], parameters['saturation'], parameters['hue'])
+            elif filter_type == 'noise':
+                rgb = noise(rgb, parameters['sigma'], rng)
+            else:
+                rgb = scanlines(rgb, parameters['intensity'], parameters['period'])
+        if pixels.shape[-1] == 3:
+            return rgb
+        return np.concatenate([rgb, pixels[..., 3:]], axis=-1)
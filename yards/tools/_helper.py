@@ -4,94 +4,52 @@ Helper Functions for Main Script
 @authors: Jaden Kim & Chanha Kim
 """
 import numpy as np
-from numpy.random import choice, randint
 from PIL import Image, ImageOps
 import os, glob, shutil
 
 
-def _get_sprite_counts(classes, classification_scheme='distribution', sprite_cap=-1):
-    """Returns a <class, count> dictionary of sprite counts
-        for each class to be pasted in the new image."""
-    sprite_counts = {}
-    # first handle the raw counts
-    if classification_scheme == 'random':
-        for c in classes:
-            sprite_counts[c] = choice([i for i in range(classes[c]+1)])
-            if sprite_counts[c] > sprite_cap and sprite_cap != -1:
-                sprite_counts[c] = sprite_cap
-    elif classification_scheme == 'distribution':
-        for c in classes:
-            sprite_counts[c] = choice([i for i in range(len(classes[c]))], p=classes[c])
-            if sprite_counts[c] > sprite_cap and sprite_cap != -1:
-                sprite_counts[c] = sprite_cap
-    elif classification_scheme == 'discrete':
-        class_list = list(classes.keys())
-        num_players = classes[class_list[0]]
-        for i in range(num_players):
-            c = choice(class_list)
-            if c in list(sprite_counts.keys()):
-                sprite_counts[c] += 1
-            else:
-                sprite_counts[c] = 1
-    elif classification_scheme == 'mimic-real':
-        for c in classes:
-            sprite_counts[c] = choice(classes[c][0], p=classes[c][1])
-            if sprite_counts[c] > sprite_cap and sprite_cap != -1:
-                sprite_counts[c] = sprite_cap
-    else:
-        print('Invalid classification scheme.')
-
-    return sprite_counts
-
-
-def _get_sprite_path(class_path_cache):
-    """Returns the file path of a random sprite from the sprite directory."""
-    return choice(class_path_cache)
-
-
-def gather_sprite_paths(sprite_path_cache, class_info, classification_scheme, sprite_cap):
-    """Returns a <path, class number> dictionary of the file paths of all the sprites to be pasted on an image."""
-    classes, class_numbers = class_info
-    sprite_paths = {}
-    sprite_counts = _get_sprite_counts(classes, classification_scheme, sprite_cap)
-    for c in sprite_counts:
-        for i in range(sprite_counts[c]):
-            sprite_paths[_get_sprite_path(sprite_path_cache[c])] = class_numbers[c]
-
-    return sprite_paths
-
-
-def transform_sprite(sprite, map_dim):
-    transformed_sprite = sprite
-    operations = {"mirror":bool(choice(2)), "rotate":choice([0, Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270]), "resize":bool(choice(2))}
+ROTATIONS = [None, Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270]
 
-    if operations["mirror"]:
-        transformed_sprite = transformed_sprite.transpose(Image.FLIP_LEFT_RIGHT)
 
-    if operations["rotate"] != 0:
-        transformed_sprite = transformed_sprite.transpose(operations["rotate"])
+def get_transform_operations(index):
+    """Returns the (mirror, rotation index, resize) transform operations of a transform index."""
+    return bool(index // 8), (index // 2) % 4, bool(index % 2)
 
-    if operations["resize"] and (transformed_sprite.size[0] < int(map_dim[0]/2) and transformed_sprite.size[1] < int(map_dim[1]/2)):
-        transformed_sprite = transformed_sprite.resize((transformed_sprite.size[0]*2, transformed_sprite.size[1]*2), Image.NEAREST)
 
-    return transformed_sprite
+def get_transform_index(operations):
+    """Returns the index in [0, 16) of a combination of transform operations."""
+    mirror, rotate, resize = operations
+    return int(mirror) * 8 + rotate * 2 + int(resize)
 
 
-def get_sprite_pos(map_dim, sprite_dim, clip_sprites):
-    """Returns a sprite position for a given map and sprite."""
-    map_w, map_h = map_dim
-    sprite_w, sprite_h = sprite_dim
+def can_upscale(sprite_dim, map_dim):
+    """Returns true if a sprite is small enough to be doubled in size on a map."""
+    return sprite_dim[0] < int(map_dim[0]/2) and sprite_dim[1] < int(map_dim[1]/2)
 
-    if clip_sprites:
-        x_pos = randint(-sprite_w, map_w)
-        y_pos = randint(-sprite_h, map_h)
-    else:
-        x_pos = randint(0, map_w - sprite_w)
-        y_pos = randint(0, map_h - sprite_h)
 
-    sprite_clipped = True if ((x_pos < 0 or x_pos >= map_w - sprite_w) or (y_pos < 0 or y_pos >= map_h - sprite_h)) else False
+def resolve_transform_index(sprite_dim, operations, map_dim):
+    """Returns the transform index of the operations that apply_transform actually performs on a map,
+        which drops the resize if the sprite is too big to double."""
+    mirror, rotate, resize = operations
+    rotated_dim = sprite_dim if rotate % 2 == 0 else (sprite_dim[1], sprite_dim[0])
+    return get_transform_index((mirror, rotate, resize and can_upscale(rotated_dim, map_dim)))
 
-    return (x_pos, y_pos), sprite_clipped
+
+def apply_transform(sprite, operations, map_dim):
+    """Returns the sprite mirrored, rotated and/or doubled in size by the given operations."""
+    mirror, rotate, resize = operations
+    transformed_sprite = sprite
+
+    if mirror:
+        transformed_sprite = transformed_sprite.transpose(Image.FLIP_LEFT_RIGHT)
+
+    if rotate != 0:
+        transformed_sprite = transformed_sprite.transpose(ROTATIONS[rotate])
+
+    if resize and can_upscale(transformed_sprite.size, map_dim):
+        transformed_sprite = transformed_sprite.resize((transformed_sprite.size[0]*2, transformed_sprite.size[1]*2), Image.NEAREST)
+
+    return transformed_sprite
 
 
 def _get_transparencies(sprite):
@@ -119,51 +77,52 @@ def _get_transparencies(sprite):
     return (ul, ur, bl, br)
 
 
-def edge_handler(map_dim, sprite_dim, sprite_pos, sprite):
-    """Handles edge cases"""
+def get_edge_crop(map_dim, sprite_dim, sprite_pos, transparencies):
+    """Returns the (left, top, right, bottom) box that a sprite on the edge of the map is cropped to and its new position."""
     # load parameters
     (map_w, map_h), (sprite_w, sprite_h), (x_pos, y_pos) = map_dim, sprite_dim, sprite_pos
-    ul, ur, bl, br = _get_transparencies(sprite)
+    ul, ur, bl, br = transparencies
+    left, top, right, bottom = 0, 0, sprite_w, sprite_h
 
     # left edge
     if x_pos < 0:
         if np.max([sprite_w - ur['x'], sprite_w - br['x']]) >= (x_pos + sprite_w):
-            crop_x = int(np.average([ur['x'], br['x'], ul['x'], bl['x']]))
+            left = int(np.average([ur['x'], br['x'], ul['x'], bl['x']]))
         else:
-            crop_x = abs(x_pos)
-        sprite = sprite.crop((crop_x, 0, sprite_w, sprite_h))
-        sprite_w = sprite.size[0]
+            left = abs(x_pos)
         x_pos = 0
     # right edge
     elif x_pos >= map_w - sprite_w:
         if np.max([ul['x'], bl['x']]) >= (map_w - x_pos):
-            crop_x = int(np.average([ul['x'], bl['x'], ur['x'], br['x']]))
+            right = int(np.average([ul['x'], bl['x'], ur['x'], br['x']]))
         else:
-            crop_x = map_w - x_pos
-        sprite = sprite.crop((0, 0, crop_x, sprite_h))
-        sprite_w = sprite.size[0]
-        x_pos = map_w - sprite_w
+            right = map_w - x_pos
+        x_pos = map_w - right
 
     # top edge
     if y_pos < 0:
         if np.max([sprite_h - bl['y'], sprite_h - br['y']]) >= (y_pos + sprite_h):
-            crop_y = int(np.average([bl['y'], br['y'], ul['y'], ur['y']]))
+            top = int(np.average([bl['y'], br['y'], ul['y'], ur['y']]))
         else:
-            crop_y = abs(y_pos)
-        sprite = sprite.crop((0, crop_y, sprite_w, sprite_h))
-        sprite_h = sprite.size[1]
+            top = abs(y_pos)
         y_pos = 0
     # bottom edge
     elif y_pos >= map_h - sprite_h:
         if np.max([ul['y'], ur['y']]) >= (map_h - y_pos):
-            crop_y = int(np.average([ul['y'], ur['y'], bl['y'], br['y']]))
+            bottom = int(np.average([ul['y'], ur['y'], bl['y'], br['y']]))
         else:
-            crop_y = map_h - y_pos
-        sprite = sprite.crop((0, 0, sprite_w, crop_y))
-        sprite_h = sprite.size[1]
-        y_pos = map_h - sprite_h
+            bottom = map_h - y_pos
+        y_pos = map_h - bottom
+
+    return (left, top, right, bottom), (x_pos, y_pos)
+
 
-    return sprite, (sprite_w, sprite_h), (x_pos, y_pos)
+def edge_handler(map_dim, sprite_dim, sprite_pos, sprite, transparencies=None):
+    """Handles edge cases. Takes the sprite's transparency quadrants if they were already computed."""
+    box, sprite_pos = get_edge_crop(map_dim, sprite_dim, sprite_pos, transparencies if transparencies is not None else _get_transparencies(sprite))
+    if box != (0, 0) + tuple(sprite_dim):
+        sprite = sprite.crop(box)
+    return sprite, sprite.size, sprite_pos
 
 
 def get_bbox(map_dim, sprite_dim, sprite_pos):
@@ -0,0 +1,103 @@
+"""
+Run manifest that makes generation resumable and incremental.
+
+The manifest records the config hash, the seed and the index segments of a run in manifest.json, and
+appends every completed index with its checksum to manifest.log as the run goes. A resumed run skips
+the completed indices, and appending images adds a new segment of indices after the existing ones.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import os
+import json
+import hashlib
+
+MANIFEST_FILENAME = 'manifest.json'
+LOG_FILENAME = 'manifest.log'
+
+# parameters that may change between a run and its resumption, either because they pick the indices or because they
+# only change how the same images are made
+_RESUMABLE_PARAMETERS = {'num_images', 'num_train', 'seed', 'group_by_background', 'real_copy_mode', 'real_copy_threads',
+                         'renderer', 'cache_size_mb', 'precompute_transforms', 'use_packs', 'persist_sprite_metadata'}
+
+
+def hash_config(config):
+    """Returns a hash of everything in a config that determines the generated images."""
+    config = dict(config)
+    config['parameters'] = {key: value for key, value in config['parameters'].items() if key not in _RESUMABLE_PARAMETERS}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def checksum_files(paths):
+    """Returns the total size and sha1 checksum of the files' contents."""
+    checksum = hashlib.sha1()
+    size = 0
+    for path in paths:
+        with open(path, 'rb') as file:
+            data = file.read()
+        checksum.update(data)
+        size += len(data)
+    return size, checksum.hexdigest()
+
+
+class Manifest():
+    """Header and completion log of a run in an output directory."""
+
+    def __init__(self, output_dir):
+        '''Initializing the manifest of an output directory'''
+        self._path = output_dir + MANIFEST_FILENAME
+        self._log_path = output_dir + LOG_FILENAME
+        self.config_hash = None
+        self.seed = None
+        self.segments = []      # [start, stop, num_train] index ranges, stop included
+        self.completed = {}     # count -> (is_train, size, checksum)
+
+    def exists(self):
+        '''Returns true if the output directory has a manifest'''
+        return os.path.isfile(self._path)
+
+    def num_images(self):
+        '''Returns the total number of indices in every segment'''
+        return sum(stop - start + 1 for start, stop, _ in self.segments)
+
+    def _save_header(self):
+        '''Writes manifest.json'''
+        with open(self._path + '.tmp', 'w') as file:
+            json.dump({'config_hash': self.config_hash, 'seed': self.seed, 'segments': self.segments}, file, indent=4)
+        os.replace(self._path + '.tmp', self._path)
+
+    def create(self, config_hash, seed, num_images, num_train):
+        '''Starts a new manifest with a single segment of indices'''
+        self.config_hash, self.seed = config_hash, seed
+        self.segments = [[1, num_images, num_train]]
+        self.completed = {}
+        self._save_header()
+        open(self._log_path, 'w').close()
+
+    def load(self):
+        '''Reads the header and the completion log'''
+        with open(self._path) as file:
+            header = json.load(file)
+        self.config_hash, self.seed, self.segments = header['config_hash'], header['seed'], header['segments']
+        self.completed = {}
+        if os.path.isfile(self._log_path):
+            with open(self._log_path) as file:
+                for line in file:
+                    fields = line.split()
+                    # a line cut off by an interrupted run is ignored
+                    if len(fields) == 4:
+                        self.completed[int(fields[0])] = (fields[1] == 'train', int(fields[2]), fields[3])
+
+    def add_segment(self, num_images, num_train):
+        '''Appends a segment of num_images new indices, of which the first num_train are train images'''
+        start = self.num_images() + 1
+        self.segments.append([start, start + num_images - 1, num_train])
+        self._save_header()
+
+    def record(self, entries):
+        '''Logs (count, is_train, size, checksum) entries of completed indices'''
+        if not entries:
+            return
+        with open(self._log_path, 'a') as file:
+            for count, is_train, size, checksum in entries:
+                file.write('{} {} {} {}\n'.format(count, 'train' if is_train else 'val', size, checksum))
+                self.completed[count] = (is_train, size, checksum)
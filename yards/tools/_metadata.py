@@ -0,0 +1,93 @@
+"""
+Table of per-sprite metadata that only depends on the sprite's pixels.
+
+Transparency quadrants are computed once for every transform variant of every sprite, and can be
+persisted next to the sprite library so that later runs skip the analysis entirely.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import os
+import json
+from . import _helper
+
+METADATA_FILENAME = '.yards_metadata.json'
+
+
+def _get_signature(path):
+    """Returns the (mtime, size) of a file, which invalidates its persisted metadata when it changes."""
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _to_builtin(transparencies):
+    """Converts numpy integers in transparency quadrants to ints so that they can be saved as JSON."""
+    return [{key: int(value) for key, value in quadrant.items()} for quadrant in transparencies]
+
+
+class SpriteMetadata():
+    """Transparency quadrants keyed by sprite path and transform index."""
+
+    def __init__(self):
+        '''Initializing an empty metadata table'''
+        self._transparencies = {}   # path -> {transform index: transparency quadrants}
+        self._signatures = {}       # path -> signature of the file the quadrants were computed from
+        self._is_modified = False
+
+    def __len__(self):
+        return len(self._transparencies)
+
+    def build(self, image_cache, sprite_paths, map_dims, transform_sprites, atlas=None, pack=None):
+        '''Computes the quadrants of every transform variant that can be drawn on one of the map sizes.
+            Sprites in a pack take their signatures and untransformed quadrants from its index.'''
+        identity = _helper.get_transform_index((False, 0, False))
+        for path in sprite_paths:
+            entry = pack.get_entry(path) if pack is not None else None
+            signature = [entry['mtime'], entry['size']] if entry is not None else _get_signature(path)
+            if self._signatures.get(path) != signature:
+                self._transparencies[path] = {}
+                self._signatures[path] = signature
+            if entry is not None and entry['transparencies'] is not None:
+                self._transparencies[path][identity] = entry['transparencies']
+            sprite = image_cache.get(path)
+            operations = [(mirror, rotate, resize) for mirror in (False, True) for rotate in range(4) for resize in (False, True)] if transform_sprites else [(False, 0, False)]
+            for ops in operations:
+                for map_dim in map_dims:
+                    index = _helper.resolve_transform_index(sprite.size, ops, map_dim)
+                    if index in self._transparencies[path]:
+                        continue
+                    variant = atlas.get(path, index, map_dim) if atlas is not None else _helper.apply_transform(sprite, ops, map_dim)
+                    if variant.getchannel('A').getbbox() is None:
+                        continue    # fully transparent sprites have no quadrants
+                    self._transparencies[path][index] = _to_builtin(_helper._get_transparencies(variant))
+                    self._is_modified = True
+
+    def get_transparencies(self, path, index):
+        '''Returns the transparency quadrants of a sprite variant, or None if they weren't computed'''
+        return self._transparencies.get(path, {}).get(index)
+
+    def load(self, sprites_dir):
+        '''Loads metadata persisted in a sprite directory'''
+        metadata_path = sprites_dir + METADATA_FILENAME
+        if not os.path.isfile(metadata_path):
+            return
+        with open(metadata_path) as file:
+            saved = json.load(file)
+        for relative_path, entry in saved.items():
+            path = sprites_dir + relative_path
+            self._signatures[path] = entry['signature']
+            self._transparencies[path] = {int(index): quadrants for index, quadrants in entry['transparencies'].items()}
+
+    def save(self, sprites_dir):
+        '''Persists the metadata in a sprite directory if anything new was computed'''
+        if not self._is_modified:
+            return
+        saved = {os.path.relpath(path, sprites_dir): {'signature': self._signatures[path], 'transparencies': self._transparencies[path]}
+                 for path in self._transparencies}
+        metadata_path = sprites_dir + METADATA_FILENAME
+        try:
+            with open(metadata_path + '.tmp', 'w') as file:
+                json.dump(saved, file)
+            os.replace(metadata_path + '.tmp', metadata_path)
+            self._is_modified = False
+        except OSError:
+            print('Could not save sprite metadata to {}.'.format(metadata_path))
@@ -0,0 +1,90 @@
+"""
+Occupancy grid that places sprites with bounded overlap.
+
+The grid marks the pixels of an image that are covered by the boxes placed so far, and keeps an integral
+image of them, so the number of covered pixels in any box is four lookups. A sprite's box at each of its
+candidate positions is given by its span along each axis, which also covers sprites that are cropped at the
+edges of the image, so the covered pixels of every candidate are looked up at once. A valid position is then
+drawn directly from the candidates where at most max_overlap of the box is covered. Since the intersection
+of the box with any earlier box is at most its covered area, no two boxes have an IoU above max_overlap.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import numpy as np
+
+
+def get_spans(positions, size, map_size, edge_cuts=None):
+    """Returns the [start, stop) spans along one axis of the boxes of a sprite of the given size drawn at each position,
+        clipped to the map. With the (low reach, low cut, high reach, high cut) edge cuts of the sprite's transparency
+        quadrants, sprites crossing an edge are cropped and moved like the edge handler does."""
+    starts, stops = positions, positions + size
+    if edge_cuts is not None:
+        low_reach, low_cut, high_reach, high_cut = edge_cuts
+        low = positions < 0
+        high = ~low & (positions >= map_size - size)
+        # past the low edge, the sprite is cropped at its quadrants or at the edge and moved onto the map
+        starts = np.where(low, 0, starts)
+        stops = np.where(low, np.where(low_reach >= positions + size, size - low_cut, positions + size), stops)
+        # past the high edge, it's kept up to its quadrants or to the edge and moved back against the edge
+        right = np.where(high_reach >= map_size - positions, high_cut, map_size - positions)
+        starts = np.where(high, map_size - right, starts)
+        stops = np.where(high, map_size, stops)
+    return np.clip(starts, 0, map_size), np.clip(stops, 0, map_size)
+
+
+class OccupancyGrid():
+    """The covered pixels of a (width, height) image and their integral image."""
+
+    def __init__(self, width, height):
+        '''Initializing an empty grid'''
+        self.width, self.height = int(width), int(height)
+        self._occupied = np.zeros((self.height, self.width), dtype=np.int32)
+        self._integral = np.zeros((self.height + 1, self.width + 1), dtype=np.int32)
+        self._stale_from = None   # the first (row, column) of the integral image that is out of date
+        self._is_empty = True
+
+    def add(self, x_span, y_span):
+        '''Marks the box with the given [start, stop) spans as covered'''
+        (x0, x1), (y0, y1) = x_span, y_span
+        if x1 <= x0 or y1 <= y0:
+            return
+        self._occupied[y0:y1, x0:x1] = 1
+        self._is_empty = False
+        self._stale_from = (y0, x0) if self._stale_from is None else (min(y0, self._stale_from[0]), min(x0, self._stale_from[1]))
+
+    def _get_integral(self):
+        '''Returns the integral image, with a row and column of zeros before the first pixel.
+            Only the part below and right of the boxes added since the last call is recomputed.'''
+        if self._stale_from is not None:
+            r, c = self._stale_from
+            block = self._occupied[r:, c:].cumsum(axis=0).cumsum(axis=1)
+            block += self._integral[r+1:, c:c+1] + self._integral[r:r+1, c+1:] - self._integral[r, c]
+            self._integral[r+1:, c+1:] = block
+            self._stale_from = None
+        return self._integral
+
+    def coverage(self, x_spans, y_spans):
+        '''Returns the covered and total pixels of the boxes with every combination of the (starts, stops) spans, as (y, x) arrays'''
+        (x0, x1), (y0, y1) = x_spans, y_spans
+        integral = self._get_integral()
+        rows0, rows1 = integral[y0], integral[y1]
+        covered = rows1[:, x1] - rows0[:, x1] - rows1[:, x0] + rows0[:, x0]
+        return covered, (y1 - y0)[:, None] * (x1 - x0)[None, :]
+
+    def place(self, x_spans, y_spans, max_overlap, u):
+        '''Returns the (x, y) indices of the spans of a box, and marks it as covered. The box is drawn with u from those
+            where at most max_overlap of its pixels are covered, or from the least covered ones if there are none.'''
+        nx, ny = len(x_spans[0]), len(y_spans[0])
+        if self._is_empty:
+            # every box is free
+            index = min(int(u * nx * ny), nx * ny - 1)
+        else:
+            covered, area = self.coverage(x_spans, y_spans)
+            candidates = np.flatnonzero((covered <= max_overlap * area) & (area > 0))
+            if len(candidates) == 0:
+                ratio = np.where(area > 0, covered / np.maximum(area, 1), np.inf)
+                candidates = np.flatnonzero(ratio == ratio.min())
+            index = int(candidates[min(int(u * len(candidates)), len(candidates) - 1)])
+        row, column = divmod(index, nx)
+        self.add((x_spans[0][column], x_spans[1][column]), (y_spans[0][row], y_spans[1][row]))
+        return column, row
@@ -0,0 +1,189 @@
+"""
+Packed, memory-mapped sprite and map libraries.
+
+A pack compiles every PNG of a library directory, at its top level (maps) or in one folder per class
+(sprites), into a single .yards_pack file. The file starts with a JSON index and is followed by the decoded
+RGBA pixels of every image, each starting on a 64-byte boundary. The index records each image's class,
+dimensions, tight alpha bounding box, transparency quadrants, and the mtime and size of its source file.
+
+A run reads the index with a single read and memory-maps the pixels, so images are served without opening
+their files or decoding them. The directory is only listed and its files stat'ed, to pack it again if they
+changed. Packing a directory again only decodes the files that
+were added or changed since its last pack, and copies the pixels of the others from the old pack.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import os
+import json
+import base64
+import numpy as np
+from PIL import Image
+from . import _helper
+from ._metadata import _to_builtin
+
+PACK_FILENAME = '.yards_pack'
+_MAGIC = b'YARDSPK1'
+# images start on cache line boundaries, and the pixels on a page boundary
+_ALIGNMENT = 64
+_PAGE_SIZE = 4096
+
+
+def _align(offset, alignment):
+    """Returns the first multiple of alignment at or after offset."""
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _scan(directory):
+    """Returns the sorted relative paths of the PNGs at the top level of a directory and in its subdirectories."""
+    relative_paths = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                with os.scandir(entry.path) as files:
+                    relative_paths.extend(entry.name + '/' + file.name for file in files if file.name.endswith('.png') and not file.name.startswith('.'))
+            elif entry.name.endswith('.png'):
+                relative_paths.append(entry.name)
+    return sorted(relative_paths)
+
+
+def _describe(image):
+    """Returns the alpha bounding box and transparency quadrants of an RGBA image, which are None if it's fully transparent."""
+    bbox = image.getchannel('A').getbbox()
+    if bbox is None:
+        return None, None
+    return list(bbox), _to_builtin(_helper._get_transparencies(image))
+
+
+class SpritePack():
+    """The index and memory-mapped pixels of a packed library directory, keyed by the paths of the source files."""
+
+    def __init__(self, directory, index, data_offset):
+        '''Initializing a pack of directory from its index, with the pixels at data_offset in its file'''
+        self.directory = directory
+        self.index = index  # relative path -> entry
+        self._data_offset = data_offset
+        self._entries = {directory + relative_path: entry for relative_path, entry in index.items()}
+        self._map_data()
+
+    def _map_data(self):
+        '''Memory-maps the pixels of the pack file'''
+        path = self.directory + PACK_FILENAME
+        if os.path.getsize(path) > self._data_offset:
+            self._data = np.memmap(path, dtype=np.uint8, mode='r', offset=self._data_offset)
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)
+
+    def __getstate__(self):
+        '''Drops the memory map when pickled, so that the pixels aren't copied'''
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map_data()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def paths(self, class_name=None):
+        '''Returns the sorted paths of the images of a class, or of the images at the top level of the directory'''
+        return sorted(path for path, entry in self._entries.items() if entry['class'] == class_name)
+
+    def get_entry(self, path):
+        '''Returns the index entry of the image at path, or None if it isn't packed'''
+        return self._entries.get(path)
+
+    def get_pixels(self, path):
+        '''Returns the (height, width, 4) pixels of the image at path, which are read-only'''
+        entry = self._entries[path]
+        size = entry['width'] * entry['height'] * 4
+        return self._data[entry['offset']:entry['offset']+size].reshape(entry['height'], entry['width'], 4)
+
+    def get_image(self, path):
+        '''Returns the RGBA image at path, backed by the memory-mapped pixels'''
+        entry = self._entries[path]
+        image = Image.frombuffer('RGBA', (entry['width'], entry['height']), self.get_pixels(path), 'raw', 'RGBA', 0, 1)
+        # the color profile is kept, since encoders embed the profile of the background
+        if entry.get('icc_profile') is not None:
+            image.info['icc_profile'] = base64.b64decode(entry['icc_profile'])
+        return image
+
+    def get_stale_paths(self):
+        '''Returns the sorted relative paths of the images that were added, changed or removed since the directory was packed.
+            The files are only listed and stat'ed, not opened.'''
+        relative_paths = _scan(self.directory)
+        stale = set(self.index) - set(relative_paths)
+        for relative_path in relative_paths:
+            entry = self.index.get(relative_path)
+            stat = os.stat(self.directory + relative_path)
+            if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+                stale.add(relative_path)
+        return sorted(stale)
+
+    @staticmethod
+    def open(directory):
+        '''Returns the pack of a directory, or None if the directory hasn't been packed'''
+        path = directory + PACK_FILENAME
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as file:
+            if file.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('{} is not a yards pack.'.format(path))
+            length = int.from_bytes(file.read(8), 'little')
+            header = json.loads(file.read(length))
+        return SpritePack(directory, header['index'], header['data_offset'])
+
+
+def build_pack(directory):
+    """Packs the images of a library directory, reusing the pixels of unchanged images from its existing pack.
+        Returns the pack and the number of images that were decoded."""
+    try:
+        old = SpritePack.open(directory)
+    except (OSError, ValueError):
+        old = None
+
+    index = {}
+    pixels = []
+    offset = 0
+    num_decoded = 0
+    for relative_path in _scan(directory):
+        path = directory + relative_path
+        stat = os.stat(path)
+        entry = old.index.get(relative_path) if old is not None else None
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            array = old.get_pixels(path)
+            entry = dict(entry)
+        else:
+            with Image.open(path) as image:
+                image = image.convert('RGBA')
+            array = np.asarray(image)
+            bbox, transparencies = _describe(image)
+            entry = {'class': relative_path.split('/')[0] if '/' in relative_path else None, 'width': image.size[0], 'height': image.size[1],
+                     'bbox': bbox, 'transparencies': transparencies, 'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+                     'icc_profile': base64.b64encode(image.info['icc_profile']).decode() if image.info.get('icc_profile') else None}
+            num_decoded += 1
+        entry['offset'] = offset
+        index[relative_path] = entry
+        pixels.append(array)
+        offset = _align(offset + array.nbytes, _ALIGNMENT)
+
+    # the index is written first, so the offset of the pixels depends on its length
+    index_json = json.dumps({'index': index, 'data_offset': 0})
+    data_offset = _align(len(_MAGIC) + 8 + len(index_json) + 32, _PAGE_SIZE)
+    header = json.dumps({'index': index, 'data_offset': data_offset}).encode()
+    path = directory + PACK_FILENAME
+    with open(path + '.tmp', 'wb') as file:
+        file.write(_MAGIC + len(header).to_bytes(8, 'little') + header)
+        for entry, array in zip(index.values(), pixels):
+            file.seek(data_offset + entry['offset'])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(data_offset + offset)
+    del pixels, old
+    os.replace(path + '.tmp', path)
+    return SpritePack.open(directory), num_decoded
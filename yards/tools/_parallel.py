@@ -0,0 +1,119 @@
+"""
+Multiprocessing helpers that spread image generation across CPU cores.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import multiprocessing as mp
+from multiprocessing import util
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+import random
+import numpy as np
+from . import _profiler
+
+# the yards object that worker processes render with
+_generator = None
+
+
+def _init_worker(generator=None, profiling=False):
+    """Initializes a worker process with the yards object to render with."""
+    global _generator
+    if generator is not None:
+        _generator = generator
+    # forked workers inherit the parent's stats, which the parent already counts
+    _profiler.reset()
+    if profiling:
+        _profiler.enable()
+    # forked workers inherit the parent's RNG state, so reseed them to avoid duplicate images
+    np.random.seed()
+    random.seed()
+    util.Finalize(None, _teardown_worker, exitpriority=10)
+
+
+def _teardown_worker():
+    """Shuts down the encoder threads of a worker process when it exits."""
+    if _generator is not None:
+        _generator._encoder.close()
+
+
+def _run_chunk(args):
+    """Calls a yards method on a chunk of tasks. Returns the chunk size, the method's result and the worker's profiling stats."""
+    method, chunk = args
+    result = getattr(_generator, method)(chunk)
+    return len(chunk), result, _profiler.collect() if _profiler.is_enabled() else None
+
+
+def default_chunk_size(num_tasks, num_processes):
+    """Returns a chunk size giving every process a few chunks, which balances load without per-image overhead."""
+    return max(1, min(64, num_tasks // (num_processes * 4)))
+
+
+def chunk_tasks(tasks, chunk_size):
+    """Splits a list of tasks into chunks of at most chunk_size tasks."""
+    return [tasks[i:i+chunk_size] for i in range(0, len(tasks), chunk_size)]
+
+
+def chunk_iter(tasks, chunk_size):
+    """Splits a possibly infinite iterable of tasks into lists of at most chunk_size tasks."""
+    tasks = iter(tasks)
+    while True:
+        chunk = list(islice(tasks, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@contextmanager
+def _pool(generator, num_processes):
+    """Returns a process pool whose workers render with the generator."""
+    global _generator
+    # forked workers inherit the generator for free, other start methods need it pickled
+    ctx = mp.get_context()
+    if ctx.get_start_method() == 'fork':
+        _generator = generator
+        initargs = (None, _profiler.is_enabled())
+    else:
+        initargs = (generator, _profiler.is_enabled())
+
+    try:
+        with ctx.Pool(num_processes, initializer=_init_worker, initargs=initargs) as pool:
+            yield pool
+            # let the workers exit on their own rather than terminating them, so that they tear down
+            pool.close()
+            pool.join()
+    finally:
+        _generator = None
+
+
+def imap_chunks(generator, method, tasks, num_processes, chunk_size=None, ordered=False):
+    """Runs generator.method on chunks of tasks in a process pool.
+        Yields (chunk size, result) tuples as chunks finish."""
+    if chunk_size is None:
+        chunk_size = default_chunk_size(len(tasks), num_processes)
+
+    with _pool(generator, num_processes) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for num_done, result, stats in imap(_run_chunk, [(method, chunk) for chunk in chunk_tasks(tasks, chunk_size)]):
+            _profiler.merge(stats)
+            yield num_done, result
+
+
+def imap_bounded(generator, method, chunks, num_processes, max_pending):
+    """Runs generator.method on each chunk of a possibly infinite iterable of chunks in a process pool.
+        Yields results in order, keeping at most max_pending chunks queued or finished but not yet consumed."""
+    with _pool(generator, num_processes) as pool:
+        pending = deque()
+        chunks = iter(chunks)
+        for chunk in chunks:
+            pending.append(pool.apply_async(_run_chunk, ((method, chunk),)))
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            _, result, stats = pending.popleft().get()
+            _profiler.merge(stats)
+            # top the queue back up before handing the result over, so workers stay busy while it is consumed
+            for chunk in chunks:
+                pending.append(pool.apply_async(_run_chunk, ((method, chunk),)))
+                break
+            yield result
@@ -0,0 +1,341 @@
+"""
+Vectorized planning of the sprites placed on each image.
+
+Every image draws one fixed-width vector of uniform random numbers from its own seeded stream. The
+background, sprite counts, sprite choices, transforms and positions for a whole chunk of images are
+then computed from those vectors with a few array operations, producing a placement plan that the
+renderer consumes. Because each image only reads its own vector, the plan for an image does not
+depend on which chunk it was planned in.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import numpy as np
+from . import _rng
+from . import _occupancy
+
+IMAGE_DTYPE = np.dtype([
+    ('count', np.int64),        # index of the output image
+    ('background', np.int32),   # index into the map paths
+    ('left', np.int32),         # window of the map that the image shows, the whole map without a viewport
+    ('top', np.int32),
+    ('width', np.int32),
+    ('height', np.int32),
+    ('start', np.int64),        # first row of the image's placements
+    ('stop', np.int64)          # one past the last row of the image's placements
+])
+
+PLACEMENT_DTYPE = np.dtype([
+    ('count', np.int64),        # index of the output image
+    ('class_number', np.int16), # label number, -1 for unlabeled classes
+    ('sprite', np.int32),       # index into the sprite paths
+    ('transform', np.uint8),    # transform index actually applied (see _helper.get_transform_index)
+    ('x', np.int32),            # position of the transformed sprite's upper left corner
+    ('y', np.int32),
+    ('width', np.int32),        # size of the transformed sprite
+    ('height', np.int32),
+    ('clipped', np.bool_)       # whether the sprite crosses an edge of the map
+])
+
+# uniform random numbers drawn per sprite: sprite choice, mirror, rotation, resize, x, y
+_NUM_SPRITE_DRAWS = 6
+# uniform random numbers drawn per sprite with placement priors: position cell, size cell, width and height within the size cell
+_NUM_PRIOR_DRAWS = 4
+# uniform random numbers drawn per image for the position of its viewport, after every other draw
+_NUM_VIEWPORT_DRAWS = 2
+
+
+class PlacementPlan():
+    """The backgrounds and sprite placements for a set of images."""
+
+    def __init__(self, images, placements, map_paths, sprite_paths):
+        '''Initializing a plan from its structured arrays'''
+        self.images = images
+        self.placements = placements
+        self.map_paths = map_paths
+        self.sprite_paths = sprite_paths
+
+    def __len__(self):
+        return len(self.images)
+
+    def __iter__(self):
+        '''Yields each image's row and its placements'''
+        for image in self.images:
+            yield image, self.placements[image['start']:image['stop']]
+
+    def save(self, path):
+        '''Saves the plan to a .npz file'''
+        np.savez(path, images=self.images, placements=self.placements, map_paths=np.array(self.map_paths), sprite_paths=np.array(self.sprite_paths))
+
+    @staticmethod
+    def load(path):
+        '''Loads a plan saved with save'''
+        with np.load(path) as data:
+            return PlacementPlan(data['images'], data['placements'], list(data['map_paths']), list(data['sprite_paths']))
+
+
+class Planner():
+    """Samples placement plans for every classification scheme."""
+
+    def __init__(self, classes, class_numbers, classification_scheme, sprite_cap, map_paths, map_dims, sprite_path_cache, sprite_dims, transform_sprites, clip_sprites, map_weights=None, viewport=None, priors=None, max_overlap=None, sprite_metadata=None):
+        '''Builds the lookup tables used for sampling. Backgrounds are drawn uniformly unless map_weights gives each map a weight.
+            With a (width, height) viewport, each image shows a window of that size at a random position on its map.
+            With PlacementPriors, sprites of classes with a prior are sized and positioned like the real labels.
+            With max_overlap, sprites are placed so that no two of an image's boxes have an IoU above it. Clipped sprites are then placed
+            by the boxes the edge handler crops them to, using the transparency quadrants in sprite_metadata.'''
+        self.map_paths = list(map_paths)
+        self._map_dims = np.array(map_dims, dtype=np.int64).reshape(-1, 2)
+        # maps smaller than the viewport are shown whole along that axis
+        self._viewport = viewport
+        self._window_dims = np.minimum(self._map_dims, np.array(viewport, dtype=np.int64)) if viewport is not None else self._map_dims
+        self._map_cdf = None
+        if map_weights is not None:
+            map_weights = np.asarray(map_weights, dtype=np.float64)
+            if len(map_weights) != len(self.map_paths) or (map_weights < 0).any() or map_weights.sum() <= 0:
+                raise ValueError('The background weights must be non-negative with at least one positive weight.')
+            self._map_cdf = np.cumsum(map_weights) / map_weights.sum()
+        self._scheme = classification_scheme
+        self._transform_sprites = transform_sprites
+        self._clip_sprites = clip_sprites
+
+        class_list = list(classes.keys())
+        # a class without sprites would be drawn with the sprites of the class after it
+        empty = [c for c in class_list if len(sprite_path_cache[c]) == 0]
+        if empty:
+            raise ValueError('No sprites were found for {}.'.format(', '.join(str(c) for c in empty)))
+        self._class_numbers = np.array([class_numbers[c] for c in class_list], dtype=np.int16)
+
+        # flatten the sprite paths, remembering where each class starts
+        self.sprite_paths = [path for c in class_list for path in sprite_path_cache[c]]
+        self._sprite_counts = np.array([len(sprite_path_cache[c]) for c in class_list], dtype=np.int64)
+        self._sprite_offsets = np.concatenate([[0], np.cumsum(self._sprite_counts)[:-1]]).astype(np.int64)
+        self._sprite_dims = np.array([sprite_dims[path] for path in self.sprite_paths], dtype=np.int64).reshape(-1, 2)
+        # the sprites of each class, padded with -1
+        self._class_sprites = np.full((len(class_list), max(self._sprite_counts.max(initial=0), 1)), -1, dtype=np.int64)
+        for i in range(len(class_list)):
+            self._class_sprites[i, :self._sprite_counts[i]] = self._sprite_offsets[i] + np.arange(self._sprite_counts[i])
+        self._priors = priors
+        self._max_overlap = max_overlap
+        self._sprite_metadata = sprite_metadata
+        self._num_sprite_draws = _NUM_SPRITE_DRAWS + (_NUM_PRIOR_DRAWS if priors is not None else 0)
+
+        # per scheme tables: the count values of each class and the cumulative probability of each value
+        if classification_scheme == 'random':
+            self._maxes = np.array([classes[c] for c in class_list], dtype=np.int64)
+            self._max_counts = np.minimum(self._maxes, sprite_cap) if sprite_cap != -1 else self._maxes
+            self._num_count_draws = len(class_list)
+        elif classification_scheme == 'discrete':
+            self._num_discrete = classes[class_list[0]]
+            self._max_counts = np.full(len(class_list), self._num_discrete, dtype=np.int64)
+            self._num_count_draws = self._num_discrete
+        elif classification_scheme in ('distribution', 'mimic-real'):
+            if classification_scheme == 'distribution':
+                values = [list(range(len(classes[c]))) for c in class_list]
+                probabilities = [classes[c] for c in class_list]
+            else:
+                values = [list(classes[c][0]) for c in class_list]
+                probabilities = [classes[c][1] for c in class_list]
+            width = max(len(v) for v in values)
+            self._values = np.zeros((len(class_list), width), dtype=np.int64)
+            self._cdf = np.full((len(class_list), width), np.inf)
+            for i in range(len(class_list)):
+                self._values[i, :len(values[i])] = values[i]
+                self._values[i, len(values[i]):] = values[i][-1]
+                self._cdf[i, :len(values[i])] = np.cumsum(probabilities[i])
+            if sprite_cap != -1:
+                self._values = np.minimum(self._values, sprite_cap)
+            self._max_counts = self._values.max(axis=1)
+            self._num_count_draws = len(class_list)
+        else:
+            raise ValueError('Invalid classification scheme.')
+
+        self._max_sprites = int(self._max_counts.sum()) if classification_scheme != 'discrete' else self._num_discrete
+        self._num_draws = 1 + self._num_count_draws + self._num_sprite_draws * self._max_sprites + (_NUM_VIEWPORT_DRAWS if viewport is not None else 0)
+
+    def _draw(self, seed, counts):
+        '''Returns the uniform random numbers of each image, one row per image'''
+        return np.stack([_rng.image_rng(seed, count).random(self._num_draws) for count in counts]) if len(counts) > 0 else np.zeros((0, self._num_draws))
+
+    def _sample_backgrounds(self, u):
+        '''Returns the background index of each uniform random number'''
+        if self._map_cdf is None:
+            return np.floor(u * len(self.map_paths)).astype(np.int64)
+        # maps with zero weight take up no room in the cdf, so they are never drawn
+        return np.minimum(np.searchsorted(self._map_cdf, u, side='right'), len(self.map_paths) - 1)
+
+    def backgrounds(self, seed, counts):
+        '''Returns the background index of each of the images with the given indices, without planning their sprites.
+            The background is the first number in an image's stream, so only that number is drawn.'''
+        u = np.array([_rng.image_rng(seed, count).random() for count in counts], dtype=np.float64)
+        return self._sample_backgrounds(u)
+
+    def _sample_counts(self, u):
+        '''Returns the (images, classes) matrix of sprite counts'''
+        num_images, num_classes = u.shape[0], len(self._class_numbers)
+        if self._scheme == 'random':
+            # counts above the cap are clipped to it rather than redrawn
+            return np.minimum(np.floor(u * (self._maxes + 1)).astype(np.int64), self._max_counts)
+        if self._scheme == 'discrete':
+            choices = np.floor(u * num_classes).astype(np.int64)
+            counts = np.zeros((num_images, num_classes), dtype=np.int64)
+            np.add.at(counts, (np.repeat(np.arange(num_images), choices.shape[1]), choices.ravel()), 1)
+            return counts
+        # inverse transform sampling on every class at once
+        indices = (u[:, :, None] >= self._cdf[None, :, :]).sum(axis=2)
+        # the frequency spaces sum to 1, so this only catches the rounding of their cumulative sums
+        indices = np.minimum(indices, self._values.shape[1] - 1)
+        return self._values[np.arange(num_classes)[None, :], indices]
+
+    def _apply_size_prior(self, classes, sprites, dims, rotate, resize, map_dims, draws):
+        '''Replaces the sprite and resize of every sprite whose class has a prior with the rotated sprite and scale
+            of its class that comes closest to a size drawn from the prior'''
+        learned = np.flatnonzero(self._priors.has_prior[classes])
+        if len(learned) == 0:
+            return sprites, dims, resize
+        sprites, dims, resize = sprites.copy(), dims.copy(), resize.copy()
+        targets = np.maximum(self._priors.sample_sizes(classes[learned], draws[learned, 7], draws[learned, 8:10]) * map_dims[learned], 1)
+
+        # every (sprite, scale) option of each sprite's class, as (rows, options, 2) sizes
+        candidates = self._class_sprites[classes[learned]]
+        candidate_dims = self._sprite_dims[np.maximum(candidates, 0)]
+        candidate_dims = np.where((rotate[learned] % 2 == 1)[:, None, None], candidate_dims[..., ::-1], candidate_dims)
+        option_dims, option_valid = [candidate_dims], [candidates >= 0]
+        if self._transform_sprites:
+            option_dims.append(candidate_dims * 2)
+            option_valid.append((candidates >= 0) & (candidate_dims < map_dims[learned, None, :] // 2).all(axis=2))
+        option_dims, option_valid = np.concatenate(option_dims, axis=1), np.concatenate(option_valid, axis=1)
+
+        # the option closest in log scale
+        distances = np.abs(np.log(option_dims / targets[:, None, :])).sum(axis=2)
+        best = np.where(option_valid, distances, np.inf).argmin(axis=1)
+        chosen = best % candidates.shape[1]
+        sprites[learned] = candidates[np.arange(len(learned)), chosen]
+        dims[learned] = candidate_dims[np.arange(len(learned)), chosen]
+        resize[learned] = best >= candidates.shape[1]
+        return sprites, dims, resize
+
+    def _apply_position_prior(self, classes, positions, dims, map_dims, draws):
+        '''Replaces the position of every sprite whose class has a prior with one centered on a point drawn from the prior'''
+        learned = np.flatnonzero(self._priors.has_prior[classes])
+        if len(learned) == 0:
+            return positions
+        positions = positions.copy()
+        centers = self._priors.sample_positions(classes[learned], draws[learned, 6], draws[learned, 4:6]) * map_dims[learned]
+        learned_positions = np.floor(centers - dims[learned] / 2).astype(np.int64)
+        # keep sprites on the map, or at least partly on it when clipping
+        if self._clip_sprites:
+            positions[learned] = np.clip(learned_positions, 1 - dims[learned], map_dims[learned] - 1)
+        else:
+            # the same bounds as uniform positions, which stop short of the right and bottom edges
+            positions[learned] = np.clip(learned_positions, 0, np.maximum(map_dims[learned] - dims[learned] - 1, 0))
+        return positions
+
+    def _get_edge_cuts(self, sprite, transform, dim):
+        '''Returns the (low reach, low cut, high reach, high cut) of a transformed sprite along x and y that the edge handler crops it by,
+            or None if its transparency quadrants aren't known'''
+        transparencies = self._sprite_metadata.get_transparencies(self.sprite_paths[sprite], transform) if self._sprite_metadata is not None else None
+        if transparencies is None:
+            return None, None
+        ul, ur, bl, br = transparencies
+        (w, h), xs, ys = dim, [q['x'] for q in transparencies], [q['y'] for q in transparencies]
+        return ((max(w - ur['x'], w - br['x']), int(np.average(xs)), max(ul['x'], bl['x']), int(np.average(xs))),
+                (max(h - bl['y'], h - br['y']), int(np.average(ys)), max(ul['y'], ur['y']), int(np.average(ys))))
+
+    def _apply_overlap_limit(self, classes, sprites, transforms, positions, dims, starts, stops, window_dims, draws):
+        '''Replaces the positions of each image's sprites, in order, with positions drawn from an occupancy grid of the boxes
+            before them, so that no box is covered by more than max_overlap. Sprites placed by a prior keep their positions but take up room.'''
+        positions = positions.copy()
+        fixed = self._priors.has_prior[classes] if self._priors is not None else np.zeros(len(classes), dtype=bool)
+        for start, stop, (width, height) in zip(starts, stops, window_dims):
+            grid = _occupancy.OccupancyGrid(width, height)
+            for row in range(start, stop):
+                w, h = dims[row]
+                x_cuts, y_cuts = self._get_edge_cuts(sprites[row], transforms[row], (w, h)) if self._clip_sprites else (None, None)
+                if fixed[row]:
+                    xs, ys = positions[row, :1], positions[row, 1:]
+                elif self._clip_sprites:
+                    # the same positions as without the limit, apart from those that would be drawn entirely off the map
+                    xs = np.arange(-w, width) if x_cuts is not None else np.arange(1 - w, width)
+                    ys = np.arange(-h, height) if y_cuts is not None else np.arange(1 - h, height)
+                else:
+                    xs, ys = np.arange(max(width - w, 1)), np.arange(max(height - h, 1))
+                column, row_index = grid.place(_occupancy.get_spans(xs, w, width, x_cuts), _occupancy.get_spans(ys, h, height, y_cuts),
+                                               1.0 if fixed[row] else self._max_overlap, draws[row, 4])
+                positions[row] = xs[column], ys[row_index]
+        return positions
+
+    def plan(self, seed, counts):
+        '''Returns the placement plan for the images with the given indices'''
+        counts = np.asarray(list(counts), dtype=np.int64)
+        u = self._draw(seed, counts)
+        num_images = len(counts)
+        num_classes = len(self._class_numbers)
+
+        # backgrounds
+        backgrounds = self._sample_backgrounds(u[:, 0])
+        window_dims = self._window_dims[backgrounds]
+        if self._viewport is not None:
+            windows = np.floor(u[:, -_NUM_VIEWPORT_DRAWS:] * (self._map_dims[backgrounds] - window_dims + 1)).astype(np.int64)
+        else:
+            windows = np.zeros((num_images, 2), dtype=np.int64)
+
+        # sprite counts, then one row per sprite in class order
+        class_counts = self._sample_counts(u[:, 1:1+self._num_count_draws])
+        totals = class_counts.sum(axis=1)
+        stops = np.cumsum(totals)
+        starts = stops - totals
+        rows = np.repeat(np.arange(num_images), totals)
+        classes = np.repeat(np.tile(np.arange(num_classes), num_images), class_counts.ravel())
+        slots = np.arange(len(rows)) - starts[rows]
+
+        # the uniform random numbers of each sprite
+        columns = 1 + self._num_count_draws + self._num_sprite_draws * slots
+        draws = u[rows[:, None], columns[:, None] + np.arange(self._num_sprite_draws)[None, :]]
+
+        # sprite choices
+        sprites = self._sprite_offsets[classes] + np.floor(draws[:, 0] * self._sprite_counts[classes]).astype(np.int64)
+        dims = self._sprite_dims[sprites]
+        # sprites are placed within the image's window
+        map_dims = window_dims[rows]
+
+        # transforms, dropping the resize where the sprite is too big to double on the map
+        mirror = np.zeros(len(rows), dtype=bool)
+        rotate = np.zeros(len(rows), dtype=np.int64)
+        resize = np.zeros(len(rows), dtype=bool)
+        if self._transform_sprites:
+            mirror = draws[:, 1] < 0.5
+            rotate = np.floor(draws[:, 2] * 4).astype(np.int64)
+            dims = np.where((rotate % 2 == 1)[:, None], dims[:, ::-1], dims)
+            resize = (draws[:, 3] < 0.5) & (dims[:, 0] < map_dims[:, 0] // 2) & (dims[:, 1] < map_dims[:, 1] // 2)
+        if self._priors is not None:
+            sprites, dims, resize = self._apply_size_prior(classes, sprites, dims, rotate, resize, map_dims, draws)
+        dims = np.where(resize[:, None], dims * 2, dims)
+        transforms = mirror * 8 + rotate * 2 + resize
+
+        # positions
+        if self._clip_sprites:
+            positions = np.floor(draws[:, 4:6] * (map_dims + dims)).astype(np.int64) - dims
+        else:
+            positions = np.floor(draws[:, 4:6] * (map_dims - dims)).astype(np.int64)
+        if self._priors is not None:
+            positions = self._apply_position_prior(classes, positions, dims, map_dims, draws)
+        if self._max_overlap is not None:
+            positions = self._apply_overlap_limit(classes, sprites, transforms, positions, dims, starts, stops, window_dims, draws)
+        # only sprites that may cross the edges go through the edge handler
+        if self._clip_sprites:
+            clipped = ((positions < 0) | (positions >= map_dims - dims)).any(axis=1)
+        else:
+            clipped = np.zeros(len(rows), dtype=bool)
+
+        images = np.zeros(num_images, dtype=IMAGE_DTYPE)
+        images['count'], images['background'], images['start'], images['stop'] = counts, backgrounds, starts, stops
+        images['left'], images['top'] = windows[:, 0], windows[:, 1]
+        images['width'], images['height'] = window_dims[:, 0], window_dims[:, 1]
+        placements = np.zeros(len(rows), dtype=PLACEMENT_DTYPE)
+        placements['count'] = counts[rows]
+        placements['class_number'] = self._class_numbers[classes]
+        placements['sprite'] = sprites
+        placements['transform'] = transforms
+        placements['x'], placements['y'] = positions[:, 0], positions[:, 1]
+        placements['width'], placements['height'] = dims[:, 0], dims[:, 1]
+        placements['clipped'] = clipped
+        return PlacementPlan(images, placements, self.map_paths, self.sprite_paths)
@@ -0,0 +1,76 @@
+"""
+Placement priors learned from real labels.
+
+Each class's histograms of bounding box centers and sizes (see _real_stats) are turned into alias tables,
+so that a cell of a histogram is drawn in constant time from a single uniform random number. A position
+or size is then jittered uniformly within its cell.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import numpy as np
+
+
+def build_alias_table(weights):
+    """Returns the (probability, alias) arrays of Vose's alias method for drawing indices with the given weights."""
+    n = len(weights)
+    scaled = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] += scaled[s] - 1.0
+        (small if scaled[l] < 1.0 else large).append(l)
+    # whatever is left is only off by rounding
+    return prob, alias
+
+
+def sample_alias(prob, alias, rows, u):
+    """Returns the indices drawn from the given rows of stacked alias tables with one uniform random number each.
+        The whole part of u * n picks a column and the fractional part decides between it and its alias."""
+    n = prob.shape[1]
+    scaled = u * n
+    columns = np.minimum(np.floor(scaled).astype(np.int64), n - 1)
+    return np.where(scaled - columns < prob[rows, columns], columns, alias[rows, columns])
+
+
+class PlacementPriors():
+    """Alias tables of the position and size histograms of each class, in the planner's class order."""
+
+    def __init__(self, histograms):
+        '''Builds the tables from a list of (positions, sizes) histograms per class, or None for classes without real labels'''
+        bins = next((positions.shape[0] for positions, _ in filter(None, histograms)), 1)
+        self.bins = bins
+        self.has_prior = np.array([h is not None for h in histograms], dtype=bool)
+        self._position_tables = self._build_tables([h[0] if h is not None else None for h in histograms])
+        self._size_tables = self._build_tables([h[1] if h is not None else None for h in histograms])
+
+    def _build_tables(self, histograms):
+        '''Returns the stacked (probability, alias) tables of flattened histograms, with flat tables for missing ones'''
+        tables = [build_alias_table(h.ravel() if h is not None else np.ones(self.bins * self.bins)) for h in histograms]
+        return np.stack([prob for prob, _ in tables]), np.stack([alias for _, alias in tables])
+
+    def _sample(self, tables, classes, u, jitter):
+        '''Returns relative (x, y) points drawn from the histograms of the classes, jittered within their cells'''
+        prob, alias = tables
+        cells = sample_alias(prob, alias, classes, u)
+        return (np.stack([cells // self.bins, cells % self.bins], axis=1) + jitter) / self.bins
+
+    def sample_positions(self, classes, u, jitter):
+        '''Returns relative (x, y) centers for sprites of the classes'''
+        return self._sample(self._position_tables, classes, u, jitter)
+
+    def sample_sizes(self, classes, u, jitter):
+        '''Returns relative (width, height) sizes for sprites of the classes'''
+        return self._sample(self._size_tables, classes, u, jitter)
+
+    @staticmethod
+    def from_real_stats(real_stats, class_ids):
+        '''Returns the priors of the real classes with the given ids. Classes without real labels (id None or unseen) get no prior.'''
+        histograms = []
+        for class_id in class_ids:
+            stats = real_stats.classes.get(class_id) if class_id is not None else None
+            histograms.append((stats['positions'], stats['sizes']) if stats is not None and stats['positions'].sum() > 0 else None)
+        return PlacementPriors(histograms)
@@ -0,0 +1,185 @@
+"""
+Stage timers and counters for the generation hot path.
+
+Profiling is off by default, in which case stage() returns a shared no-op context manager and count() returns
+right away. When it is on, every stage keeps its total time, number of calls and a bounded random sample of
+call durations that percentiles are estimated from. Worker processes send their stats back with their results,
+which the main process merges in.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import random
+import threading
+import time
+from contextlib import nullcontext
+import numpy as np
+
+# the number of call durations kept per stage for percentiles
+SAMPLE_SIZE = 10000
+
+_NULL_STAGE = nullcontext()
+_enabled = False
+_start = None
+_totals = {}
+_calls = {}
+_samples = {}
+_counters = {}
+_exporters = []
+_lock = threading.Lock()
+_random = random.Random(0)
+
+
+def _add_sample(samples, num_calls, duration):
+    '''Reservoir-samples a call duration, given the number of calls of the stage including this one'''
+    if len(samples) < SAMPLE_SIZE:
+        samples.append(duration)
+    else:
+        i = _random.randrange(num_calls)
+        if i < SAMPLE_SIZE:
+            samples[i] = duration
+
+
+class _Stage():
+    """Context manager that adds the time spent inside it to a stage."""
+
+    __slots__ = ('_name', '_start')
+
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self._start
+        with _lock:
+            _totals[self._name] = _totals.get(self._name, 0.0) + elapsed
+            _calls[self._name] = _calls.get(self._name, 0) + 1
+            _add_sample(_samples.setdefault(self._name, []), _calls[self._name], elapsed)
+
+
+def enable():
+    """Turns profiling on."""
+    global _enabled, _start
+    _enabled = True
+    if _start is None:
+        _start = time.perf_counter()
+
+
+def disable():
+    """Turns profiling off."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """Returns true if profiling is on."""
+    return _enabled
+
+
+def reset():
+    """Clears the recorded stats."""
+    global _start
+    with _lock:
+        _totals.clear()
+        _calls.clear()
+        _samples.clear()
+        _counters.clear()
+    _start = time.perf_counter() if _enabled else None
+
+
+def stage(name):
+    """Returns a context manager timing the named stage."""
+    return _Stage(name) if _enabled else _NULL_STAGE
+
+
+def count(name, n=1):
+    """Adds n to the named counter."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def get_stats():
+    """Returns the raw stats: {'stages': {stage: {'total', 'calls', 'samples'}}, 'counters': {counter: value}}."""
+    with _lock:
+        return {'stages': {name: {'total': _totals[name], 'calls': _calls[name], 'samples': list(_samples[name])} for name in _totals},
+                'counters': dict(_counters)}
+
+
+def collect():
+    """Returns the raw stats and clears them, e.g. to send a worker's stats back to the main process."""
+    stats = get_stats()
+    reset()
+    return stats
+
+
+def merge(stats):
+    """Adds raw stats collected in another process."""
+    if stats is None:
+        return
+    with _lock:
+        for name, timing in stats['stages'].items():
+            _totals[name] = _totals.get(name, 0.0) + timing['total']
+            _calls[name] = _calls.get(name, 0) + timing['calls']
+            samples = _samples.setdefault(name, [])
+            samples.extend(timing['samples'])
+            # keep a sample that's still spread across every merged process
+            if len(samples) > SAMPLE_SIZE:
+                samples[:] = _random.sample(samples, SAMPLE_SIZE)
+        for name, value in stats['counters'].items():
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def report():
+    """Returns a summary of the stats with the time, share and percentiles of each stage and every counter.
+        The share of a stage is its part of the total time over all stages, which is summed across processes."""
+    stats = get_stats()
+    timed = sum(timing['total'] for timing in stats['stages'].values())
+    stages = {}
+    for name, timing in sorted(stats['stages'].items(), key=lambda item: -item[1]['total']):
+        p50, p90, p99 = np.percentile(timing['samples'], [50, 90, 99]) if timing['samples'] else (0.0, 0.0, 0.0)
+        stages[name] = {'total': timing['total'], 'calls': timing['calls'], 'share': timing['total'] / timed if timed > 0 else 0.0,
+                        'mean': timing['total'] / timing['calls'], 'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+                        'max': max(timing['samples']) if timing['samples'] else 0.0}
+
+    counters = stats['counters']
+    lookups = counters.get('cache_hits', 0) + counters.get('cache_misses', 0)
+    return {'elapsed': time.perf_counter() - _start if _start is not None else 0.0,
+            'stages': stages,
+            'counters': dict(sorted(counters.items())),
+            'cache_hit_rate': counters.get('cache_hits', 0) / lookups if lookups > 0 else None}
+
+
+def format_report(summary):
+    """Returns a printable table of a report()."""
+    lines = ['Profile over {:.2f}s:'.format(summary['elapsed']),
+             '{:<16}{:>10}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('stage', 'total (s)', 'calls', 'share', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)')]
+    for name, timing in summary['stages'].items():
+        lines.append('{:<16}{:>10.2f}{:>10}{:>7.1f}%{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            name, timing['total'], timing['calls'], 100 * timing['share'], 1000 * timing['p50'], 1000 * timing['p90'], 1000 * timing['p99'], 1000 * timing['max']))
+    for name, value in summary['counters'].items():
+        lines.append('{}: {}'.format(name, value))
+    if summary['cache_hit_rate'] is not None:
+        lines.append('cache_hit_rate: {:.1f}%'.format(100 * summary['cache_hit_rate']))
+    return '\n'.join(lines)
+
+
+def add_exporter(exporter):
+    """Registers a function that export() calls with every report()."""
+    _exporters.append(exporter)
+
+
+def remove_exporter(exporter):
+    """Unregisters an exporter."""
+    _exporters.remove(exporter)
+
+
+def export():
+    """Calls every registered exporter with the current report()."""
+    if not _enabled or not _exporters:
+        return
+    summary = report()
+    for exporter in _exporters:
+        exporter(summary)
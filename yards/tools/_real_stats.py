@@ -0,0 +1,163 @@
+"""
+Statistics of a set of real, hand-labeled images.
+
+The label files are scanned in parallel, parsing a whole chunk of files with one numpy conversion. For every
+class, the scan counts how many files have each number of sprites of that class (its frequency space), and
+builds histograms of the bounding box centers and sizes. The statistics are saved next to the labels, keyed by
+the names, mtimes and sizes of the label files, so later runs load them instead of scanning again.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import os
+import json
+import hashlib
+import multiprocessing as mp
+import numpy as np
+
+STATS_FILENAME = '.yards_real_stats.json'
+# the number of bins along each axis of the position and size histograms, which cover [0, 1]
+HISTOGRAM_BINS = 32
+# the number of label files handed to a worker at a time
+CHUNK_SIZE = 256
+# corpora with fewer label files are scanned without a process pool
+_MIN_PARALLEL_FILES = 2048
+
+
+def get_signature(label_paths):
+    """Returns a hash of the names, mtimes and sizes of the label files, which changes when any of them do."""
+    signature = hashlib.sha1()
+    for path in label_paths:
+        stat = os.stat(path)
+        signature.update('{}\t{}\t{}\n'.format(os.path.split(path)[1], stat.st_mtime_ns, stat.st_size).encode())
+    return signature.hexdigest()
+
+
+def parse_labels(contents):
+    """Returns a (N, 5) array of the (class, x, y, w, h) rows of each label file's contents, along with the index of each row's file."""
+    tokens = []
+    num_rows = []
+    for data in contents:
+        words = data.split()
+        tokens.extend(words[:len(words) - len(words) % 5])
+        num_rows.append(len(words) // 5)
+    rows = np.array(tokens, dtype=np.float64).reshape(-1, 5)
+    return rows, np.repeat(np.arange(len(contents)), num_rows)
+
+
+def _histogram(points):
+    """Returns the HISTOGRAM_BINS x HISTOGRAM_BINS histogram of (x, y) points in [0, 1]."""
+    histogram, _, _ = np.histogram2d(points[:, 0], points[:, 1], bins=HISTOGRAM_BINS, range=[[0, 1], [0, 1]])
+    return histogram.astype(np.int64)
+
+
+def _scan_chunk(paths):
+    """Returns the statistics of a chunk of label files."""
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as file:
+            contents.append(file.read())
+    rows, files = parse_labels(contents)
+    class_ids = rows[:, 0].astype(np.int64)
+
+    classes = {}
+    for class_id in np.unique(class_ids):
+        selected = class_ids == class_id
+        # the number of sprites of the class in each file that has any, and how many files have each number
+        _, per_file = np.unique(files[selected], return_counts=True)
+        values, num_files = np.unique(per_file, return_counts=True)
+        classes[int(class_id)] = {'counts': {int(value): int(n) for value, n in zip(values, num_files)},
+                                  'positions': _histogram(rows[selected, 1:3]),
+                                  'sizes': _histogram(rows[selected, 3:5])}
+    return len(paths), classes
+
+
+class RealStats():
+    """Frequency spaces and bounding box histograms of every class in a set of real labels."""
+
+    def __init__(self):
+        '''Initializing empty statistics'''
+        self.signature = None
+        self.num_files = 0
+        self.classes = {}   # class id -> {'counts': {count: num files}, 'positions': histogram, 'sizes': histogram}
+
+    def _merge(self, num_files, classes):
+        '''Adds the statistics of a chunk of label files'''
+        self.num_files += num_files
+        for class_id, stats in classes.items():
+            merged = self.classes.setdefault(class_id, {'counts': {}, 'positions': np.zeros((HISTOGRAM_BINS, HISTOGRAM_BINS), dtype=np.int64),
+                                                        'sizes': np.zeros((HISTOGRAM_BINS, HISTOGRAM_BINS), dtype=np.int64)})
+            for value, n in stats['counts'].items():
+                merged['counts'][value] = merged['counts'].get(value, 0) + n
+            merged['positions'] += stats['positions']
+            merged['sizes'] += stats['sizes']
+
+    def scan(self, label_paths, num_processes=None):
+        '''Computes the statistics of the label files, on a pool of num_processes processes for large sets'''
+        self.num_files, self.classes = 0, {}
+        chunks = [label_paths[i:i+CHUNK_SIZE] for i in range(0, len(label_paths), CHUNK_SIZE)]
+        num_processes = num_processes if num_processes is not None else mp.cpu_count()
+        if len(label_paths) < _MIN_PARALLEL_FILES or num_processes <= 1:
+            for chunk in chunks:
+                self._merge(*_scan_chunk(chunk))
+        else:
+            with mp.get_context().Pool(num_processes) as pool:
+                for result in pool.imap_unordered(_scan_chunk, chunks):
+                    self._merge(*result)
+
+    def get_frequency_space(self, class_id):
+        '''Returns the sprite counts of a class that appear in the labels and the share of files with each count'''
+        counts = dict(self.classes[class_id]['counts']) if class_id in self.classes else {}
+        # files without the class have zero sprites of it
+        num_without = self.num_files - sum(counts.values())
+        if num_without > 0:
+            counts[0] = num_without
+        values = sorted(counts)
+        return [values, [counts[value] / self.num_files for value in values]]
+
+    def load(self, path, signature):
+        '''Loads statistics saved at path. Returns false if there are none or they were computed from other label files.'''
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path) as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if saved.get('signature') != signature:
+            return False
+        self.signature, self.num_files = signature, saved['num_files']
+        self.classes = {int(class_id): {'counts': {int(value): n for value, n in stats['counts'].items()},
+                                        'positions': np.array(stats['positions'], dtype=np.int64),
+                                        'sizes': np.array(stats['sizes'], dtype=np.int64)}
+                        for class_id, stats in saved['classes'].items()}
+        return True
+
+    def save(self, path):
+        '''Saves the statistics to path'''
+        saved = {'signature': self.signature, 'num_files': self.num_files,
+                 'classes': {str(class_id): {'counts': {str(value): n for value, n in stats['counts'].items()},
+                                             'positions': stats['positions'].tolist(), 'sizes': stats['sizes'].tolist()}
+                             for class_id, stats in self.classes.items()}}
+        try:
+            with open(path + '.tmp', 'w') as file:
+                json.dump(saved, file)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            print('Could not save real label statistics to {}.'.format(path))
+
+
+def get_real_stats(real_dir, num_processes=None):
+    """Returns the statistics of the labels in a real data directory, loading them from its stats file if the labels haven't changed."""
+    label_paths = sorted(entry.path for entry in os.scandir(real_dir + 'labels/') if entry.name.endswith('.txt'))
+    signature = get_signature(label_paths)
+    stats = RealStats()
+    stats_path = real_dir + STATS_FILENAME
+    if stats.load(stats_path, signature):
+        print('Loaded statistics of {} real labels from {}.'.format(stats.num_files, stats_path))
+        return stats
+    print('Scanning {} real labels...'.format(len(label_paths)))
+    stats.scan(label_paths, num_processes)
+    stats.signature = signature
+    stats.save(stats_path)
+    print('Finished scanning {} real labels.'.format(stats.num_files))
+    return stats
@@ -0,0 +1,40 @@
+"""
+Seedable random number streams.
+
+Every image index gets its own numpy Generator derived from the run's seed, so any
+subset of images can be regenerated identically on any process, in any order.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import numpy as np
+
+# spawn keys separating the independent streams derived from one seed
+IMAGE_STREAM = 0
+SHUFFLE_STREAM = 1
+FILTER_STREAM = 2
+
+
+def new_seed():
+    """Returns a fresh seed drawn from OS entropy."""
+    return int(np.random.SeedSequence().entropy)
+
+
+def get_rng(seed, stream, *keys):
+    """Returns the Generator for a stream (and optional integer keys) of a seed."""
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(stream, *keys)))
+
+
+def image_rng(seed, count):
+    """Returns the Generator used to create the image with index count."""
+    return get_rng(seed, IMAGE_STREAM, count)
+
+
+def filter_rng(seed, count):
+    """Returns the Generator used to filter the image with index count."""
+    return get_rng(seed, FILTER_STREAM, count)
+
+
+def shuffle(seed, items, *keys):
+    """Shuffles a list in place with the shuffle stream of a seed."""
+    order = get_rng(seed, SHUFFLE_STREAM, *keys).permutation(len(items))
+    items[:] = [items[i] for i in order]
@@ -0,0 +1,88 @@
+"""
+Sharded tar output, which packs samples into a few large files instead of millions of small ones.
+
+Each sample's image and label are stored next to each other under the same key (WebDataset style),
+e.g. 'super_mario_bros-12.png' and 'super_mario_bros-12.txt'. Every split gets its own set of shards
+and a tab-separated index of where each member's bytes start, for random access without reading
+through the tar.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import io
+import os
+import tarfile
+
+DEFAULT_SHARD_NAME = '{split}-{shard:06d}.tar'
+
+
+def get_index_path(directory, split):
+    """Returns the path of the index file of a split."""
+    return '{}{}-index.tsv'.format(directory, split)
+
+
+class ShardWriter():
+    """Streams samples of one split into fixed-size tar shards."""
+
+    def __init__(self, directory, split, shard_size, shard_name=DEFAULT_SHARD_NAME, game_title=''):
+        '''Initializing a writer that starts its first shard on the first write'''
+        self._directory = directory
+        self._split = split
+        self._shard_size = shard_size
+        self._shard_name = shard_name
+        self._game_title = game_title
+        self._shard = -1
+        self._tar = None
+        self._shard_filename = None
+        self._num_in_shard = 0
+        self._index = open(get_index_path(directory, split), 'w')
+        self._index.write('key\textension\tshard\toffset\tsize\n')
+        self.num_samples = 0
+
+    def _next_shard(self):
+        '''Closes the current shard and opens the next one'''
+        if self._tar is not None:
+            self._tar.close()
+        self._shard += 1
+        self._shard_filename = self._shard_name.format(split=self._split, shard=self._shard, game_title=self._game_title)
+        self._tar = tarfile.open(self._directory + self._shard_filename, 'w', format=tarfile.USTAR_FORMAT)
+        self._num_in_shard = 0
+
+    def write(self, key, members):
+        '''Writes a sample, given as a list of (extension, bytes) members, to the current shard'''
+        if self._tar is None or self._num_in_shard >= self._shard_size:
+            self._next_shard()
+        for extension, data in members:
+            info = tarfile.TarInfo(key + extension)
+            info.size = len(data)
+            # the member's data starts right after its header
+            offset = self._tar.offset + len(info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+            self._tar.addfile(info, io.BytesIO(data))
+            self._index.write('{}\t{}\t{}\t{}\t{}\n'.format(key, extension, self._shard_filename, offset, len(data)))
+        self._num_in_shard += 1
+        self.num_samples += 1
+
+    def close(self):
+        '''Closes the current shard and the index'''
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+        self._index.close()
+
+
+def read_index(directory, split):
+    """Returns {key: {extension: (shard, offset, size)}} from the index of a split."""
+    index = {}
+    with open(get_index_path(directory, split)) as file:
+        next(file)
+        for line in file:
+            key, extension, shard, offset, size = line.rstrip('\n').split('\t')
+            index.setdefault(key, {})[extension] = (shard, int(offset), int(size))
+    return index
+
+
+def read_member(directory, location):
+    """Returns the bytes of a member at a (shard, offset, size) location from the index."""
+    shard, offset, size = location
+    with open(os.path.join(directory, shard), 'rb') as file:
+        file.seek(offset)
+        return file.read(size)
@@ -0,0 +1,54 @@
+"""
+Transfer of real images and labels into the output directory.
+
+Besides copying, a file can be hardlinked, symlinked or reflinked (a copy-on-write clone that shares the
+source's blocks, on filesystems such as Btrfs and XFS), which only writes metadata. A link that fails, e.g.
+across filesystems or on a filesystem without reflinks, falls back to a copy.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:     # not on Windows
+    fcntl = None
+
+COPY_MODES = ('copy', 'hardlink', 'symlink', 'reflink')
+
+# the Linux ioctl that clones a whole file into another, _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """Clones src into dst, raising OSError where the platform or filesystem can't."""
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+
+
+def transfer_file(src, dst, mode='copy'):
+    """Puts the file at src at dst with the given mode. Returns false if a link failed and the file was copied instead."""
+    # a resumed run may find a file from an earlier attempt, which a link can't replace and a copy mustn't write through
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode != 'copy':
+        try:
+            if mode == 'hardlink':
+                os.link(src, dst)
+            elif mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            else:
+                _reflink(src, dst)
+            return True
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return mode == 'copy'
@@ -3,6 +3,8 @@
 @author: Jaden Kim & Chanha Kim
 @date  : 7/20/2020
 """
+from . import _filters
+from . import _transfer
 
 def validate_config(config):
     '''Returns true if the config is valid'''
@@ -66,6 +68,40 @@ def validate_parameters(parameters, real_dir_exists):
         are_values_correct = False
     if parameters['classification_scheme'] == 'mimic-real' and not real_dir_exists:
         are_values_correct = False
+    if parameters.get('seed') is not None and (not isinstance(parameters['seed'], int) or parameters['seed'] < 0):
+        are_values_correct = False
+    if 'cache_size_mb' in parameters and (not isinstance(parameters['cache_size_mb'], int) or (parameters['cache_size_mb'] < 0 and parameters['cache_size_mb'] != -1)):
+        are_values_correct = False
+    if 'precompute_transforms' in parameters and not isinstance(parameters['precompute_transforms'], bool):
+        are_values_correct = False
+    if 'persist_sprite_metadata' in parameters and not isinstance(parameters['persist_sprite_metadata'], bool):
+        are_values_correct = False
+    if parameters.get('renderer', 'pil') not in ('pil', 'numpy'):
+        are_values_correct = False
+    if parameters.get('viewport') is not None and (not isinstance(parameters['viewport'], (list, tuple)) or len(parameters['viewport']) != 2 or not all(isinstance(value, int) and value > 0 for value in parameters['viewport'])):
+        are_values_correct = False
+    if parameters.get('placement_scheme', 'uniform') not in ('uniform', 'learned') or (parameters.get('placement_scheme') == 'learned' and not real_dir_exists):
+        are_values_correct = False
+    if parameters.get('max_overlap') is not None and (not isinstance(parameters['max_overlap'], (int, float)) or not 0 <= parameters['max_overlap'] <= 1):
+        are_values_correct = False
+    if parameters.get('min_visibility') is not None and (not isinstance(parameters['min_visibility'], (int, float)) or not 0 <= parameters['min_visibility'] <= 1):
+        are_values_correct = False
+    if parameters.get('occluded_boxes', 'drop') not in ('drop', 'flag'):
+        are_values_correct = False
+    if parameters.get('filters') is not None and not _filters.is_valid(parameters['filters']):
+        are_values_correct = False
+    if parameters.get('real_class_ids') is not None and (not isinstance(parameters['real_class_ids'], dict) or not all(isinstance(value, int) for value in parameters['real_class_ids'].values())):
+        are_values_correct = False
+    if 'group_by_background' in parameters and not isinstance(parameters['group_by_background'], bool):
+        are_values_correct = False
+    if 'use_packs' in parameters and not isinstance(parameters['use_packs'], bool):
+        are_values_correct = False
+    if parameters.get('real_copy_mode', 'copy') not in _transfer.COPY_MODES:
+        are_values_correct = False
+    if 'real_copy_threads' in parameters and (not isinstance(parameters['real_copy_threads'], int) or parameters['real_copy_threads'] < 1):
+        are_values_correct = False
+    if parameters.get('background_weights') is not None and (not isinstance(parameters['background_weights'], dict) or not all(isinstance(key, str) and isinstance(value, (int, float)) and value >= 0 for key, value in parameters['background_weights'].items())):
+        are_values_correct = False
 
     return are_keys_correct and are_values_correct
 
@@ -77,6 +113,8 @@ def validate_classes(classes, classification_scheme):
     classes_values = list(classes.values())
     if classification_scheme == 'distribution':
         are_values_correct = min([type(value) == list for value in classes_values]) and min([all(isinstance(sub_value, float) for sub_value in value) for value in classes_values])
+        # each frequency space is a probability distribution
+        are_values_correct = are_values_correct and all(abs(sum(value) - 1) <= 1e-6 for value in classes_values)
     elif classification_scheme == 'random':
         are_values_correct = min([type(value) == int for value in classes_values])
     elif classification_scheme == 'discrete':
@@ -88,3 +126,32 @@ def validate_classes(classes, classification_scheme):
 
     return are_keys_correct and are_values_correct
 
+
+
+def validate_output_format(output_format):
+    '''Returns true if the output format is valid'''
+    from ._encoder import FORMATS
+    from ._shards import DEFAULT_SHARD_NAME
+
+    correct_keys = {'format', 'compress_level', 'optimize', 'encoder_threads', 'mode', 'shard_size', 'shard_name'}
+    are_keys_correct = (set(output_format.keys()) - correct_keys) == set()
+
+    are_values_correct = True
+    if output_format.get('format', 'png') not in FORMATS:
+        are_values_correct = False
+    if output_format.get('compress_level') is not None and (not isinstance(output_format['compress_level'], int) or output_format['compress_level'] < 0 or output_format['compress_level'] > 9):
+        are_values_correct = False
+    if not isinstance(output_format.get('optimize', False), bool):
+        are_values_correct = False
+    if not isinstance(output_format.get('encoder_threads', 0), int) or output_format.get('encoder_threads', 0) < 0:
+        are_values_correct = False
+    if output_format.get('mode', 'files') not in ('files', 'shards'):
+        are_values_correct = False
+    if not isinstance(output_format.get('shard_size', 1000), int) or output_format.get('shard_size', 1000) < 1:
+        are_values_correct = False
+    try:
+        output_format.get('shard_name', DEFAULT_SHARD_NAME).format(split='train', shard=0, game_title='')
+    except (AttributeError, KeyError, IndexError, ValueError):
+        are_values_correct = False
+
+    return are_keys_correct and are_values_correct
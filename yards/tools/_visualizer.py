@@ -0,0 +1,70 @@
+"""
+Drawing of bounding boxes on images, and tiling of annotated images into contact sheets.
+
+Boxes are drawn as one-pixel outlines straight into an (height, width, 3) array, with every edge of every
+box written by a single fancy-indexed assignment. Each class has a fixed color derived from its number.
+
+@authors: Jaden Kim & Chanha Kim
+"""
+import colorsys
+import numpy as np
+from PIL import Image
+
+# the golden ratio spreads the hues of consecutive class numbers around the color wheel
+_GOLDEN_RATIO = 0.618033988749895
+
+
+def get_class_color(class_id):
+    """Returns the (r, g, b) color of a class, which is the same on every run."""
+    r, g, b = colorsys.hsv_to_rgb((int(class_id) * _GOLDEN_RATIO) % 1.0, 0.85, 1.0)
+    return int(r * 255), int(g * 255), int(b * 255)
+
+
+def parse_label(data):
+    """Returns the (N, 4) relative (x_center, y_center, width, height) boxes and (N,) class numbers in the contents of a label file."""
+    words = data.split()
+    rows = np.array(words[:len(words) - len(words) % 5], dtype=np.float64).reshape(-1, 5)
+    return rows[:, 1:], rows[:, 0].astype(np.int64)
+
+
+def _ranges(starts, stops):
+    """Returns the concatenation of arange(start, stop + 1) for each pair, and the index of the pair of every element."""
+    lengths = np.maximum(stops - starts + 1, 0)
+    owners = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[owners] + offsets, owners
+
+
+def draw_boxes(image, boxes, class_ids):
+    """Draws the outlines of relative (x_center, y_center, width, height) boxes onto an (height, width, 3) array in place."""
+    if len(boxes) == 0:
+        return image
+    height, width = image.shape[:2]
+    x1 = (width * boxes[:, 0] - width * boxes[:, 2] / 2).astype(np.int64)
+    y1 = (height * boxes[:, 1] - height * boxes[:, 3] / 2).astype(np.int64)
+    x2 = (width * boxes[:, 0] + width * boxes[:, 2] / 2).astype(np.int64)
+    y2 = (height * boxes[:, 1] + height * boxes[:, 3] / 2).astype(np.int64)
+    colors = np.array([get_class_color(c) for c in class_ids], dtype=np.uint8).reshape(-1, 3)
+
+    # horizontal edges, then vertical edges, each clipped to the image
+    for ys in (y1, y2):
+        xs, owners = _ranges(np.maximum(x1, 0), np.minimum(x2, width - 1))
+        visible = (ys[owners] >= 0) & (ys[owners] < height)
+        image[ys[owners][visible], xs[visible]] = colors[owners][visible]
+    for xs in (x1, x2):
+        ys, owners = _ranges(np.maximum(y1, 0), np.minimum(y2, height - 1))
+        visible = (xs[owners] >= 0) & (xs[owners] < width)
+        image[ys[visible], xs[owners][visible]] = colors[owners][visible]
+    return image
+
+
+def make_contact_sheet(images, columns, rows):
+    """Returns an array tiling up to columns x rows images in row-major order. Images are scaled to the size of the first."""
+    height, width = images[0].shape[:2]
+    sheet = np.zeros((height * rows, width * columns, 3), dtype=np.uint8)
+    for i, image in enumerate(images[:columns * rows]):
+        if image.shape[:2] != (height, width):
+            image = np.asarray(Image.fromarray(image).resize((width, height), Image.NEAREST))
+        row, column = divmod(i, columns)
+        sheet[row*height:(row+1)*height, column*width:(column+1)*width] = image
+    return sheet
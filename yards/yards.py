@@ -12,44 +12,102 @@ Uses distribution curves to place sprites and create bounding boxes.
 import os
 import glob
 import shutil
+import time
+import itertools
+import socket
+import concurrent.futures
 import yaml
 import tqdm
-from PIL import Image, ImageDraw
-from numpy.random import choice
-from numpy import unique
-from random import shuffle
+from PIL import Image
+import numpy as np
+from multiprocessing import cpu_count
 from .tools import _helper # import the helper module correctly
 from .tools import _validator
+from .tools import _parallel
+from .tools import _rng
+from .tools import _cache
+from .tools import _atlas
+from .tools import _metadata
+from .tools import _planner
+from .tools import _encoder
+from .tools import _shards
+from .tools import _manifest
+from .tools import _profiler
+from .tools import _compositor
+from .tools import _real_stats
+from .tools import _priors
+from .tools import _visualizer
+from .tools import _transfer
+from .tools import _dataset_index
+from .tools import _pack
+from .tools import _filters
+from .tools import _coordinator
 
 class yards():
 
     def __init__(self, config_path = None):
         '''Initializing a yards object'''
+        self._config_path = None
+        self._config = None
+        self._dirs = None
+        self._params = None
+        self._classes = None
+        self._class_numbers = None
+        self._output_dirs = None
+        self._map_path_cache = None
+        self._sprite_path_cache = None
+        self._real_image_paths = None
+        self._real_label_paths = None
+        self._image_cache = None
+        self._transform_atlas = None
+        self._sprite_metadata = None
+        self._planner = None
+        self._compositor = None
+        self._filter_chain = None
+        self._real_stats = None
+        self._real_class_ids = None
+        self._output_format = {}
+        self._encoder = _encoder.Encoder()
+        self._shard_writers = None
+        self._manifest = None
+        self._dataset_index = None
+        self._work_queue = None
+
         if config_path != None:
             self.load_config_from_file(config_path)
-        else:
-            self._config_path = None
-            self._config = None
-            self._dirs = None
-            self._params = None
-            self._classes = None
-            self._class_numbers = None
-            self._output_dirs = None
-            self._map_path_cache = None
-            self._sprite_path_cache = None
-            self._real_image_paths = None
-            self._real_label_paths = None
+
+    def __getstate__(self):
+        '''Drops the open shard files when pickled for a worker process'''
+        state = self.__dict__.copy()
+        state['_shard_writers'] = None
+        state['_dataset_index'] = None
+        state['_work_queue'] = None
+        return state
 
     # Setting configurations and getters/setters
 
-    def _create_output_dirs(self):
-        '''Helper that creates output directories'''
-        if os.path.isdir(self._dirs['output']):
-            shutil.rmtree(self._dirs['output'])
-            os.mkdir(self._dirs['output'])
+    def _create_output_dirs(self, resume=False, keep=()):
+        '''Helper that creates output directories. When resuming, the existing output is kept, and otherwise everything but the keep files is removed.'''
+        if not resume and os.path.isdir(self._dirs['output']):
+            if keep:
+                for entry in os.scandir(self._dirs['output']):
+                    if entry.name in keep:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+            else:
+                shutil.rmtree(self._dirs['output'])
+                os.mkdir(self._dirs['output'])
 
-        os.mkdir(self._dirs['output'] +'images/')
-        os.mkdir(self._dirs['output'] +'labels/')
+        if self._is_sharding():
+            self._output_dirs = {'shards': self._dirs['output'] + 'shards/'}
+            os.makedirs(self._output_dirs['shards'], exist_ok=resume)
+            return
+
+        os.makedirs(self._dirs['output'] +'images/', exist_ok=resume)
+        os.makedirs(self._dirs['output'] +'labels/', exist_ok=resume)
 
         self._output_dirs = {
             'images_train': self._dirs['output'] + 'images/train/',
@@ -57,40 +115,201 @@ class yards():
             'labels_train': self._dirs['output'] + 'labels/train/',
             'labels_val': self._dirs['output'] + 'labels/val/'
         }
-        for out in self._output_dirs.values(): os.mkdir(out)
+        for out in self._output_dirs.values(): os.makedirs(out, exist_ok=resume)
+
+    def _load_config(self, resume=False, join=False, keep=()):
+        '''Parses the loaded configuration and prepares the output directory, resuming the run recorded in its manifest if asked to.
+            With join, the run is joined as one of its workers.'''
+        if join:
+            return self._join_run()
+        output_dir = self._config['directories']['output']
+        manifest = _manifest.Manifest(output_dir)
+        if resume:
+            # checked before the output directory is touched, since a run that can't be resumed would clear it
+            if self._config.get('output_format', {}).get('mode', 'files') == 'shards':
+                raise ValueError('Resuming is only supported when writing files.')
+            if not manifest.exists():
+                if os.path.isdir(output_dir) and os.listdir(output_dir):
+                    raise ValueError('{} has no manifest to resume the run from, so its output is kept. Start a new run in another directory.'.format(output_dir))
+                # there is nothing to resume, so the run starts from scratch
+                resume = False
+        if resume:
+            manifest.load()
+            # a run without a seed in its config resumes with the seed it was started with
+            if self._config['parameters'].get('seed') is None:
+                self._config['parameters']['seed'] = manifest.seed
+            elif self._config['parameters']['seed'] != manifest.seed:
+                raise ValueError('The seed differs from the seed of the run being resumed.')
+
+        self._parse_params()
+        self._create_output_dirs(resume, keep)
+
+        self._manifest = None
+        if resume:
+            if manifest.config_hash != _manifest.hash_config(self._config):
+                raise ValueError('The config differs from the config of the run being resumed.')
+            # the manifest's segments decide the number of images and the train/val split
+            self._params['num_images'] = manifest.num_images()
+            self._manifest = manifest
+        elif not self._is_sharding():
+            manifest.create(_manifest.hash_config(self._config), self._params['seed'], self._params['num_images'], self._params['num_train'])
+            self._manifest = manifest
+
+        # shards aren't resumable, so their index is only kept in memory
+        self._dataset_index = _dataset_index.DatasetIndex(self._dirs['output'], persist=not self._is_sharding())
+        if resume:
+            self._dataset_index.load()
+        else:
+            self._dataset_index.create()
+
+    def _join_run(self):
+        '''Loads the configuration as one of the workers of the run in the output directory.
+            The first worker starts the run, and the workers after it resume the run, with its seed.'''
+        if self._config.get('output_format', {}).get('mode', 'files') == 'shards':
+            raise ValueError('Workers are only supported when writing files.')
+        output_dir = self._config['directories']['output']
+        os.makedirs(output_dir, exist_ok=True)
+        self._work_queue = _coordinator.WorkQueue(output_dir)
+        try:
+            # the run is started by one worker at a time, so that none of them clears the output of another
+            with self._work_queue.transaction():
+                is_started = _manifest.Manifest(output_dir).exists()
+                if not is_started:
+                    self._load_config(keep=_coordinator.QUEUE_FILENAMES)
+                    self._work_queue.reset()
+            if is_started:
+                self._load_config(resume=True)
+        except BaseException:
+            self._work_queue.close()
+            self._work_queue = None
+            raise
 
     def _parse_params(self):
         '''Parses all_params dictionary into separate dictionaries'''
         self.set_directories(self._config['directories'])
         self.set_parameters(self._config['parameters'])
         self.set_classes(self._config['classes'])
+        self.set_output_format(self._config.get('output_format', {}))
 
     def _cache_paths(self):
         '''Caches all the params into separate dictionaries'''
-        self._map_path_cache = glob.glob(self._dirs['maps']+'*.png')
+        # packed libraries are listed from their index instead of the directory
+        packs = self._open_packs() if self._params.get('use_packs', False) else {'maps': None, 'sprites': None}
+        # paths are sorted so that seeded runs don't depend on the filesystem's listing order
+        if packs['maps'] is not None:
+            self._map_path_cache = packs['maps'].paths()
+        else:
+            self._map_path_cache = sorted(glob.glob(self._dirs['maps']+'*.png'))
         self._sprite_path_cache = {}
         for c in self._classes:
-            self._sprite_path_cache[c] = glob.glob(self._dirs['sprites']+'{}/*.png'.format(c))
+            if packs['sprites'] is not None:
+                self._sprite_path_cache[c] = packs['sprites'].paths(c)
+            else:
+                self._sprite_path_cache[c] = sorted(glob.glob(self._dirs['sprites']+'{}/*.png'.format(c)))
         
         if 'real' in self._dirs:
-            self._real_image_paths = glob.glob(self._dirs['real']+'images/*.png')
+            self._real_image_paths = sorted(glob.glob(self._dirs['real']+'images/*.png'))
             self._real_label_paths = {os.path.splitext(os.path.split(filepath)[1])[0]: filepath for filepath in glob.glob(self._dirs['real']+'labels/*.txt')}
-            shuffle(self._real_image_paths)
+            _rng.shuffle(self._params['seed'], self._real_image_paths, 0)
 
-    def load_config_from_file(self, config_path):
-        '''Loads configuration from a file'''
+        # decode as many backgrounds and sprites up front as the budget holds, and the rest as they are drawn
+        cache_size_mb = self._params.get('cache_size_mb', 512)
+        self._image_cache = _cache.ImageCache(-1 if cache_size_mb == -1 else cache_size_mb * 2**20, packs.values())
+        self._image_cache.preload(self._map_path_cache + [path for c in self._classes for path in self._sprite_path_cache[c]])
+
+        sprite_paths = [path for c in self._classes for path in self._sprite_path_cache[c]]
+        # with a viewport, images are the size of the window shown from each map
+        viewport = tuple(self._params['viewport']) if self._params.get('viewport') is not None else None
+        map_sizes = [self._image_cache.get_size(path) for path in self._map_path_cache]
+        map_dims = sorted(set((min(w, viewport[0]), min(h, viewport[1])) if viewport is not None else (w, h) for w, h in map_sizes))
+
+        self._transform_atlas = None
+        if self._params['transform_sprites'] and self._params.get('precompute_transforms', False):
+            print('Precomputing sprite transforms...')
+            self._transform_atlas = _atlas.TransformAtlas()
+            self._transform_atlas.build(self._image_cache, sprite_paths, map_dims)
+            print('Finished precomputing transforms for {} sprites.'.format(len(self._transform_atlas)))
+
+        # only clipped sprites need their transparency quadrants
+        self._sprite_metadata = None
+        if self._params['clip_sprites']:
+            self._sprite_metadata = _metadata.SpriteMetadata()
+            if self._params.get('persist_sprite_metadata', False):
+                self._sprite_metadata.load(self._dirs['sprites'])
+            self._sprite_metadata.build(self._image_cache, sprite_paths, map_dims, self._params['transform_sprites'], self._transform_atlas, packs['sprites'])
+            if self._params.get('persist_sprite_metadata', False):
+                self._sprite_metadata.save(self._dirs['sprites'])
+
+        # the numpy renderer keeps the arrays of backgrounds and sprites in the image cache, within its budget
+        self._compositor = None
+        if self._params.get('renderer', 'pil') == 'numpy':
+            self._compositor = _compositor.Compositor(self._image_cache)
+
+        self._filter_chain = _filters.FilterChain(self._params['filters']) if self._params.get('filters') else None
+
+        # sprites are sized and placed like the real labels with the learned placement scheme
+        priors = None
+        if self._params.get('placement_scheme', 'uniform') == 'learned':
+            if self._real_stats is None:
+                self._real_stats = _real_stats.get_real_stats(self._dirs['real'])
+            real_class_ids = self._params.get('real_class_ids') or self._real_class_ids or {}
+            priors = _priors.PlacementPriors.from_real_stats(self._real_stats, [real_class_ids.get(c) for c in self._classes])
+            missing = [c for c, has_prior in zip(self._classes, priors.has_prior) if not has_prior]
+            if missing:
+                print('No real labels to learn placements from for {}, which are placed uniformly.'.format(', '.join(missing)))
+
+        self._planner = _planner.Planner(self._classes, self._class_numbers, self._params['classification_scheme'], self._params['max_sprites_per_class'],
+                                         self._map_path_cache, map_sizes,
+                                         self._sprite_path_cache, {path: self._image_cache.get_size(path) for path in sprite_paths},
+                                         self._params['transform_sprites'], self._params['clip_sprites'], self._get_map_weights(), viewport, priors,
+                                         self._params.get('max_overlap'), self._sprite_metadata)
+
+    def _open_packs(self):
+        '''Returns the packs of the maps and sprites directories, which are None for a directory that hasn't been packed'''
+        packs = {}
+        for key in ('maps', 'sprites'):
+            pack = _pack.SpritePack.open(self._dirs[key])
+            if pack is None:
+                print('No pack in {0}, so its files are read instead. Run yards --pack {0} to pack it.'.format(self._dirs[key]))
+            else:
+                # a pack that is out of date would serve the old pixels of changed images
+                stale = pack.get_stale_paths()
+                if stale:
+                    print('{} images in {} changed since it was packed, so it is packed again.'.format(len(stale), self._dirs[key]))
+                    try:
+                        pack, _ = _pack.build_pack(self._dirs[key])
+                    except OSError:
+                        print('{} could not be packed again, so its files are read instead.'.format(self._dirs[key]))
+                        pack = None
+            packs[key] = pack
+        return packs
+
+    def _get_map_weights(self):
+        '''Returns the weight of each map from the background_weights parameter, which defaults to 1 for unlisted maps, or None for uniform backgrounds'''
+        background_weights = self._params.get('background_weights')
+        if not background_weights:
+            return None
+        return [float(background_weights.get(os.path.split(path)[1], 1.0)) for path in self._map_path_cache]
+
+    def _group_tasks_by_background(self, tasks):
+        '''Returns the (count, is_train) tasks stably sorted by their background, so that chunks of tasks share backgrounds'''
+        backgrounds = self._planner.backgrounds(self._params['seed'], [count for count, _ in tasks])
+        return [tasks[i] for i in np.argsort(backgrounds, kind='stable')]
+
+    def load_config_from_file(self, config_path, resume=False, join=False):
+        '''Loads configuration from a file. With resume, a run previously started in the output directory is continued.
+            With join, the run in the output directory is joined as one of several workers, which generate it with work().'''
         self._config_path = config_path
         with open(r'{}'.format(self._config_path)) as file:
             self._config = yaml.load(file, Loader=yaml.FullLoader)
-        self._parse_params()
-        self._create_output_dirs()
+        self._load_config(resume, join)
 
-    def set_config(self, config):
-        '''Sets a configuration from a dictionary'''
+    def set_config(self, config, resume=False, join=False):
+        '''Sets a configuration from a dictionary. With resume, a run previously started in the output directory is continued.
+            With join, the run in the output directory is joined as one of several workers, which generate it with work().'''
         if _validator.validate_config(config):
             self._config = config
-            self._parse_params()
-            self._create_output_dirs()
+            self._load_config(resume, join)
         else:
             print('Configuration is not valid')
 
@@ -113,18 +332,21 @@ class yards():
         '''Sets the parameters'''
         if _validator.validate_parameters(parameters, 'real' in self._dirs):
             self._params = parameters
+            if self._params.get('seed') is None:
+                self._params['seed'] = _rng.new_seed()
             self._params['num_train'] = int(self._params['train_size'] * self._params['num_images'])
         else:
             print('Parameters are not valid')
 
     def get_parameters(self):
         '''Returns the parameters'''
-        return self._parameters
+        return self._params
 
     def set_classes(self, classes):
         '''Sets the classes'''
         if _validator.validate_classes(classes, self._params['classification_scheme']):
             if self._params['classification_scheme'] == 'mimic-real':
+                self._real_class_ids = classes
                 self.approximate_frequency_spaces_from_real_data(classes)
             else:
                 self._classes = classes
@@ -150,153 +372,698 @@ class yards():
         '''Returns the classes'''
         return self._classes
 
+    def set_output_format(self, output_format):
+        '''Sets the output image format'''
+        if _validator.validate_output_format(output_format):
+            self._output_format = output_format
+            self._encoder = _encoder.Encoder(output_format)
+        else:
+            print('Output format is not valid')
+
+    def enable_profiling(self, exporter=None):
+        '''Turns on the timers and counters of the generation stages. The exporter, if given, is called with the report at the end of every loop and visualization.'''
+        _profiler.enable()
+        if exporter is not None:
+            _profiler.add_exporter(exporter)
+
+    def disable_profiling(self):
+        '''Turns off the timers and counters of the generation stages'''
+        _profiler.disable()
+
+    def get_profile(self):
+        '''Returns the report of the timers and counters recorded so far'''
+        return _profiler.report()
+
     def approximate_frequency_spaces_from_real_data(self, class_ids):
         """Approximates frequency spaces by analyzing real samples."""
-        # set up some local variables
-        real_samples_labels_dir = self._dirs['real'] + "labels/"
-        real_samples_labels_paths = glob.glob(real_samples_labels_dir + "*.txt")
-        num_samples = len(real_samples_labels_paths)
-        classes = {num: [] for num in class_ids.values()}
-        print("Approximating frequency spaces from {num} samples...".format(num = num_samples))
-        # read in class info
-        for path in tqdm.tqdm(real_samples_labels_paths):
-            for c in classes: classes[c].append(0)
-            with open(path, "r") as file:
-                for line in file:
-                    class_id = int([float(i) for i in line.split()][0])
-                    if class_id in classes:
-                        classes[class_id][-1] += 1
-
-        # analyze frequencies
-        for c in class_ids:
-            class_id = class_ids[c]
-            classes[class_id] = list(unique(classes[class_id], return_counts = True))
-            total = sum(classes[class_id][1])
-            classes[class_id][1] = [num / total for num in classes[class_id][1]]
-            classes[class_id][0] = list(classes[class_id][0])
-            classes[c] = classes[class_id]
-            del classes[class_id]
-
+        # the scan is cached next to the real labels, so it only runs again when they change
+        self._real_stats = _real_stats.get_real_stats(self._dirs['real'])
+        print("Approximating frequency spaces from {num} samples...".format(num = self._real_stats.num_files))
+        self._classes = {c: self._real_stats.get_frequency_space(class_ids[c]) for c in class_ids}
         print("Finished approximating frequency spaces.")
 
-        self._classes = classes
+    def plan(self, counts):
+        """Returns the placement plan for the images with the given indices."""
+        with _profiler.stage('plan'):
+            return self._planner.plan(self._params['seed'], counts)
 
-    def _create_image(self, count, output_dir):
-        '''Creates an image'''
-        background_image = Image.open(choice(self._map_path_cache))
-        new_image = background_image.copy().convert('RGBA')
-        map_dim = new_image.size
-        background_image.close()
+    def _get_sprite(self, sprite_path, transform_index, map_dim):
+        """Returns the planned transform variant of a sprite. The image may be shared, so it must not be modified."""
+        with _profiler.stage('sprite_load'):
+            sprite = self._image_cache.get(sprite_path) if self._transform_atlas is None else self._transform_atlas.get(sprite_path, transform_index, map_dim)
+        if self._transform_atlas is None and transform_index != 0:
+            with _profiler.stage('transform'):
+                sprite = _helper.apply_transform(sprite, _helper.get_transform_operations(transform_index), map_dim)
+        return sprite
+
+    def _get_edge_crop(self, sprite_path, transform_index, sprite_dim, map_dim, sprite_pos, sprite=None):
+        """Returns the box a clipped sprite is cropped to and its new position. The sprite is only needed if its transparency quadrants weren't precomputed."""
+        _profiler.count('edge_handler_calls')
+        with _profiler.stage('edge_handler'):
+            transparencies = self._sprite_metadata.get_transparencies(sprite_path, transform_index) if self._sprite_metadata is not None else None
+            if transparencies is None:
+                if sprite is None:
+                    sprite = self._get_sprite(sprite_path, transform_index, map_dim)
+                transparencies = _helper._get_transparencies(sprite)
+            return _helper.get_edge_crop(map_dim, sprite_dim, sprite_pos, transparencies)
+
+    def _get_background(self, index):
+        """Returns the decoded background with the given map index, as an RGB array for the numpy renderer.
+            The background is shared, so it must not be modified."""
+        path = self._map_path_cache[index]
+        if self._compositor is None:
+            return self._image_cache.get(path)
+        background = self._compositor.get_background(path)
+        if background is None:
+            background = self._compositor.add_background(path, self._image_cache.get(path))
+        return background
+
+    def _copy_window(self, background, image):
+        """Returns a copy of the window of a background that the planned image shows, which is the whole background without a viewport."""
+        left, top, width, height = (int(image[key]) for key in ('left', 'top', 'width', 'height'))
+        if isinstance(background, np.ndarray):
+            return background[top:top+height, left:left+width].copy()
+        if (width, height) == background.size:
+            return background.copy()
+        return background.crop((left, top, left+width, top+height))
+
+    def _create_instance_buffer(self, map_dim):
+        """Returns an empty instance buffer for an image and a list for the number of pixels drawn of each labeled sprite,
+            or None and None if visible boxes aren't measured."""
+        if self._params.get('min_visibility') is None:
+            return None, None
+        return np.zeros((map_dim[1], map_dim[0]), dtype=np.int32), []
+
+    def _get_visible_boxes(self, instances, drawn, bbox_cache, map_dim):
+        """Returns the bounding boxes shrunk to the visible pixels of their sprites, with the visible fraction of each sprite appended.
+            A sprite that is hidden entirely keeps its box, with a visible fraction of 0."""
+        with _profiler.stage('instances'):
+            boxes, visible = _compositor.get_instance_boxes(instances, len(bbox_cache))
+            visible_cache = []
+            for (class_number, *bbox), (left, top, right, bottom), num_visible, num_drawn in zip(bbox_cache, boxes.tolist(), visible.tolist(), drawn):
+                if num_visible > 0:
+                    bbox = _helper.get_bbox(map_dim, (right - left, bottom - top), (left, top))
+                visible_cache.append((class_number, *bbox, num_visible / num_drawn if num_drawn else 0.0))
+        return visible_cache
+
+    def _filter_occluded(self, bbox_cache):
+        """Applies min_visibility to bounding boxes with visible fractions. Returns the boxes to label and the (row, visible fraction)
+            of the occluded boxes among them, which are dropped unless occluded_boxes is 'flag'."""
+        min_visibility = self._params.get('min_visibility')
+        if min_visibility is None:
+            return bbox_cache, []
+        if self._params.get('occluded_boxes', 'drop') == 'flag':
+            return [bbox[:5] for bbox in bbox_cache], [(row, bbox[5]) for row, bbox in enumerate(bbox_cache) if bbox[5] < min_visibility]
+        return [bbox[:5] for bbox in bbox_cache if bbox[5] >= min_visibility and bbox[5] > 0], []
+
+    def _apply_filters(self, pixels, count):
+        """Returns the pixels of the image with index count with the filter chain applied."""
+        with _profiler.stage('filter'):
+            return self._filter_chain.apply(pixels, _rng.filter_rng(self._params['seed'], count))
 
-        # get the sprite paths
-        sprite_paths = _helper.gather_sprite_paths(self._sprite_path_cache, (self._classes, self._class_numbers), self._params['classification_scheme'], self._params['max_sprites_per_class'])
+    def _render_image(self, image, placements, background=None):
+        """Draws the planned sprites on the planned background, which is looked up unless it is given.
+            Returns the image and its bounding boxes."""
+        if self._compositor is not None:
+            new_image, bbox_cache = self._render_array(image, placements, background)
+            return Image.fromarray(new_image), bbox_cache
+
+        with _profiler.stage('background'):
+            new_image = self._copy_window(background if background is not None else self._get_background(image['background']), image)
+        map_dim = new_image.size
         bbox_cache = []
+        instances, drawn = self._create_instance_buffer(map_dim)
 
         # add the sprites to the new image, saving the bounding box information in a cache
-        for sprite_path in sprite_paths:
-            sprite = Image.open(sprite_path).convert('RGBA')
-            if self._params['transform_sprites']:
-                sprite = _helper.transform_sprite(sprite, map_dim)
+        for placement in placements:
+            sprite_path = self._planner.sprite_paths[placement['sprite']]
+            transform_index = int(placement['transform'])
+            sprite = self._get_sprite(sprite_path, transform_index, map_dim)
             sprite_dim = sprite.size
 
-            sprite_pos, is_sprite_clipped = _helper.get_sprite_pos(map_dim, sprite_dim, self._params['clip_sprites'])
-            if is_sprite_clipped:
-                sprite, sprite_dim, sprite_pos = _helper.edge_handler(map_dim, sprite_dim, sprite_pos, sprite)
+            sprite_pos = (int(placement['x']), int(placement['y']))
+            if placement['clipped']:
+                box, sprite_pos = self._get_edge_crop(sprite_path, transform_index, sprite_dim, map_dim, sprite_pos, sprite)
+                if box != (0, 0) + sprite_dim:
+                    sprite = sprite.crop(box)
+                sprite_dim = sprite.size
 
-            new_image = _helper.draw_sprite_to_background(sprite, new_image, sprite_pos)
-            sprite.close()
+            with _profiler.stage('composite'):
+                new_image = _helper.draw_sprite_to_background(sprite, new_image, sprite_pos)
+                if instances is not None:
+                    # unlabeled sprites are drawn as background, so they occlude the sprites below them
+                    instance_id = len(bbox_cache) + 1 if placement['class_number'] != -1 else 0
+                    num_drawn = _compositor.draw_instance(instances, np.asarray(sprite.getchannel('A')) > 0, (0, 0) + sprite_dim, sprite_pos, instance_id)
+            _profiler.count('sprites_placed')
             bbox = _helper.get_bbox(map_dim, sprite_dim, sprite_pos)
-            if sprite_paths[sprite_path] != -1:
-                bbox_cache.append((sprite_paths[sprite_path], *bbox))
+            if placement['class_number'] != -1:
+                bbox_cache.append((int(placement['class_number']), *bbox))
+                if instances is not None:
+                    drawn.append(num_drawn)
+
+        if instances is not None:
+            bbox_cache = self._get_visible_boxes(instances, drawn, bbox_cache, map_dim)
+        if self._filter_chain is not None:
+            filtered = Image.fromarray(self._apply_filters(np.asarray(new_image), image['count']))
+            # keep the color profile, which the encoder embeds
+            filtered.info.update(new_image.info)
+            new_image = filtered
+        return new_image, bbox_cache
+
+    def _render_array(self, image, placements, background=None):
+        """Draws the planned sprites on the planned background, which is looked up unless it is given.
+            Returns the image as an (height, width, 3) array and its bounding boxes."""
+        if self._compositor is None:
+            new_image, bbox_cache = self._render_image(image, placements, background)
+            return np.asarray(new_image.convert('RGB')), bbox_cache
+
+        with _profiler.stage('background'):
+            new_image = self._copy_window(background if background is not None else self._get_background(image['background']), image)
+        map_dim = (new_image.shape[1], new_image.shape[0])
+        bbox_cache = []
+        instances, drawn = self._create_instance_buffer(map_dim)
+
+        # draw every sprite into the same array, saving the bounding box information in a cache
+        for placement in placements:
+            sprite_path = self._planner.sprite_paths[placement['sprite']]
+            transform_index = int(placement['transform'])
+            arrays = self._compositor.get_sprite(sprite_path, transform_index)
+            if arrays is None:
+                arrays = self._compositor.add_sprite(sprite_path, transform_index, self._get_sprite(sprite_path, transform_index, map_dim))
+            sprite_dim = (arrays.rgb.shape[1], arrays.rgb.shape[0])
 
-        # save and close the image
-        new_image.save('{}{}-{}.png'.format(output_dir, self._params['game_title'], count))
-        new_image.close()
+            box, sprite_pos = (0, 0) + sprite_dim, (int(placement['x']), int(placement['y']))
+            if placement['clipped']:
+                box, sprite_pos = self._get_edge_crop(sprite_path, transform_index, sprite_dim, map_dim, sprite_pos)
+                sprite_dim = (box[2] - box[0], box[3] - box[1])
+
+            with _profiler.stage('composite'):
+                _compositor.composite(new_image, arrays, box, sprite_pos)
+                if instances is not None:
+                    instance_id = len(bbox_cache) + 1 if placement['class_number'] != -1 else 0
+                    num_drawn = _compositor.draw_instance(instances, arrays.mask, box, sprite_pos, instance_id)
+            _profiler.count('sprites_placed')
+            bbox = _helper.get_bbox(map_dim, sprite_dim, sprite_pos)
+            if placement['class_number'] != -1:
+                bbox_cache.append((int(placement['class_number']), *bbox))
+                if instances is not None:
+                    drawn.append(num_drawn)
+
+        if instances is not None:
+            bbox_cache = self._get_visible_boxes(instances, drawn, bbox_cache, map_dim)
+        if self._filter_chain is not None:
+            new_image = self._apply_filters(new_image, image['count'])
+        return new_image, bbox_cache
+
+    def _render_samples(self, counts):
+        """Renders the images with the given indices in memory. Returns a list of (image, boxes, class_ids) samples."""
+        samples = []
+        for image, placements in self.plan(counts):
+            new_image, bbox_cache = self._render_array(image, placements)
+            bbox_cache, _ = self._filter_occluded(bbox_cache)
+            boxes = np.array([bbox[1:] for bbox in bbox_cache], dtype=np.float32).reshape(-1, 4)
+            class_ids = np.array([bbox[0] for bbox in bbox_cache], dtype=np.int64)
+            samples.append((new_image, boxes, class_ids))
+        return samples
+
+    def stream(self, n=None, start=1, num_workers=0, chunk_size=8, prefetch=2):
+        """Yields (image, boxes, class_ids) samples rendered in memory, without encoding or touching the disk.
+
+        image is an (height, width, 3) uint8 array, boxes is an (N, 4) array of YOLO-style relative
+        (x_center, y_center, width, height) boxes and class_ids is an (N,) array of class numbers.
+        Yields n samples, or samples forever if n is None, for the image indices starting at start, so a
+        seeded stream yields the same images that loop() writes. With num_workers processes, chunks of
+        chunk_size images are rendered in the background, keeping prefetch chunks per worker queued.
+        """
+        counts = itertools.count(start) if n is None else range(start, start+n)
+        chunks = _parallel.chunk_iter(counts, chunk_size)
+        if num_workers <= 0:
+            for chunk in chunks:
+                yield from self._render_samples(chunk)
+        else:
+            for samples in _parallel.imap_bounded(self, '_render_samples', chunks, num_workers, num_workers * prefetch):
+                yield from samples
+
+    def _create_image(self, image, placements, output_dir, background=None):
+        '''Creates the planned image. Returns its boxes and a future of the size and sha1 hash of the saved image.'''
+        new_image, bbox_cache = self._render_image(image, placements, background)
+
+        # hand the image to the encoder, which may save it on another thread
+        with _profiler.stage('encode'):
+            encoded = self._encoder.submit(new_image, '{}{}-{}{}'.format(output_dir, self._params['game_title'], image['count'], self._encoder.extension))
 
         # return the cache
-        return bbox_cache
+        return bbox_cache, encoded
+
+    def _format_annotation(self, bbox_cache):
+        """Returns the text of a dataset label."""
+        return ''.join('{} {} {} {} {}\n'.format(*bbox) for bbox in bbox_cache)
 
     def _create_annotation(self, bbox_cache, count, output_dir):
-        """Creates a dataset label at the desired directory."""
-        with open('{}{}-{}.txt'.format(output_dir, self._params['game_title'], count), 'w') as file:
-            for bbox in bbox_cache:
-                file.write('{} {} {} {} {}\n'.format(*bbox))
-
-    def _create_image_and_annotate(self, count):
-        bbox_cache = self._create_image(count, self._output_dirs['images_train'] if count <= self._params['num_train'] else self._output_dirs['images_val'])
-        self._create_annotation(bbox_cache, count, self._output_dirs['labels_train'] if count <= self._params['num_train'] else self._output_dirs['labels_val'])
-        return None
+        """Creates a dataset label at the desired directory and returns its bytes."""
+        with _profiler.stage('annotation'):
+            label = self._format_annotation(bbox_cache).encode()
+            with open('{}{}-{}.txt'.format(output_dir, self._params['game_title'], count), 'wb') as file:
+                file.write(label)
+        _profiler.count('bytes_written', len(label))
+        return label
+
+    def _is_sharding(self):
+        """Returns true if samples are packed into tar shards instead of written as separate files."""
+        return self._output_format.get('mode', 'files') == 'shards'
+
+    def _create_image_and_annotate(self, image, placements, is_train, background=None):
+        """Creates a planned image and its annotation in the train or val directories, and returns the class numbers of its boxes
+            and the (row, visible fraction) of its flagged occluded boxes, along with the future of its encoded image and the bytes of
+            its label for the manifest. When sharding, the encoded sample is returned instead, for the main process to write."""
+        if self._is_sharding():
+            new_image, bbox_cache = self._render_image(image, placements, background)
+            bbox_cache, occluded = self._filter_occluded(bbox_cache)
+            with _profiler.stage('encode'):
+                members = [(self._encoder.extension, self._encoder.encode_bytes(new_image)), ('.txt', self._format_annotation(bbox_cache).encode())]
+            return ('{}-{}'.format(self._params['game_title'], image['count']), is_train, members), [bbox[0] for bbox in bbox_cache], occluded, None
+
+        bbox_cache, encoded = self._create_image(image, placements, self._output_dirs['images_train'] if is_train else self._output_dirs['images_val'], background)
+        bbox_cache, occluded = self._filter_occluded(bbox_cache)
+        label = self._create_annotation(bbox_cache, image['count'], self._output_dirs['labels_train'] if is_train else self._output_dirs['labels_val'])
+        return None, [bbox[0] for bbox in bbox_cache], occluded, (encoded, label)
+
+    def _create_images(self, tasks):
+        """Creates and annotates a chunk of (count, is_train) images.
+            Returns the image cache counters for the chunk, the dataset index entries and, when sharding, the samples to write."""
+        before = self._image_cache.stats()
+        plan = self.plan([count for count, _ in tasks])
+        if self._params.get('group_by_background', False):
+            # render the images of each background from one base image, keeping the samples in task order
+            images = list(plan)
+            order = np.argsort(plan.images['background'], kind='stable')
+            results = [None] * len(tasks)
+            for background_index, group in itertools.groupby(order, key=lambda i: plan.images['background'][i]):
+                with _profiler.stage('background'):
+                    background = self._get_background(background_index)
+                for i in group:
+                    results[i] = self._create_image_and_annotate(*images[i], tasks[i][1], background)
+        else:
+            results = [self._create_image_and_annotate(image, placements, is_train) for (image, placements), (_, is_train) in zip(plan, tasks)]
+        samples = [sample for sample, _, _, _ in results if sample is not None]
+        indexed = [(count, is_train, '{}-{}{}'.format(self._params['game_title'], count, self._encoder.extension), class_ids, occluded)
+                   for (count, is_train), (_, class_ids, occluded, _) in zip(tasks, results)]
+        with _profiler.stage('encode'):
+            self._encoder.flush()
+        after = self._image_cache.stats()
+        _profiler.count('images', len(tasks))
+        _profiler.count('cache_hits', after['hits'] - before['hits'])
+        _profiler.count('cache_misses', after['misses'] - before['misses'])
+
+        # the manifest records the size and checksum of each image followed by its label, from the bytes that were written
+        completed = []
+        if self._manifest is not None:
+            for (count, is_train), (_, _, _, (encoded, label)) in zip(tasks, results):
+                size, checksum = encoded.result()
+                checksum.update(label)
+                completed.append((count, is_train, size + len(label), checksum.hexdigest()))
+        return {'cache_stats': {key: after[key] - before[key] for key in ('hits', 'misses', 'evictions')}, 'samples': samples, 'indexed': indexed, 'completed': completed}
+
+    def _open_shard_writers(self):
+        """Opens a shard writer for each split."""
+        shards_dir = self._dirs['output'] + 'shards/'
+        os.makedirs(shards_dir, exist_ok=True)
+        shard_size = self._output_format.get('shard_size', 1000)
+        shard_name = self._output_format.get('shard_name', _shards.DEFAULT_SHARD_NAME)
+        self._shard_writers = {split: _shards.ShardWriter(shards_dir, split, shard_size, shard_name, self._params['game_title']) for split in ('train', 'val')}
+
+    def _close_shard_writers(self):
+        """Closes the shard writers of each split."""
+        for writer in self._shard_writers.values():
+            writer.close()
+        print('Packed {} train and {} val samples into shards.'.format(self._shard_writers['train'].num_samples, self._shard_writers['val'].num_samples))
+        self._shard_writers = None
+
+    def _write_samples(self, samples):
+        """Writes (key, is_train, members) samples into the shards."""
+        for key, is_train, members in samples:
+            with _profiler.stage('shard_write'):
+                self._shard_writers['train' if is_train else 'val'].write(key, members)
+            _profiler.count('bytes_written', sum(len(data) for _, data in members))
+
+    def _is_mixing(self):
+        """Returns true if real images are mixed into the output."""
+        return ('real' in self._dirs) and (self._params['mix_size'] != -1)
+
+    def _get_segments(self):
+        """Returns the [start, stop, num_train] index segments of the run. Every segment after the first was appended."""
+        if self._manifest is not None:
+            return self._manifest.segments
+        return [[1, self._params['num_images'], self._params['num_train']]]
+
+    def _get_index_plan(self):
+        """Splits the output indices between real and synthetic images.
+            Returns a list of (src_image_path, count, is_train) real tasks and a list of (count, is_train) synthetic tasks."""
+        segments = self._get_segments()
+        _, num_images, num_train = segments[0]
+        # appended segments only hold synthetic images, since every real image is placed in the first segment
+        appended_tasks = [(count, count < start + segment_train) for start, stop, segment_train in segments[1:] for count in range(start, stop+1)]
+        if not self._is_mixing():
+            return [], [(count, count <= num_train) for count in range(1, 1+num_images)] + appended_tasks
+
+        # local variables
+        data_indices = [i for i in range(1, 1+num_images)] # create indices for output images/labels
+        train_indices = data_indices[:num_train]
+        valid_indices = data_indices[num_train:]
+        _rng.shuffle(self._params['seed'], train_indices, 1)
+        _rng.shuffle(self._params['seed'], valid_indices, 2)
+
+        # get number of images for train/valid and real/synt
+        n = len(self._real_image_paths) # number of real images
+        num_train_real = int(n * self._params['mix_size'])   # get number of real images -> train set
+        num_valid_real = min(len(valid_indices), n - num_train_real)    # number of real images -> val set should be the minimum of num_valid_indices and the remaining number of real images
+        num_train_real += (n - num_train_real - num_valid_real)
+
+        # split train_indices and valid_indices
+        real_indices = train_indices[:num_train_real] + valid_indices[:num_valid_real]
+        synt_train_indices = train_indices[num_train_real:]
+        synt_valid_indices = valid_indices[num_valid_real:]
+
+        real_tasks = [(self._real_image_paths[i], real_indices[i], i < num_train_real) for i in range(len(real_indices))]
+        synt_tasks = [(count, True) for count in synt_train_indices] + [(count, False) for count in synt_valid_indices] + appended_tasks
+        return real_tasks, synt_tasks
+
+    def _get_pending_tasks(self):
+        """Returns the real and synthetic tasks of the index plan that the manifest doesn't record as completed."""
+        real_tasks, synt_tasks = self._get_index_plan()
+        if self._manifest is None or not self._manifest.completed:
+            return real_tasks, synt_tasks
+
+        # an index only counts as completed if its files are still there with the recorded size
+        def is_completed(count, is_train, extension):
+            entry = self._manifest.completed.get(count)
+            if entry is None or entry[0] != is_train:
+                return False
+            paths = self._get_sample_paths(count, is_train, extension)
+            return all(os.path.isfile(path) for path in paths) and sum(os.path.getsize(path) for path in paths) == entry[1]
+
+        pending_real = [task for task in real_tasks if not is_completed(task[1], task[2], os.path.splitext(task[0])[1])]
+        pending_synt = [task for task in synt_tasks if not is_completed(task[0], task[1], self._encoder.extension)]
+        print('Skipping {} completed images.'.format(len(real_tasks) + len(synt_tasks) - len(pending_real) - len(pending_synt)))
+        return pending_real, pending_synt
+
+    def _get_scheduled_tasks(self):
+        """Returns the pending real and synthetic tasks in the order they are generated.
+            With group_by_background, synthetic images are sorted by background unless their order decides the shards' contents."""
+        real_tasks, synt_tasks = self._get_pending_tasks()
+        if self._params.get('group_by_background', False) and not self._is_sharding():
+            synt_tasks = self._group_tasks_by_background(synt_tasks)
+        return real_tasks, synt_tasks
+
+    def append(self, num_images):
+        """Adds num_images new images after the existing ones, split between train and val by train_size. They are generated by the next loop."""
+        if self._manifest is None:
+            raise ValueError('Appending images is only supported when writing files.')
+        self._manifest.add_segment(num_images, int(self._params['train_size'] * num_images))
+        self._params['num_images'] = self._manifest.num_images()
+
+    def _get_sample_paths(self, count, is_train, extension):
+        """Returns the image and label paths of an output index."""
+        split = 'train' if is_train else 'val'
+        image_path = '{}{}-{}{}'.format(self._output_dirs['images_' + split], self._params['game_title'], count, extension)
+        label_path = '{}{}-{}.txt'.format(self._output_dirs['labels_' + split], self._params['game_title'], count)
+        return image_path, label_path
+
+    def _copy_real_sample(self, src_image_path, count, is_train):
+        """Transfers a real image and its corresponding label into the train or val directories.
+            Returns the manifest entry of the transfer when writing files, or the sample when writing shards,
+            along with the number of files that couldn't be linked and were copied instead, and the dataset index entry."""
+        key, extension = os.path.splitext(os.path.split(src_image_path)[1])
+        src_label_path = self._real_label_paths[key] # figure out corresponding label path
+        with _profiler.stage('real_copy'):
+            with open(src_label_path, 'rb') as label_file:
+                label = label_file.read()
+            indexed = (count, is_train, '{}-{}{}'.format(self._params['game_title'], count, extension), _visualizer.parse_label(label)[1].tolist())
+            if self._is_sharding():
+                # put image and corresponding label into the shards under the same key
+                with open(src_image_path, 'rb') as image_file:
+                    members = [(extension, image_file.read()), ('.txt', label)]
+                return ('{}-{}'.format(self._params['game_title'], count), is_train, members), 0, indexed
+            # put image and corresponding label into train or val
+            mode = self._params.get('real_copy_mode', 'copy')
+            dst_image_path, dst_label_path = self._get_sample_paths(count, is_train, extension)
+            linked = [_transfer.transfer_file(src_image_path, dst_image_path, mode), _transfer.transfer_file(src_label_path, dst_label_path, mode)]
+        if mode == 'copy' or not all(linked):
+            _profiler.count('bytes_written', os.path.getsize(dst_image_path) + os.path.getsize(dst_label_path))
+        if self._manifest is None:
+            return None, linked.count(False), indexed
+        if mode == 'copy':
+            return (count, is_train, *_manifest.checksum_files([dst_image_path, dst_label_path])), 0, indexed
+        # links share the source's bytes, so they're recorded by size alone rather than read back for a checksum
+        return (count, is_train, os.path.getsize(dst_image_path) + os.path.getsize(dst_label_path), 'linked'), linked.count(False), indexed
+
+    def _copy_real_chunk(self, executor, chunk):
+        """Transfers a chunk of real samples on the executor's threads. Returns their manifest entries or shard samples,
+            their dataset index entries and the number of files that were copied instead of linked."""
+        results, indexed, fallbacks = [], [], 0
+        for result, num_fallbacks, entry in executor.map(lambda task: self._copy_real_sample(*task), chunk):
+            results.append(result)
+            indexed.append(entry)
+            fallbacks += num_fallbacks
+        return results, indexed, fallbacks
+
+    def _copy_real_samples(self, real_tasks, chunk_size=256):
+        """Transfers all the real images and labels into the output directory on a pool of threads."""
+        n = len(real_tasks)
+        mode = self._params.get('real_copy_mode', 'copy')
+        print('Splitting {} real images into output directory ({})...'.format(n, mode))
+        fallbacks = 0
+        with concurrent.futures.ThreadPoolExecutor(self._params.get('real_copy_threads', 8)) as executor, tqdm.tqdm(total=n) as progress:
+            # a chunk at a time, so that shard samples aren't all read into memory ahead of being written
+            for chunk in _parallel.chunk_tasks(real_tasks, chunk_size):
+                results, indexed, num_fallbacks = self._copy_real_chunk(executor, chunk)
+                fallbacks += num_fallbacks
+                self._record_indexed(indexed)
+                if self._is_sharding():
+                    self._write_samples(results)
+                else:
+                    self._record_completed(results)
+                _profiler.count('real_images_copied', len(chunk))
+                progress.update(len(chunk))
+        _profiler.count('real_copy_fallbacks', fallbacks)
+        if fallbacks > 0:
+            print('Could not {} {} real files, so they were copied instead.'.format(mode, fallbacks))
+        print('Finished splitting {} real images into output directory.'.format(n))
+
+    def _create_images_in_chunks(self, tasks, chunk_size=64):
+        """Creates and annotates (count, is_train) images a chunk of planned images at a time."""
+        with tqdm.tqdm(total=len(tasks)) as progress_bar:
+            for chunk in _parallel.chunk_tasks(tasks, chunk_size):
+                result = self._create_images(chunk)
+                self._write_samples(result['samples'])
+                self._record_indexed(result['indexed'])
+                self._record_completed(result['completed'])
+                progress_bar.update(len(chunk))
+
+    def _record_indexed(self, entries):
+        """Adds samples to the dataset index. They're indexed before the manifest records them, so every completed index has an entry."""
+        if self._dataset_index is not None:
+            self._dataset_index.record(entries)
+
+    def _write_dataset_index(self):
+        """Writes the image lists, data.yaml and dataset stats of the output."""
+        with _profiler.stage('index'):
+            class_names = {n: c for c, n in self._class_numbers.items() if n != -1}
+            if self._is_sharding():
+                self._dataset_index.write(class_names)
+            else:
+                self._dataset_index.write(class_names, *({split: self._output_dirs[kind + '_' + split] for split in ('train', 'val')} for kind in ('images', 'labels')))
+        print('Indexed {} images in {}.'.format(len(self._dataset_index.entries), self._dirs['output']))
+
+    def _record_completed(self, entries):
+        """Logs completed indices in the manifest."""
+        if self._manifest is not None:
+            self._manifest.record(entries)
 
     def loop(self):
         """Creates the images."""
-        if ('real' in self._dirs) and (self._params['mix_size'] != -1):
-            # local variables
-            data_indices = [i for i in range(1, 1+self._params['num_images'])] # create indices for output images/labels
-            train_indices = data_indices[:self._params['num_train']]
-            valid_indices = data_indices[self._params['num_train']:]
-            shuffle(train_indices)
-            shuffle(valid_indices)
-
-            # get number of images for train/valid and real/synt
-            n = len(self._real_image_paths) # number of real images
-            num_train_real = int(n * self._params['mix_size'])   # get number of real images -> train set
-            num_valid_real = min(len(valid_indices), n - num_train_real)    # number of real images -> val set should be the minimum of num_valid_indices and the remaining number of real images
-            num_train_real += (n - num_train_real - num_valid_real)
-
-            # split train_indices and valid_indices
-            real_indices = train_indices[:num_train_real] + valid_indices[:num_valid_real]
-            synt_indices = train_indices[num_train_real:] + valid_indices[num_valid_real:]
-
+        if self._is_sharding():
+            self._open_shard_writers()
+        real_tasks, synt_tasks = self._get_scheduled_tasks()
+        if self._is_mixing():
             # real loop
-            split_index = num_train_real # split index for real images
-            n = len(real_indices)
-            print('Splitting {} real images into output directory...'.format(n))
-            for i in tqdm.tqdm(range(0, n)):
-                src_image_path = self._real_image_paths[i]
-                key = os.path.splitext(os.path.split(src_image_path)[1])[0]
-                src_label_path = self._real_label_paths[key] # figure out corresponding label path
-                count = real_indices[i]
-                if i < split_index:
-                    # put image and corresponding label into train
-                    dst_image_path = '{}{}-{}.png'.format(self._output_dirs['images_train'], self._params['game_title'], count)
-                    dst_label_path = '{}{}-{}.txt'.format(self._output_dirs['labels_train'], self._params['game_title'], count)
-                else:
-                    # put image and corresponding label into val
-                    dst_image_path = '{}{}-{}.png'.format(self._output_dirs['images_val'], self._params['game_title'], count)
-                    dst_label_path = '{}{}-{}.txt'.format(self._output_dirs['labels_val'], self._params['game_title'], count)
-                shutil.copyfile(src_image_path, dst_image_path)
-                shutil.copyfile(src_label_path, dst_label_path)
-            print('Finished splitting {} real images into output directory.'.format(n))
+            self._copy_real_samples(real_tasks)
 
             # synthetic loop
-            n = len(synt_indices)
-            split_index = len(train_indices[num_train_real:])
+            n = len(synt_tasks)
             print('Writing {} synthetic images...'.format(n))
-            for i in tqdm.tqdm(range(0, n)):
-                count = synt_indices[i]
-                bbox_cache = self._create_image(count, self._output_dirs['images_train'] if i < split_index else self._output_dirs['images_val'])
-                self._create_annotation(bbox_cache, count, self._output_dirs['labels_train'] if i < split_index else self._output_dirs['labels_val'])
+            self._create_images_in_chunks(synt_tasks)
             print('Finished writing {} synthetic images.'.format(n))
 
         else:
             # If there are no real images/labels provided.
-            print('Writing {} images...'.format(self._params['num_images']))
-            for count in tqdm.tqdm(range(1, 1+self._params['num_images'])):
-                bbox_cache = self._create_image(count, self._output_dirs['images_train'] if count <= self._params['num_train'] else self._output_dirs['images_val'])
-                self._create_annotation(bbox_cache, count, self._output_dirs['labels_train'] if count <= self._params['num_train'] else self._output_dirs['labels_val'])
-            print('Finished writing {} images.'.format(self._params['num_images']))
-
-    def visualize(self, directory='train', num_visualize=50):
-        """Draws bounding boxes around the images."""
+            print('Writing {} images...'.format(len(synt_tasks)))
+            self._create_images_in_chunks(synt_tasks)
+            print('Finished writing {} images.'.format(len(synt_tasks)))
+        print(_cache.format_stats(self._image_cache.stats()))
+        if self._is_sharding():
+            self._close_shard_writers()
+        self._write_dataset_index()
+        self._encoder.close()
+        _profiler.export()
+
+    def parallel_loop(self, num_cpus=None, chunk_size=None):
+        """Creates the images, sharding the synthetic images across a pool of num_cpus processes."""
+        if num_cpus is None:
+            num_cpus = cpu_count()
+        if num_cpus <= 1:
+            return self.loop()
+
+        if self._is_sharding():
+            self._open_shard_writers()
+        real_tasks, synt_tasks = self._get_scheduled_tasks()
+        if self._is_mixing():
+            self._copy_real_samples(real_tasks)
+        description = 'synthetic images' if self._is_mixing() else 'images'
+
+        # run the synthetic images through the pool, reporting aggregate progress
+        n = len(synt_tasks)
+        print('Writing {} {} on {} processes...'.format(n, description, num_cpus))
+        start = time.perf_counter()
+        cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        with tqdm.tqdm(total=n) as progress_bar:
+            # shards are written in task order so that their contents don't depend on worker timing
+            for num_done, result in _parallel.imap_chunks(self, '_create_images', synt_tasks, num_cpus, chunk_size, ordered=self._is_sharding()):
+                self._write_samples(result['samples'])
+                self._record_indexed(result['indexed'])
+                self._record_completed(result['completed'])
+                progress_bar.update(num_done)
+                for key in cache_stats:
+                    cache_stats[key] += result['cache_stats'][key]
+        elapsed = time.perf_counter() - start
+        print('Finished writing {} {} in {:.2f}s ({:.1f} images/sec).'.format(n, description, elapsed, n / elapsed if elapsed > 0 else 0.0))
+        print(_cache.format_stats(cache_stats))
+        if self._is_sharding():
+            self._close_shard_writers()
+        self._write_dataset_index()
+        self._encoder.close()
+        _profiler.export()
+
+    def work(self, worker=None, lease_seconds=60.0, poll_seconds=1.0, chunk_size=64):
+        """Generates chunks of the run joined with join=True until every chunk of it is done, together with the other workers.
+
+        The first worker splits the pending images of the run into chunks of chunk_size images in the queue in the output
+        directory. Workers lease one chunk at a time and renew their leases with heartbeats, so the chunks of a worker that
+        crashed are generated by another one lease_seconds later. A worker waits for the chunks leased by others every
+        poll_seconds, and the worker that finds the run finished writes its dataset index. worker names the worker in the
+        queue, which defaults to its host name and process id. The worker's connection to the queue is closed when it stops.
+        """
+        if self._work_queue is None:
+            print('Load a config with join=True before starting a worker.')
+            return
+        try:
+            if worker is None:
+                worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+            self._work_queue.lease_seconds = lease_seconds
+            with self._work_queue.transaction():
+                if not self._work_queue.is_created():
+                    real_tasks, synt_tasks = self._get_scheduled_tasks()
+                    self._work_queue.create(real_tasks, synt_tasks, chunk_size)
+                    print('Queued {} images in {} for the workers.'.format(len(real_tasks) + len(synt_tasks), self._dirs['output']))
+            print('Worker {} joined the run in {}.'.format(worker, self._dirs['output']))
+            num_images, fallbacks = 0, 0
+            start = time.perf_counter()
+            try:
+                with concurrent.futures.ThreadPoolExecutor(self._params.get('real_copy_threads', 8)) as executor, self._work_queue.heartbeats(worker):
+                    while True:
+                        with self._work_queue.transaction():
+                            chunk = self._work_queue.acquire(worker)
+                            is_finished = chunk is None and self._work_queue.is_finished()
+                        if chunk is None:
+                            if is_finished:
+                                break
+                            # the remaining chunks are leased by other workers, whose leases may still expire
+                            time.sleep(poll_seconds)
+                            continue
+
+                        chunk_id, kind, tasks = chunk
+                        if kind == 'real':
+                            completed, indexed, num_fallbacks = self._copy_real_chunk(executor, tasks)
+                            fallbacks += num_fallbacks
+                            _profiler.count('real_images_copied', len(tasks))
+                        else:
+                            result = self._create_images(tasks)
+                            completed, indexed = result['completed'], result['indexed']
+                        # the logs are appended under the queue's lock, so the lines of different workers don't interleave
+                        with self._work_queue.transaction():
+                            is_completed = self._work_queue.complete(chunk_id, worker)
+                            if is_completed:
+                                self._record_indexed(indexed)
+                                self._record_completed(completed)
+                        if not is_completed:
+                            # the lease expired, so the chunk is recorded by the worker that leases it next
+                            print('Worker {} lost the lease on a chunk of {} images, so its results are dropped.'.format(worker, len(tasks)))
+                            continue
+                        num_images += len(tasks)
+                        done, total = self._work_queue.progress()
+                        print('Worker {} finished a chunk of {} images ({}/{} chunks done).'.format(worker, len(tasks), done, total))
+            except BaseException:
+                # hand the unfinished chunks to the other workers at once instead of when their leases expire
+                with self._work_queue.transaction():
+                    self._work_queue.release(worker)
+                raise
+
+            elapsed = time.perf_counter() - start
+            _profiler.count('real_copy_fallbacks', fallbacks)
+            print('Worker {} wrote {} images in {:.2f}s.'.format(worker, num_images, elapsed))
+            with self._work_queue.transaction():
+                if not self._work_queue.is_finalized():
+                    # the index is read back from its log, which holds the entries of every worker
+                    self._dataset_index.load()
+                    self._write_dataset_index()
+                    self._work_queue.set_finalized()
+            _profiler.export()
+        finally:
+            # the heartbeat thread closed its own connection when it stopped
+            self._work_queue.close()
+            self._work_queue = None
+            self._encoder.close()
+
+    def _get_sheet_path(self, examples_dir, index):
+        """Returns the path of a contact sheet."""
+        return examples_dir + 'contact-sheet-{:04d}{}'.format(index, self._encoder.extension)
+
+    def _visualize_files(self, tasks):
+        """Draws the bounding boxes of a chunk of (image path, label path, examples dir, sheet, sheet index) tasks.
+            Saves each annotated image, or the chunk as one contact sheet when a (columns, rows) sheet is given."""
+        annotated = []
+        for image_path, label_path, examples_dir, sheet, _ in tasks:
+            with _profiler.stage('visualize_load'):
+                with open(label_path, 'rb') as file:
+                    boxes, class_ids = _visualizer.parse_label(file.read())
+                with Image.open(image_path) as image:
+                    array = np.array(image.convert('RGB'))
+            with _profiler.stage('visualize_draw'):
+                _visualizer.draw_boxes(array, boxes, class_ids)
+            _profiler.count('images_visualized')
+            if sheet is None:
+                image_name = os.path.splitext(os.path.split(image_path)[1])[0]
+                with _profiler.stage('visualize_encode'):
+                    self._encoder.encode(Image.fromarray(array), examples_dir+'annotated-{}{}'.format(image_name, self._encoder.extension))
+            else:
+                annotated.append(array)
+        if annotated:
+            _, _, examples_dir, sheet, index = tasks[0]
+            with _profiler.stage('visualize_encode'):
+                self._encoder.encode(Image.fromarray(_visualizer.make_contact_sheet(annotated, *sheet)), self._get_sheet_path(examples_dir, index))
+        return None
+
+    def visualize(self, directory='train', num_visualize=50, num_processes=None, sheet=None):
+        """Draws bounding boxes around the images, on a pool of num_processes processes if given.
+            With a (columns, rows) sheet, the annotated images are tiled into contact sheets instead of saved one by one."""
+        if self._is_sharding() and directory in ('train', 'val'):
+            print('Visualizing sharded output is not supported.')
+            return
+
         if directory == 'train' or directory == 'val':
-            if directory == 'train':
-                image_dir = self._output_dirs['images_train']
-                label_dir = self._output_dirs['labels_train']
-            elif directory == 'label':
-                image_dir = directory['images']
-                label_dir = directory['labels']
+            image_dir = self._output_dirs['images_' + directory]
+            label_dir = self._output_dirs['labels_' + directory]
             examples_dir = self._dirs['output']+'examples/'
-            
         else:
             if directory[-1] != '/':
                 directory += '/'
@@ -308,31 +1075,44 @@ class yards():
             shutil.rmtree(examples_dir)
         os.mkdir(examples_dir)
 
-        image_paths = glob.glob(image_dir+'*.png')[0:num_visualize]
-
-        print('Visualizing {} example images...'.format(num_visualize))
-        colors = {}
-        for i in tqdm.tqdm(range(len(image_paths))):
-            bboxes = []
-            image_name = os.path.splitext(os.path.split(image_paths[i])[1])[0]
-            with open(label_dir+'{}.txt'.format(image_name)) as file:
-                for line in file:
-                    line = [float(i) for i in line.split()]
-                    bboxes.append(line)
-            image = Image.open(image_paths[i])
-            draw = ImageDraw.Draw(image)
-            for bbox in bboxes:
-                c = int(bbox[0])
-                x1 = int(image.size[0]*bbox[1] - image.size[0]*bbox[3]/2)
-                y1 = int(image.size[1]*bbox[2] - image.size[1]*bbox[4]/2)
-                x2 = int(image.size[0]*bbox[1] + image.size[0]*bbox[3]/2)
-                y2 = int(image.size[1]*bbox[2] + image.size[1]*bbox[4]/2)
-                if c not in list(colors.keys()):
-                    colors[c] = tuple(choice(range(256), size=3))
-                draw.rectangle([x1, y1, x2, y2], fill=None, outline=colors[c])
-
-            image.save(examples_dir+'annotated-{}.png'.format(image_name))
-            image.close()
-        print('Finished visualizing {} example images.'.format(num_visualize))
+        image_paths = sorted(path for extension in _encoder.IMAGE_EXTENSIONS for path in glob.glob(image_dir+'*'+extension))[0:num_visualize]
+        per_sheet = sheet[0] * sheet[1] if sheet is not None else 1
+        tasks = [(path, label_dir + os.path.splitext(os.path.split(path)[1])[0] + '.txt', examples_dir, sheet, i // per_sheet)
+                 for i, path in enumerate(image_paths)]
+        # every chunk of a contact sheet run is one sheet
+        chunk_size = per_sheet if sheet is not None else None
+
+        print('Visualizing {} example images...'.format(len(tasks)))
+        with tqdm.tqdm(total=len(tasks)) as progress_bar:
+            if num_processes is not None and num_processes > 1:
+                for num_done, _ in _parallel.imap_chunks(self, '_visualize_files', tasks, num_processes, chunk_size):
+                    progress_bar.update(num_done)
+            else:
+                for chunk in _parallel.chunk_tasks(tasks, chunk_size or 64):
+                    self._visualize_files(chunk)
+                    progress_bar.update(len(chunk))
+        print('Finished visualizing {} example images.'.format(len(tasks)))
+        _profiler.export()
 
+    def visualize_samples(self, samples, num_visualize=50, sheet=None, output_dir=None):
+        """Draws bounding boxes around in-memory (image, boxes, class_ids) samples, such as the ones yielded by stream().
+            Returns the annotated images as arrays, tiled into contact sheets with a (columns, rows) sheet,
+            and also saves them to output_dir if given."""
+        annotated = []
+        for image, boxes, class_ids in itertools.islice(samples, num_visualize):
+            with _profiler.stage('visualize_draw'):
+                annotated.append(_visualizer.draw_boxes(np.array(image), boxes, class_ids))
+            _profiler.count('images_visualized')
+        if sheet is not None:
+            per_sheet = sheet[0] * sheet[1]
+            annotated = [_visualizer.make_contact_sheet(annotated[i:i+per_sheet], *sheet) for i in range(0, len(annotated), per_sheet)]
 
+        if output_dir is not None:
+            if output_dir[-1] != '/':
+                output_dir += '/'
+            os.makedirs(output_dir, exist_ok=True)
+            for i, array in enumerate(annotated):
+                path = self._get_sheet_path(output_dir, i) if sheet is not None else output_dir + 'annotated-{}{}'.format(i, self._encoder.extension)
+                with _profiler.stage('visualize_encode'):
+                    self._encoder.encode(Image.fromarray(array), path)
+        return annotated